@@ -0,0 +1,185 @@
+import os
+import time
+import uuid
+import shutil
+import sqlite3
+import tarfile
+import logging
+import threading
+from pathlib import Path
+from metrics import queued
+
+logger = logging.getLogger('creative_tool')
+
+BASE = Path(os.getenv('BASE_DIR', Path(__file__).resolve().parent.parent / "storage"))
+BACKUP_DIR = Path(os.getenv('BACKUP_DIR', BASE / "backups"))
+BACKUP_RETENTION_DAYS = int(os.getenv('BACKUP_RETENTION_DAYS', '30'))
+
+# Directories under the storage root whose files are never rewritten in place,
+# so a snapshot can hardlink the live file instead of copying it
+IMMUTABLE_DIRS = {'blobs'}
+# Top-level directories never part of a snapshot: earlier backups, in-flight scratch
+# files, and the rendition and background-mask caches, which are rebuilt on demand
+EXCLUDED_DIRS = {BACKUP_DIR.name, 'tmp', 'renditions', 'masks'}
+COMPLETE_MARKER = '.complete'
+JOB_ID_LENGTH = 12
+
+_jobs = {}
+_jobs_lock = threading.Lock()
+_run_lock = threading.Lock()
+
+def _snapshot_dirs():
+    if not BACKUP_DIR.exists():
+        return []
+    return sorted(d for d in BACKUP_DIR.iterdir() if d.is_dir() and (d / COMPLETE_MARKER).exists())
+
+def _link_or_copy(src, dst):
+    try:
+        os.link(src, dst)
+        return True
+    except OSError:
+        shutil.copy2(src, dst)
+        return False
+
+def _iter_source_files(db_path):
+    skip = {str(Path(db_path).resolve()) + suffix for suffix in ('', '-wal', '-shm', '-journal')}
+    backup_root = BACKUP_DIR.resolve()
+    for root, dirs, files in os.walk(BASE):
+        root_path = Path(root)
+        # Legacy backup_<ts> copies from the old copytree backups are skipped as well
+        top = root_path == BASE
+        dirs[:] = [d for d in dirs if not (top and (d in EXCLUDED_DIRS or d.startswith('backup_')))
+                   and (root_path / d).resolve() != backup_root]
+        for name in files:
+            path = root_path / name
+            if str(path.resolve()) not in skip:
+                yield path
+
+def _update(job_id, **fields):
+    with _jobs_lock:
+        _jobs[job_id].update(fields)
+
+def _run_backup(job_id, db_path):
+    job = _jobs[job_id]
+    final_dir = BACKUP_DIR / job['name']
+    work_dir = BACKUP_DIR / (job['name'] + '.partial')
+    try:
+        with queued('backup'), _run_lock:
+            snapshots = _snapshot_dirs()
+            previous = snapshots[-1] if snapshots else None
+            work_dir.mkdir(parents=True, exist_ok=True)
+
+            # Consistent database snapshot through SQLite's online backup API
+            src = sqlite3.connect(db_path)
+            dst = sqlite3.connect(str(work_dir / Path(db_path).name))
+            with dst:
+                src.backup(dst, pages=1024)
+            dst.close()
+            src.close()
+
+            files = list(_iter_source_files(db_path))
+            _update(job_id, state='running', files_total=len(files))
+            linked = copied = bytes_copied = 0
+            for i, path in enumerate(files, 1):
+                rel = path.relative_to(BASE)
+                dst_path = work_dir / 'files' / rel
+                dst_path.parent.mkdir(parents=True, exist_ok=True)
+                st = path.stat()
+                prev_path = previous / 'files' / rel if previous else None
+                if rel.parts[0] in IMMUTABLE_DIRS and _link_or_copy(path, dst_path):
+                    linked += 1
+                elif prev_path and prev_path.exists() and prev_path.stat().st_size == st.st_size \
+                        and int(prev_path.stat().st_mtime) == int(st.st_mtime) and _link_or_copy(prev_path, dst_path):
+                    # Unchanged since the previous snapshot: share its copy
+                    linked += 1
+                else:
+                    shutil.copy2(path, dst_path)
+                    copied += 1
+                    bytes_copied += st.st_size
+                if i % 100 == 0 or i == len(files):
+                    _update(job_id, files_done=i, files_linked=linked, files_copied=copied, bytes_copied=bytes_copied)
+
+            (work_dir / COMPLETE_MARKER).write_text(str(time.time()))
+            os.replace(work_dir, final_dir)
+            _prune_old_snapshots()
+        _update(job_id, state='success', finished_at=time.time(), backup_path=str(final_dir))
+        logger.info(f'Backup {job_id} completed: {_jobs[job_id]}')
+    except Exception as e:
+        shutil.rmtree(work_dir, ignore_errors=True)
+        _update(job_id, state='error', finished_at=time.time(), error=str(e))
+        logger.exception(f'Backup {job_id} failed')
+
+def _prune_old_snapshots():
+    cutoff = time.time() - BACKUP_RETENTION_DAYS * 24 * 60 * 60
+    snapshots = _snapshot_dirs()
+    # Always keep the newest snapshot as the base for the next incremental run
+    for snapshot in snapshots[:-1]:
+        if snapshot.stat().st_mtime < cutoff:
+            shutil.rmtree(snapshot, ignore_errors=True)
+
+def start_backup(db_path) -> dict:
+    """Start a snapshot in a background thread and return its job record"""
+    job_id = uuid.uuid4().hex[:JOB_ID_LENGTH]
+    # The full id is in the name so find_snapshot can match it exactly after a restart
+    name = f'backup_{time.strftime("%Y%m%d_%H%M%S")}_{job_id}'
+    job = {
+        'backup_id': job_id,
+        'name': name,
+        'state': 'queued',
+        'started_at': time.time(),
+        'finished_at': None,
+        'files_total': 0,
+        'files_done': 0,
+        'files_linked': 0,
+        'files_copied': 0,
+        'bytes_copied': 0,
+        'backup_path': str(BACKUP_DIR / name),
+        'error': None
+    }
+    with _jobs_lock:
+        _jobs[job_id] = job
+    threading.Thread(target=_run_backup, args=(job_id, db_path), name=f'backup-{job_id}', daemon=True).start()
+    return dict(job)
+
+def get_backup_job(job_id) -> dict:
+    with _jobs_lock:
+        job = _jobs.get(job_id)
+        return dict(job) if job else None
+
+def find_snapshot(backup_id) -> Path:
+    """Completed snapshot for a job id or an exact snapshot directory name"""
+    job = get_backup_job(backup_id)
+    if job and job['state'] == 'success':
+        return Path(job['backup_path'])
+    for snapshot in _snapshot_dirs():
+        if snapshot.name == backup_id or (len(backup_id) == JOB_ID_LENGTH and snapshot.name.rsplit('_', 1)[-1] == backup_id):
+            return snapshot
+    return None
+
+class _ChunkWriter:
+    """File-like sink that hands written bytes to a generator"""
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks.clear()
+        return data
+
+def stream_archive(snapshot: Path):
+    """Yield a gzip-compressed tar of a snapshot without building it on disk"""
+    writer = _ChunkWriter()
+    with tarfile.open(fileobj=writer, mode='w|gz') as tar:
+        for root, _, files in os.walk(snapshot):
+            for name in sorted(files):
+                path = Path(root) / name
+                tar.add(str(path), arcname=str(Path(snapshot.name) / path.relative_to(snapshot)))
+                chunk = writer.drain()
+                if chunk:
+                    yield chunk
+    yield writer.drain()
@@ -0,0 +1,190 @@
+"""
+Latency benchmarks for backend hot paths.
+
+Usage (from the backend directory):
+    python benchmarks.py ocr <image_dir> [--runs N]
+    python benchmarks.py detect <image_dir> [--batch-sizes 1,4,8,16] [--images N] [--backend torch|onnx]
+    python benchmarks.py encode <image_dir> [--runs N]
+    python benchmarks.py login [--url http://localhost:8000] [--users N] [--logins N] [--concurrency N]
+
+The login benchmark needs httpx: pip install -r requirements-dev.txt
+"""
+import argparse
+import statistics
+import time
+from pathlib import Path
+from PIL import Image
+
+IMAGE_SUFFIXES = {'.png', '.jpg', '.jpeg', '.webp'}
+
+def _load_images(image_dir):
+    paths = sorted(p for p in Path(image_dir).iterdir() if p.suffix.lower() in IMAGE_SUFFIXES)
+    if not paths:
+        raise SystemExit(f'No images found in {image_dir}')
+    images = []
+    for p in paths:
+        img = Image.open(p)
+        img.load()
+        images.append((p.name, img))
+    return images
+
+def _time_calls(fn, runs):
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        fn()
+        timings.append((time.perf_counter() - start) * 1000)
+    return timings
+
+def _report(name, timings, extra=''):
+    timings = sorted(timings)
+    p95 = timings[min(len(timings) - 1, int(len(timings) * 0.95))]
+    print(f'{name:<24} n={len(timings):<4} median={statistics.median(timings):8.1f}ms '
+          f'mean={statistics.mean(timings):8.1f}ms p95={p95:8.1f}ms{extra}')
+
+def bench_ocr(args):
+    import ocr
+    images = _load_images(args.image_dir)
+    backends = ['pytesseract']
+    if ocr.tesserocr is not None:
+        backends.insert(0, 'tesserocr')
+    else:
+        print('tesserocr not installed; only the pytesseract path is measured')
+
+    for backend in backends:
+        # Warm-up call so engine initialization is not counted as per-call latency
+        ocr.image_to_string(images[0][1], backend=backend)
+        timings = []
+        for _, img in images:
+            timings.extend(_time_calls(lambda: ocr.image_to_string(img, backend=backend), args.runs))
+        _report(f'ocr[{backend}]', timings)
+
+def bench_detect(args):
+    import detection
+    images = [img for _, img in _load_images(args.image_dir)]
+    # Repeat the corpus so every batch size sees the same number of images
+    images = (images * (args.images // len(images) + 1))[:args.images]
+    detector = detection.load_detector('cpu', backend=args.backend)
+    detection.detect_batch(detector, images[:1], batch_size=1)
+
+    for batch_size in [int(b) for b in args.batch_sizes.split(',')]:
+        start = time.perf_counter()
+        detection.detect_batch(detector, images, batch_size=batch_size)
+        elapsed = time.perf_counter() - start
+        print(f'detect[{args.backend or detection.DETECTION_BACKEND} batch={batch_size:<3}] images={len(images):<4} '
+              f'{len(images) / elapsed:7.2f} img/s  {elapsed / len(images) * 1000:8.1f}ms/img')
+
+def bench_encode(args):
+    import io
+    from encoders import CODECS, save_params, has_transparency
+    images = [img for _, img in _load_images(args.image_dir)]
+    raw_bytes = sum(len(img.tobytes()) for img in images)
+    configs = [('png', level) for level in (0, 1, 3, 6, 9)] + [('webp', None), ('jpeg', None)]
+
+    for codec, level in configs:
+        pil_format = CODECS[codec][0]
+        params = save_params(codec, level)
+        timings, total = [], 0
+        for img in images:
+            transparent = has_transparency(img)
+            if codec == 'jpeg' and transparent:
+                continue  # the policy never writes transparent images as JPEG
+            if codec != 'png' and img.mode not in ('RGB', 'RGBA'):
+                img = img.convert('RGBA' if transparent else 'RGB')
+            buf = io.BytesIO()
+            img.save(buf, format=pil_format, **params)
+            total += buf.tell()
+
+            def encode():
+                img.save(io.BytesIO(), format=pil_format, **params)
+            timings.extend(_time_calls(encode, args.runs))
+        if not timings:
+            continue
+        label = f'encode[{codec}' + (f' level={level}' if level is not None else '') + ']'
+        _report(label, timings, f'  size={total / 1024:9.0f}KB ({total / raw_bytes * 100:5.1f}% of raw)')
+
+def bench_login(args):
+    import asyncio
+    import httpx
+
+    async def run():
+        async with httpx.AsyncClient(base_url=args.url, timeout=60) as client:
+            users = [(f'bench_user_{i}', f'bench-password-{i}') for i in range(args.users)]
+            for username, password in users:
+                # 400 means the user exists from an earlier run
+                await client.post('/register', data={'username': username, 'password': password})
+
+            # Baseline latency of a cheap route with no login load
+            idle = []
+            for _ in range(20):
+                start = time.perf_counter()
+                await client.get('/health')
+                idle.append((time.perf_counter() - start) * 1000)
+
+            login_timings, probe_timings, statuses = [], [], {}
+            semaphore = asyncio.Semaphore(args.concurrency)
+            done = asyncio.Event()
+
+            async def login(i):
+                username, password = users[i % len(users)]
+                async with semaphore:
+                    start = time.perf_counter()
+                    resp = await client.post('/login', data={'username': username, 'password': password})
+                    login_timings.append((time.perf_counter() - start) * 1000)
+                    statuses[resp.status_code] = statuses.get(resp.status_code, 0) + 1
+
+            async def probe():
+                while not done.is_set():
+                    start = time.perf_counter()
+                    await client.get('/health')
+                    probe_timings.append((time.perf_counter() - start) * 1000)
+                    await asyncio.sleep(args.probe_interval)
+
+            probe_task = asyncio.create_task(probe())
+            start = time.perf_counter()
+            await asyncio.gather(*(login(i) for i in range(args.logins)))
+            elapsed = time.perf_counter() - start
+            done.set()
+            await probe_task
+
+        print(f'login throughput: {args.logins / elapsed:7.2f} logins/s over {elapsed:.1f}s  statuses={statuses}')
+        _report('login', login_timings)
+        _report('/health idle', idle)
+        _report('/health under login load', probe_timings)
+
+    asyncio.run(run())
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    p = sub.add_parser('ocr', help='Per-call OCR latency: resident tesserocr engines vs pytesseract subprocess')
+    p.add_argument('image_dir')
+    p.add_argument('--runs', type=int, default=5)
+    p.set_defaults(func=bench_ocr)
+
+    p = sub.add_parser('detect', help='CPU object-detection throughput per batch size')
+    p.add_argument('image_dir')
+    p.add_argument('--batch-sizes', default='1,4,8,16')
+    p.add_argument('--images', type=int, default=32)
+    p.add_argument('--backend', choices=['torch', 'onnx'])
+    p.set_defaults(func=bench_detect)
+
+    p = sub.add_parser('encode', help='Encode time against output size for each output codec setting')
+    p.add_argument('image_dir')
+    p.add_argument('--runs', type=int, default=3)
+    p.set_defaults(func=bench_encode)
+
+    p = sub.add_parser('login', help='Login throughput under concurrent load, and /health latency while it runs')
+    p.add_argument('--url', default='http://localhost:8000')
+    p.add_argument('--users', type=int, default=20)
+    p.add_argument('--logins', type=int, default=200)
+    p.add_argument('--concurrency', type=int, default=50)
+    p.add_argument('--probe-interval', type=float, default=0.05)
+    p.set_defaults(func=bench_login)
+
+    args = parser.parse_args()
+    args.func(args)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+import os
+import time
+import uuid
+import shutil
+import hashlib
+from pathlib import Path
+
+# Content-addressed storage: every stored file lives at blobs/<aa>/<bb>/<sha256><ext>
+BASE = Path(os.getenv('BASE_DIR', Path(__file__).resolve().parent.parent / "storage"))
+BLOB_DIR = BASE / "blobs"
+TMP_DIR = BLOB_DIR / "tmp"
+# Unreferenced blobs younger than this are kept; a request may be about to reference them
+BLOB_GC_GRACE_SECONDS = int(os.getenv('BLOB_GC_GRACE_SECONDS', '3600'))
+
+TMP_DIR.mkdir(parents=True, exist_ok=True)
+
+def is_blob(path) -> bool:
+    try:
+        Path(path).resolve().relative_to(BLOB_DIR.resolve())
+    except ValueError:
+        return False
+    return Path(path).parent.name != TMP_DIR.name
+
+def is_temp(path) -> bool:
+    """True for scratch files that were never added to the store"""
+    return Path(path).resolve().parent == TMP_DIR.resolve()
+
+def file_digest(path) -> str:
+    """sha256 of a file; blobs are named by their digest so no read is needed"""
+    if is_blob(path):
+        return Path(path).name.split('.')[0]
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def blob_path(digest: str, ext: str = '.png') -> Path:
+    return BLOB_DIR / digest[:2] / digest[2:4] / (digest + ext.lower())
+
+def temp_path(suffix: str = '.png') -> Path:
+    """Scratch file inside the store, so put_file can rename rather than copy"""
+    return TMP_DIR / (uuid.uuid4().hex + suffix)
+
+def put_file(src, move: bool = True) -> str:
+    """Add a file to the store and return its blob path.
+
+    If identical content is already stored the source is discarded and the
+    existing blob is returned, so duplicate outputs cost no extra bytes.
+    """
+    src = Path(src)
+    dest = blob_path(file_digest(src), src.suffix or '.png')
+    if dest.exists():
+        # Refresh mtime so a concurrent GC pass treats it as recently used
+        os.utime(dest)
+        if move:
+            src.unlink()
+        return str(dest)
+    dest.parent.mkdir(parents=True, exist_ok=True)
+    if move:
+        os.replace(src, dest)
+    else:
+        tmp = temp_path(dest.suffix)
+        shutil.copyfile(src, tmp)
+        os.replace(tmp, dest)
+    return str(dest)
+
+def put_bytes(data: bytes, suffix: str = '.png') -> str:
+    tmp = temp_path(suffix)
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    return put_file(tmp)
+
+def collect_garbage(db_path, grace_seconds: int = None, dry_run: bool = False,
+                    batch_size: int = 0, pause: float = 0.0) -> dict:
+    """Delete blob files no asset version references.
+
+    With batch_size set, sleeps `pause` seconds after every batch of deletions
+    to limit I/O pressure on a serving node.
+    """
+    from db import get_referenced_blob_paths, delete_blob_rows
+    grace_seconds = BLOB_GC_GRACE_SECONDS if grace_seconds is None else grace_seconds
+    referenced = get_referenced_blob_paths(db_path)
+    cutoff = time.time() - grace_seconds
+    removed = []
+    bytes_freed = 0
+    for f in BLOB_DIR.rglob('*'):
+        if not f.is_file() or str(f) in referenced:
+            continue
+        st = f.stat()
+        if st.st_mtime >= cutoff:
+            continue
+        if not dry_run:
+            f.unlink()
+            if batch_size and len(removed) % batch_size == batch_size - 1:
+                time.sleep(pause)
+        removed.append(str(f))
+        bytes_freed += st.st_size
+    if not dry_run:
+        delete_blob_rows(db_path, removed)
+    return {'removed_files': len(removed), 'bytes_freed': bytes_freed, 'dry_run': dry_run}
+
+def migrate_to_blobstore(db_path) -> dict:
+    """Move every file referenced by assets/asset_versions into the store"""
+    from db import list_version_paths, replace_asset_path, rebuild_blob_refcounts
+    migrated = missing = 0
+    for path in list_version_paths(db_path):
+        if is_blob(path):
+            continue
+        if not os.path.exists(path):
+            missing += 1
+            continue
+        new_path = put_file(path, move=False)
+        replace_asset_path(db_path, path, new_path)
+        os.remove(path)
+        migrated += 1
+    rebuild_blob_refcounts(db_path)
+    return {'migrated': migrated, 'missing': missing}
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Content-addressed blob store maintenance')
+    parser.add_argument('command', choices=['migrate', 'gc'])
+    parser.add_argument('--db', default=os.getenv('DB_PATH', str(BASE / "assets.db")))
+    parser.add_argument('--dry-run', action='store_true')
+    args = parser.parse_args()
+    if args.command == 'migrate':
+        print(migrate_to_blobstore(args.db))
+    else:
+        print(collect_garbage(args.db, dry_run=args.dry_run))
@@ -1,5 +1,34 @@
-import sqlite3, os, time
+import sqlite3, os, time, json, itertools, threading
 from pathlib import Path
+from metrics import instrument_module
+
+HASH_BITS = 64
+HASH_BANDS = 4
+_BAND_BITS = HASH_BITS // HASH_BANDS
+_HASH_MASK = (1 << HASH_BITS) - 1
+# Bound parameters per statement on older SQLite builds; longer IN lists are split
+_SQL_VARIABLE_LIMIT = 999
+
+ROLLUP_DIMENSIONS = ('upload_hour', 'upload_day', 'user_uploads', 'user_versions', 'category', 'label',
+                     'size', 'operation', 'processed')
+# Label keyword rules for asset categories; the first matching category wins
+LABEL_CATEGORIES = [
+    ('Product', ('product', 'shot')),
+    ('Lifestyle', ('lifestyle', 'scene')),
+    ('Banner', ('banner', 'header')),
+    ('Packshot', ('packshot', 'package'))
+]
+# User rows are cached per worker; the TTL bounds how long a change made by another worker goes unseen
+USER_CACHE_TTL = float(os.getenv('USER_CACHE_TTL', '30'))
+USER_CACHE_SIZE = int(os.getenv('USER_CACHE_SIZE', '10000'))
+# Upper bound in bytes for each upload size bucket
+SIZE_BUCKETS = [(100 * 1024, '<100KB'), (500 * 1024, '100-500KB'), (1024 * 1024, '500KB-1MB'),
+                (5 * 1024 * 1024, '1-5MB'), (None, '>5MB')]
+
+def _ensure_column(c, table, column, decl):
+    columns = [r[1] for r in c.execute(f'PRAGMA table_info({table})').fetchall()]
+    if column not in columns:
+        c.execute(f'ALTER TABLE {table} ADD COLUMN {column} {decl}')
 
 def init_db(db_path):
     os.makedirs(os.path.dirname(db_path), exist_ok=True)
@@ -34,8 +63,61 @@ def init_db(db_path):
                  FOREIGN KEY (asset_id) REFERENCES assets (id),
                  FOREIGN KEY (version_id) REFERENCES asset_versions (id)
                  )''')
+    # Op-log versioning: derivation base, keyframe flag and access counter for promotion
+    _ensure_column(c, 'asset_versions', 'base_version', 'INTEGER')
+    _ensure_column(c, 'asset_versions', 'is_keyframe', 'INTEGER DEFAULT 1')
+    _ensure_column(c, 'asset_versions', 'access_count', 'INTEGER DEFAULT 0')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_asset_versions_asset ON asset_versions (asset_id, version_number)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_assets_uploaded_at ON assets (uploaded_at)')
+    # Analytics counters kept in step with assets/asset_versions by the writers below
+    c.execute('''CREATE TABLE IF NOT EXISTS analytics_rollups (
+                 dimension TEXT,
+                 bucket TEXT,
+                 count INTEGER DEFAULT 0,
+                 bytes INTEGER DEFAULT 0,
+                 PRIMARY KEY (dimension, bucket)
+                 ) WITHOUT ROWID''')
+    # Perceptual hashes split into 16-bit bands for multi-index Hamming lookup
+    c.execute('''CREATE TABLE IF NOT EXISTS asset_hashes (
+                 asset_id INTEGER PRIMARY KEY,
+                 phash INTEGER,
+                 dhash INTEGER,
+                 band0 INTEGER,
+                 band1 INTEGER,
+                 band2 INTEGER,
+                 band3 INTEGER,
+                 FOREIGN KEY (asset_id) REFERENCES assets (id)
+                 )''')
+    for band in range(HASH_BANDS):
+        c.execute(f'CREATE INDEX IF NOT EXISTS idx_asset_hashes_band{band} ON asset_hashes (band{band})')
+    c.execute('''CREATE TABLE IF NOT EXISTS users (
+                 id INTEGER PRIMARY KEY AUTOINCREMENT,
+                 username TEXT NOT NULL UNIQUE,
+                 password_hash TEXT NOT NULL,
+                 email TEXT,
+                 role TEXT DEFAULT 'user',
+                 created_at REAL
+                 )''')
+    # Stored files with the number of keyframe asset_versions rows that point at them
+    c.execute('''CREATE TABLE IF NOT EXISTS blobs (
+                 path TEXT PRIMARY KEY,
+                 size INTEGER,
+                 refcount INTEGER DEFAULT 0,
+                 created_at REAL
+                 )''')
+    needs_backfill = c.execute('SELECT 1 FROM assets LIMIT 1').fetchone() is not None \
+        and c.execute('SELECT 1 FROM analytics_rollups LIMIT 1').fetchone() is None
     conn.commit()
     conn.close()
+    if needs_backfill:
+        # First start after rollups were introduced
+        rebuild_rollups(db_path)
+
+def _add_blob_ref(c, path, delta=1):
+    size = os.path.getsize(path) if os.path.exists(path) else None
+    c.execute('INSERT OR IGNORE INTO blobs (path, size, refcount, created_at) VALUES (?, ?, 0, ?)',
+              (path, size, time.time()))
+    c.execute('UPDATE blobs SET refcount = MAX(0, refcount + ?) WHERE path=?', (delta, path))
 
 def save_asset(db_path, filepath, label, created_by=None):
     conn = sqlite3.connect(db_path)
@@ -48,6 +130,9 @@ def save_asset(db_path, filepath, label, created_by=None):
     # Create initial version
     c.execute('INSERT INTO asset_versions (asset_id, version_number, path, operation, created_at, created_by) VALUES (?, ?, ?, ?, ?, ?)',
               (asset_id, 1, filepath, 'upload', current_time, created_by))
+    _add_blob_ref(c, filepath)
+    _rollup_upload(c, label, current_time, created_by, os.path.getsize(filepath) if os.path.exists(filepath) else 0)
+    _rollup_version(c, 'upload', created_by)
 
     conn.commit()
     conn.close()
@@ -82,13 +167,16 @@ def save_asset_version(db_path, asset_id, new_path, operation, operation_params=
         conn.close()
         return None
 
-    new_version = row[0] + 1
+    base_version = row[0]
+    new_version = base_version + 1
     current_time = time.time()
 
     # Insert new version
-    c.execute('''INSERT INTO asset_versions (asset_id, version_number, path, operation, operation_params, created_at, created_by)
-                 VALUES (?, ?, ?, ?, ?, ?, ?)''',
-              (asset_id, new_version, new_path, operation, operation_params, current_time, created_by))
+    c.execute('''INSERT INTO asset_versions (asset_id, version_number, path, operation, operation_params, created_at, created_by, base_version)
+                 VALUES (?, ?, ?, ?, ?, ?, ?, ?)''',
+              (asset_id, new_version, new_path, operation, operation_params, current_time, created_by, base_version))
+    _add_blob_ref(c, new_path)
+    _rollup_version(c, operation, created_by)
 
     # Update asset current version and path
     c.execute('UPDATE assets SET current_version=?, path=? WHERE id=?', (new_version, new_path, asset_id))
@@ -100,10 +188,62 @@ def save_asset_version(db_path, asset_id, new_path, operation, operation_params=
 def get_asset_versions(db_path, asset_id):
     conn = sqlite3.connect(db_path)
     c = conn.cursor()
-    rows = c.execute('''SELECT version_number, operation, operation_params, created_at, created_by
+    rows = c.execute('''SELECT version_number, operation, operation_params, created_at, created_by, is_keyframe
                         FROM asset_versions WHERE asset_id=? ORDER BY version_number DESC''', (asset_id,)).fetchall()
     conn.close()
-    return [{'version': r[0], 'operation': r[1], 'params': r[2], 'created_at': r[3], 'created_by': r[4]} for r in rows]
+    return [{'version': r[0], 'operation': r[1], 'params': r[2], 'created_at': r[3], 'created_by': r[4], 'keyframe': bool(r[5])} for r in rows]
+
+def get_version_record(db_path, asset_id, version):
+    conn = sqlite3.connect(db_path)
+    c = conn.cursor()
+    row = c.execute('''SELECT version_number, path, operation, operation_params, base_version, is_keyframe, access_count, created_at
+                       FROM asset_versions WHERE asset_id=? AND version_number=?''', (asset_id, version)).fetchone()
+    conn.close()
+    if not row:
+        return None
+    return {'version': row[0], 'path': row[1], 'operation': row[2], 'params': row[3],
+            'base_version': row[4] if row[4] is not None else row[0] - 1,
+            'is_keyframe': bool(row[5]), 'access_count': row[6] or 0, 'created_at': row[7]}
+
+def get_current_version(db_path, asset_id):
+    """Path and number of an asset's current version, with when that version was created"""
+    conn = sqlite3.connect(db_path)
+    c = conn.cursor()
+    row = c.execute('''SELECT a.path, a.current_version, COALESCE(v.created_at, a.uploaded_at)
+                       FROM assets a LEFT JOIN asset_versions v
+                       ON v.asset_id = a.id AND v.version_number = a.current_version
+                       WHERE a.id=?''', (asset_id,)).fetchone()
+    conn.close()
+    return {'path': row[0], 'version': row[1], 'created_at': row[2]} if row else None
+
+def set_version_keyframe(db_path, asset_id, version, keyframe, path=None):
+    """Promote or demote a version; keyframes hold a blob reference, op-log-only versions do not"""
+    conn = sqlite3.connect(db_path)
+    c = conn.cursor()
+    row = c.execute('SELECT path, is_keyframe FROM asset_versions WHERE asset_id=? AND version_number=?',
+                    (asset_id, version)).fetchone()
+    if row and bool(row[1]) != keyframe:
+        old_path = row[0]
+        new_path = path or old_path
+        c.execute('UPDATE asset_versions SET is_keyframe=?, path=? WHERE asset_id=? AND version_number=?',
+                  (1 if keyframe else 0, new_path, asset_id, version))
+        if keyframe:
+            _add_blob_ref(c, new_path)
+        else:
+            _add_blob_ref(c, old_path, -1)
+    conn.commit()
+    conn.close()
+
+def record_version_access(db_path, asset_id, version):
+    conn = sqlite3.connect(db_path)
+    c = conn.cursor()
+    c.execute('UPDATE asset_versions SET access_count = COALESCE(access_count, 0) + 1 WHERE asset_id=? AND version_number=?',
+              (asset_id, version))
+    row = c.execute('SELECT access_count FROM asset_versions WHERE asset_id=? AND version_number=?',
+                    (asset_id, version)).fetchone()
+    conn.commit()
+    conn.close()
+    return row[0] if row else 0
 
 def add_asset_comment(db_path, asset_id, comment, version_id=None, created_by=None):
     conn = sqlite3.connect(db_path)
@@ -124,3 +264,337 @@ def get_asset_comments(db_path, asset_id):
                         WHERE c.asset_id=? ORDER BY c.created_at DESC''', (asset_id,)).fetchall()
     conn.close()
     return [{'comment': r[0], 'created_at': r[1], 'created_by': r[2], 'version': r[3]} for r in rows]
+
+_user_cache = {}
+_user_cache_lock = threading.Lock()
+
+def _invalidate_user(username):
+    with _user_cache_lock:
+        _user_cache.pop(username, None)
+
+def get_user(db_path, username):
+    """User row by username, served from the in-memory cache when fresh"""
+    now = time.time()
+    cached = _user_cache.get(username)
+    if cached and cached[0] > now:
+        return cached[1]
+    conn = sqlite3.connect(db_path)
+    c = conn.cursor()
+    row = c.execute('SELECT username, password_hash, email, role, created_at FROM users WHERE username=?', (username,)).fetchone()
+    conn.close()
+    user = {'username': row[0], 'password_hash': row[1], 'email': row[2], 'role': row[3], 'created_at': row[4]} if row else None
+    # Misses are not cached so a user registered on another worker can log in immediately
+    if user:
+        with _user_cache_lock:
+            if len(_user_cache) >= USER_CACHE_SIZE:
+                _user_cache.clear()
+            _user_cache[username] = (now + USER_CACHE_TTL, user)
+    return user
+
+def create_user(db_path, username, password_hash, email=None, role='user', created_at=None):
+    """Insert a user; returns False if the username is taken"""
+    conn = sqlite3.connect(db_path)
+    c = conn.cursor()
+    try:
+        c.execute('INSERT INTO users (username, password_hash, email, role, created_at) VALUES (?, ?, ?, ?, ?)',
+                  (username, password_hash, email, role, created_at or time.time()))
+        conn.commit()
+    except sqlite3.IntegrityError:
+        return False
+    finally:
+        conn.close()
+    _invalidate_user(username)
+    return True
+
+def update_user_password(db_path, username, password_hash):
+    conn = sqlite3.connect(db_path)
+    c = conn.cursor()
+    c.execute('UPDATE users SET password_hash=? WHERE username=?', (password_hash, username))
+    updated = c.rowcount
+    conn.commit()
+    conn.close()
+    _invalidate_user(username)
+    return updated > 0
+
+def import_users_json(db_path, users_file):
+    """One-time import of the legacy users.json; the file is renamed once imported"""
+    if not os.path.exists(users_file):
+        return 0
+    with open(users_file, 'r') as f:
+        users = json.load(f)
+    conn = sqlite3.connect(db_path)
+    c = conn.cursor()
+    imported = 0
+    for username, user in users.items():
+        c.execute('INSERT OR IGNORE INTO users (username, password_hash, email, role, created_at) VALUES (?, ?, ?, ?, ?)',
+                  (username, user['password_hash'], user.get('email'), user.get('role', 'user'), user.get('created_at')))
+        imported += c.rowcount
+    conn.commit()
+    conn.close()
+    os.replace(users_file, users_file + '.imported')
+    return imported
+
+def get_referenced_blob_paths(db_path):
+    conn = sqlite3.connect(db_path)
+    c = conn.cursor()
+    rows = c.execute('SELECT path FROM blobs WHERE refcount > 0').fetchall()
+    conn.close()
+    return {r[0] for r in rows}
+
+def delete_blob_rows(db_path, paths):
+    conn = sqlite3.connect(db_path)
+    c = conn.cursor()
+    c.executemany('DELETE FROM blobs WHERE path=? AND refcount <= 0', [(p,) for p in paths])
+    conn.commit()
+    conn.close()
+
+def list_version_paths(db_path):
+    conn = sqlite3.connect(db_path)
+    c = conn.cursor()
+    rows = c.execute('SELECT path FROM asset_versions UNION SELECT path FROM assets').fetchall()
+    conn.close()
+    return [r[0] for r in rows if r[0]]
+
+def replace_asset_path(db_path, old_path, new_path):
+    conn = sqlite3.connect(db_path)
+    c = conn.cursor()
+    c.execute('UPDATE asset_versions SET path=? WHERE path=?', (new_path, old_path))
+    c.execute('UPDATE assets SET path=? WHERE path=?', (new_path, old_path))
+    conn.commit()
+    conn.close()
+
+def rebuild_blob_refcounts(db_path):
+    """Recompute blob reference counts and sizes from asset_versions"""
+    conn = sqlite3.connect(db_path)
+    c = conn.cursor()
+    c.execute('UPDATE blobs SET refcount = 0')
+    rows = c.execute('SELECT path, COUNT(*) FROM asset_versions WHERE path IS NOT NULL AND is_keyframe=1 GROUP BY path').fetchall()
+    for path, count in rows:
+        _add_blob_ref(c, path, count)
+    conn.commit()
+    conn.close()
+
+def select_reclaimable_versions(db_path, keep_last, cutoff, keep_commented=True, keep_original=True):
+    """Versions outside the retention policy, selected in SQL.
+
+    A version is kept when it is among the newest `keep_last` of its asset, is
+    newer than `cutoff`, has comments (optional), is the original upload
+    (optional), or is the replay base of an op-log-only version.
+    """
+    conn = sqlite3.connect(db_path)
+    c = conn.cursor()
+    query = '''SELECT v.id, v.asset_id, v.version_number, v.path, v.is_keyframe, b.size, b.refcount
+               FROM asset_versions v
+               JOIN assets a ON a.id = v.asset_id
+               LEFT JOIN blobs b ON b.path = v.path
+               WHERE v.version_number <= a.current_version - ?
+                 AND v.created_at < ?
+                 AND NOT EXISTS (SELECT 1 FROM asset_versions d
+                                 WHERE d.asset_id = v.asset_id AND d.is_keyframe = 0
+                                   AND (d.base_version = v.version_number
+                                        OR (d.operation = 'restore'
+                                            AND json_extract(d.operation_params, '$.restored_from') = v.version_number)))'''
+    if keep_commented:
+        query += ' AND NOT EXISTS (SELECT 1 FROM asset_comments cm WHERE cm.version_id = v.id)'
+    if keep_original:
+        query += ' AND v.version_number > 1'
+    rows = c.execute(query + ' ORDER BY v.asset_id, v.version_number', (max(1, keep_last), cutoff)).fetchall()
+    conn.close()
+    return [{'id': r[0], 'asset_id': r[1], 'version': r[2], 'path': r[3], 'is_keyframe': bool(r[4]),
+             'size': r[5] or 0, 'refcount': r[6] or 0} for r in rows]
+
+def delete_asset_versions(db_path, version_ids):
+    """Delete version rows and their blob references; returns paths left unreferenced"""
+    conn = sqlite3.connect(db_path)
+    c = conn.cursor()
+    released = set()
+    for version_id in version_ids:
+        row = c.execute('SELECT path, is_keyframe, operation, created_by FROM asset_versions WHERE id=?', (version_id,)).fetchone()
+        if not row:
+            continue
+        c.execute('DELETE FROM asset_versions WHERE id=?', (version_id,))
+        _rollup_version(c, row[2], row[3], -1)
+        if row[1]:
+            _add_blob_ref(c, row[0], -1)
+            released.add(row[0])
+    # Refcounts for files from before the blob store start at 0 while other versions may
+    # still share the file, so a path is only unreferenced once no row points at it
+    unreferenced = [p for p in released
+                    if (c.execute('SELECT refcount FROM blobs WHERE path=?', (p,)).fetchone() or (0,))[0] <= 0
+                    and not c.execute('SELECT 1 FROM asset_versions WHERE path=? UNION ALL '
+                                      'SELECT 1 FROM assets WHERE path=? LIMIT 1', (p, p)).fetchone()]
+    conn.commit()
+    conn.close()
+    return unreferenced
+
+def count_assets_before(db_path, cutoff):
+    conn = sqlite3.connect(db_path)
+    c = conn.cursor()
+    row = c.execute('SELECT COUNT(*) FROM assets WHERE uploaded_at < ?', (cutoff,)).fetchone()
+    conn.close()
+    return row[0]
+
+def get_storage_totals(db_path):
+    """Asset count and stored bytes from recorded blob sizes, without touching the files"""
+    conn = sqlite3.connect(db_path)
+    c = conn.cursor()
+    total_assets = c.execute('SELECT COUNT(*) FROM assets').fetchone()[0]
+    total_versions = c.execute('SELECT COUNT(*) FROM asset_versions').fetchone()[0]
+    blob_count, stored_bytes = c.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM blobs WHERE refcount > 0').fetchone()
+    conn.close()
+    return {'total_assets': total_assets, 'total_versions': total_versions,
+            'blob_count': blob_count, 'storage_bytes': stored_bytes}
+
+def label_category(label) -> str:
+    label = (label or '').lower()
+    for category, keywords in LABEL_CATEGORIES:
+        if any(k in label for k in keywords):
+            return category
+    return 'Other'
+
+def size_bucket(size) -> str:
+    for limit, name in SIZE_BUCKETS:
+        if limit is None or size < limit:
+            return name
+
+def _bump_rollup(c, dimension, bucket, count=1, nbytes=0):
+    c.execute('''INSERT INTO analytics_rollups (dimension, bucket, count, bytes) VALUES (?, ?, ?, ?)
+                 ON CONFLICT (dimension, bucket) DO UPDATE SET count = count + excluded.count, bytes = bytes + excluded.bytes''',
+              (dimension, bucket, count, nbytes))
+
+def _upload_buckets(label, uploaded_at, created_by, size):
+    ts = time.gmtime(uploaded_at)
+    buckets = [
+        ('upload_hour', f'{ts.tm_hour:02d}'),
+        ('upload_day', time.strftime('%Y-%m-%d', ts)),
+        ('user_uploads', created_by or 'unknown'),
+        ('category', label_category(label)),
+        ('label', label or ''),
+        ('size', size_bucket(size))
+    ]
+    if 'processed' in (label or '').lower():
+        buckets.append(('processed', 'processed'))
+    return buckets
+
+def _rollup_upload(c, label, uploaded_at, created_by, size):
+    for dimension, bucket in _upload_buckets(label, uploaded_at, created_by, size):
+        _bump_rollup(c, dimension, bucket, 1, size)
+
+def _rollup_version(c, operation, created_by, delta=1):
+    _bump_rollup(c, 'operation', operation or 'unknown', delta)
+    _bump_rollup(c, 'user_versions', created_by or 'unknown', delta)
+
+def rebuild_rollups(db_path):
+    """Recompute every rollup from assets and asset_versions (backfill or repair)"""
+    conn = sqlite3.connect(db_path)
+    c = conn.cursor()
+    totals = {}
+    rows = c.execute('''SELECT a.label, a.uploaded_at, a.created_by, v.path, b.size
+                         FROM assets a
+                         LEFT JOIN asset_versions v ON v.asset_id = a.id AND v.version_number = 1
+                         LEFT JOIN blobs b ON b.path = v.path''')
+    for label, uploaded_at, created_by, path, size in rows:
+        if size is None:
+            size = os.path.getsize(path) if path and os.path.exists(path) else 0
+        for key in _upload_buckets(label, uploaded_at or 0, created_by, size):
+            count, nbytes = totals.get(key, (0, 0))
+            totals[key] = (count + 1, nbytes + size)
+    for operation, count in c.execute('SELECT operation, COUNT(*) FROM asset_versions GROUP BY operation').fetchall():
+        totals[('operation', operation or 'unknown')] = (count, 0)
+    for user, count in c.execute('SELECT created_by, COUNT(*) FROM asset_versions GROUP BY created_by').fetchall():
+        totals[('user_versions', user or 'unknown')] = (count, 0)
+    c.execute('DELETE FROM analytics_rollups')
+    c.executemany('INSERT INTO analytics_rollups (dimension, bucket, count, bytes) VALUES (?, ?, ?, ?)',
+                  [(d, b, n, size) for (d, b), (n, size) in totals.items()])
+    conn.commit()
+    conn.close()
+    return len(totals)
+
+def get_rollup(db_path, dimension, order_by_count=False, limit=None, since=None):
+    """Rows of one rollup dimension as (bucket, count, bytes); reads only that dimension's rows"""
+    conn = sqlite3.connect(db_path)
+    c = conn.cursor()
+    query = 'SELECT bucket, count, bytes FROM analytics_rollups WHERE dimension=? AND count > 0'
+    params = [dimension]
+    if since is not None:
+        query += ' AND bucket >= ?'
+        params.append(since)
+    query += ' ORDER BY count DESC' if order_by_count else ' ORDER BY bucket'
+    if limit:
+        query += ' LIMIT ?'
+        params.append(limit)
+    rows = c.execute(query, params).fetchall()
+    conn.close()
+    return rows
+
+def _to_signed(h):
+    # SQLite integers are signed 64-bit
+    return h - (1 << HASH_BITS) if h >= (1 << (HASH_BITS - 1)) else h
+
+def _bands(h):
+    return [(h >> (band * _BAND_BITS)) & ((1 << _BAND_BITS) - 1) for band in range(HASH_BANDS)]
+
+def _band_variants(value, radius):
+    """All band values within `radius` bit flips of value"""
+    variants = [value]
+    for r in range(1, radius + 1):
+        for bits in itertools.combinations(range(_BAND_BITS), r):
+            v = value
+            for b in bits:
+                v ^= 1 << b
+            variants.append(v)
+    return variants
+
+def _hamming(a, b):
+    return bin((a ^ b) & _HASH_MASK).count('1')
+
+def save_asset_hash(db_path, asset_id, phash, dhash):
+    conn = sqlite3.connect(db_path)
+    c = conn.cursor()
+    c.execute('INSERT OR REPLACE INTO asset_hashes (asset_id, phash, dhash, band0, band1, band2, band3) VALUES (?, ?, ?, ?, ?, ?, ?)',
+              (asset_id, _to_signed(phash), _to_signed(dhash), *_bands(phash)))
+    conn.commit()
+    conn.close()
+
+def get_asset_hash(db_path, asset_id):
+    conn = sqlite3.connect(db_path)
+    c = conn.cursor()
+    row = c.execute('SELECT phash, dhash FROM asset_hashes WHERE asset_id=?', (asset_id,)).fetchone()
+    conn.close()
+    return {'phash': row[0] & _HASH_MASK, 'dhash': row[1] & _HASH_MASK} if row else None
+
+def find_near_duplicates(db_path, phash, dhash=None, max_distance=6, exclude_id=None):
+    """Assets whose pHash is within max_distance bits, closest first.
+
+    Any hash within max_distance of the query matches at least one of the
+    HASH_BANDS bands within max_distance // HASH_BANDS bits (pigeonhole), so
+    only those band values are looked up through the band indexes.
+    """
+    radius = max_distance // HASH_BANDS
+    conn = sqlite3.connect(db_path)
+    c = conn.cursor()
+    candidates = {}
+    for band, value in enumerate(_bands(phash)):
+        variants = _band_variants(value, radius)
+        for start in range(0, len(variants), _SQL_VARIABLE_LIMIT):
+            chunk = variants[start:start + _SQL_VARIABLE_LIMIT]
+            placeholders = ','.join('?' * len(chunk))
+            rows = c.execute(f'SELECT asset_id, phash, dhash FROM asset_hashes WHERE band{band} IN ({placeholders})',
+                             chunk).fetchall()
+            for r in rows:
+                candidates[r[0]] = (r[1] & _HASH_MASK, r[2] & _HASH_MASK)
+    conn.close()
+
+    matches = []
+    for asset_id, (cand_phash, cand_dhash) in candidates.items():
+        if asset_id == exclude_id:
+            continue
+        distance = _hamming(phash, cand_phash)
+        if distance <= max_distance:
+            match = {'asset_id': asset_id, 'distance': distance}
+            if dhash is not None:
+                match['dhash_distance'] = _hamming(dhash, cand_dhash)
+            matches.append(match)
+    return sorted(matches, key=lambda m: (m['distance'], m.get('dhash_distance', 0)))
+
+instrument_module(globals(), 'db')
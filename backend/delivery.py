@@ -0,0 +1,140 @@
+import os
+import mimetypes
+import threading
+from collections import OrderedDict
+from datetime import timezone
+from email.utils import formatdate, parsedate_to_datetime
+from pathlib import Path
+from urllib.parse import quote
+from fastapi.responses import FileResponse, Response
+import blobstore
+from metrics import cache_lookup, register_cache
+
+# Version URLs never change content; current-asset URLs must be revalidated (cheap with the ETag)
+IMMUTABLE_CACHE_CONTROL = 'private, max-age=31536000, immutable'
+REVALIDATE_CACHE_CONTROL = 'private, no-cache'
+FILE_INFO_CACHE_SIZE = int(os.getenv('FILE_INFO_CACHE_SIZE', '4096'))
+
+# 'direct' streams files from Python; 'x-accel' hands them to nginx, which serves
+# STORAGE_ROOT under X_ACCEL_LOCATION with sendfile. Only requests that nginx marks
+# with 'X-Sendfile-Type: X-Accel-Redirect' are redirected, so direct callers of
+# the backend still receive the bytes.
+FILE_DELIVERY = os.getenv('FILE_DELIVERY', 'direct').lower()
+X_ACCEL_LOCATION = os.getenv('X_ACCEL_LOCATION', '/_storage/')
+STORAGE_ROOT = Path(os.getenv('BASE_DIR', Path(__file__).resolve().parent.parent / "storage")).resolve()
+
+_SIGNATURES = (
+    (b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (b'\xff\xd8\xff', 'image/jpeg'),
+    (b'GIF87a', 'image/gif'),
+    (b'GIF89a', 'image/gif'),
+    (b'BM', 'image/bmp'),
+    (b'II*\x00', 'image/tiff'),
+    (b'MM\x00*', 'image/tiff'),
+)
+_FTYP_BRANDS = {b'avif': 'image/avif', b'avis': 'image/avif', b'heic': 'image/heic', b'heix': 'image/heic', b'mif1': 'image/heif'}
+
+_file_info = OrderedDict()
+_file_info_lock = threading.Lock()
+register_cache('file_info', lambda: (None, None, len(_file_info)))
+
+def detect_media_type(path) -> str:
+    """Media type from the file's magic bytes; the extension is only a fallback since uploads keep theirs"""
+    with open(path, 'rb') as f:
+        head = f.read(32)
+    for signature, media_type in _SIGNATURES:
+        if head.startswith(signature):
+            return media_type
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return 'image/webp'
+    if head[4:8] == b'ftyp' and head[8:12] in _FTYP_BRANDS:
+        return _FTYP_BRANDS[head[8:12]]
+    return mimetypes.guess_type(str(path))[0] or 'application/octet-stream'
+
+def file_info(path, st=None):
+    """(strong ETag, media type) for a file, cached per (path, mtime, size)"""
+    st = st or os.stat(path)
+    key = (str(path), st.st_mtime_ns, st.st_size)
+    with _file_info_lock:
+        info = _file_info.get(key)
+        if info is not None:
+            _file_info.move_to_end(key)
+    cache_lookup('file_info', info is not None)
+    if info is None:
+        # Blobs are named by their sha256, so only legacy paths are actually hashed here
+        info = (f'"{blobstore.file_digest(path)}"', detect_media_type(path))
+        with _file_info_lock:
+            _file_info[key] = info
+            while len(_file_info) > FILE_INFO_CACHE_SIZE:
+                _file_info.popitem(last=False)
+    return info
+
+def _not_modified(request, etag, last_modified) -> bool:
+    """RFC 9110 conditional GET: If-None-Match (weak comparison) takes precedence over If-Modified-Since"""
+    if_none_match = request.headers.get('if-none-match')
+    if if_none_match is not None:
+        if if_none_match.strip() == '*':
+            return True
+        return etag in (tag.strip().removeprefix('W/') for tag in if_none_match.split(','))
+    if_modified_since = request.headers.get('if-modified-since')
+    if if_modified_since:
+        try:
+            since = parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+        if since.tzinfo is None:
+            since = since.replace(tzinfo=timezone.utc)
+        return int(last_modified) <= since.timestamp()
+    return False
+
+def content_digest(path) -> str:
+    return file_info(path)[0].strip('"')
+
+def _cache_headers(etag, last_modified, immutable, vary):
+    headers = {
+        'ETag': etag,
+        'Last-Modified': formatdate(last_modified, usegmt=True),
+        'Cache-Control': IMMUTABLE_CACHE_CONTROL if immutable else REVALIDATE_CACHE_CONTROL,
+    }
+    if vary:
+        headers['Vary'] = vary
+    return headers
+
+def not_modified_response(request, etag: str, last_modified: float, immutable: bool = False, vary: str = None):
+    """A 304 response if the client's copy is current, else None; lets callers skip producing the file"""
+    if request.method in ('GET', 'HEAD') and _not_modified(request, etag, last_modified):
+        return Response(status_code=304, headers=_cache_headers(etag, last_modified, immutable, vary))
+    return None
+
+def _accel_uri(request, path):
+    """Internal nginx URI for path, or None if this request should be served directly"""
+    if FILE_DELIVERY != 'x-accel' or request.headers.get('x-sendfile-type', '').lower() != 'x-accel-redirect':
+        return None
+    try:
+        relative = Path(path).resolve().relative_to(STORAGE_ROOT)
+    except ValueError:
+        return None
+    return X_ACCEL_LOCATION + quote(relative.as_posix())
+
+def file_response(request, path, last_modified: float = None, immutable: bool = False,
+                  etag: str = None, media_type: str = None, vary: str = None) -> Response:
+    """Serve a stored file with ETag/Last-Modified validators, answering 304 when the client copy is current.
+
+    Range and If-Range requests are handled by FileResponse against the same validators,
+    or by nginx when the file is handed off with X-Accel-Redirect.
+    last_modified should be the version's created_at: blob mtimes are refreshed on deduplication.
+    """
+    st = os.stat(path)
+    if etag is None or media_type is None:
+        etag, media_type = file_info(path, st)
+    last_modified = last_modified or st.st_mtime
+    response = not_modified_response(request, etag, last_modified, immutable, vary)
+    if response is not None:
+        return response
+    headers = _cache_headers(etag, last_modified, immutable, vary)
+    accel_uri = _accel_uri(request, path)
+    if accel_uri is not None:
+        # nginx replaces the empty body with the file; the validators above are re-emitted by its internal location
+        headers['X-Accel-Redirect'] = accel_uri
+        return Response(status_code=200, headers=headers, media_type=media_type)
+    return FileResponse(path, media_type=media_type, headers=headers, stat_result=st)
@@ -0,0 +1,265 @@
+import os
+import sys
+import json
+import logging
+from pathlib import Path
+from typing import Dict, List
+import numpy as np
+from PIL import Image
+from metrics import stage_timer, queued
+from largeimage import drafted_copy
+
+logger = logging.getLogger('creative_tool')
+
+DETECTION_MODEL = os.getenv('DETECTION_MODEL', 'facebook/detr-resnet-50')
+DETECTION_BATCH_SIZE = int(os.getenv('DETECTION_BATCH_SIZE', '8'))
+# Every image is letterboxed onto a square canvas of this size so batches share one tensor shape
+DETECTION_INPUT_SIZE = int(os.getenv('DETECTION_INPUT_SIZE', '800'))
+DETECTION_THRESHOLD = float(os.getenv('DETECTION_THRESHOLD', '0.5'))
+
+# 'torch' serves the transformers pipeline, 'onnx' serves an exported graph through onnxruntime
+DETECTION_BACKEND = os.getenv('DETECTION_BACKEND', 'torch').lower()
+DETECTION_ONNX_PATH = os.getenv('DETECTION_ONNX_PATH')
+DETECTION_ONNX_QUANTIZE = os.getenv('DETECTION_ONNX_QUANTIZE', 'true').lower() == 'true'
+MODEL_CACHE_DIR = Path(os.getenv('MODEL_CACHE_DIR', Path(__file__).resolve().parent.parent / 'models'))
+ONNX_INTRA_OP_THREADS = int(os.getenv('ONNX_INTRA_OP_THREADS', str(os.cpu_count() or 1)))
+ONNX_INTER_OP_THREADS = int(os.getenv('ONNX_INTER_OP_THREADS', '1'))
+
+# ImageNet normalization used by the DETR image processor
+_PIXEL_MEAN = np.array([0.485, 0.456, 0.406], dtype=np.float32)
+_PIXEL_STD = np.array([0.229, 0.224, 0.225], dtype=np.float32)
+
+def load_detector(device, backend: str = None):
+    backend = backend or DETECTION_BACKEND
+    if backend == 'onnx':
+        model_path = onnx_model_path()
+        if not model_path.exists():
+            logger.info(f'Exporting {DETECTION_MODEL} to ONNX at {model_path}')
+            export_onnx(model_path, quantize=DETECTION_ONNX_QUANTIZE)
+        return OnnxDetector(model_path, device=device)
+    from transformers import pipeline
+    return pipeline("object-detection", model=DETECTION_MODEL, device=device)
+
+def onnx_model_path(quantize: bool = None) -> Path:
+    if DETECTION_ONNX_PATH:
+        return Path(DETECTION_ONNX_PATH)
+    quantize = DETECTION_ONNX_QUANTIZE if quantize is None else quantize
+    slug = DETECTION_MODEL.split('/')[-1]
+    return MODEL_CACHE_DIR / (f'{slug}.int8.onnx' if quantize else f'{slug}.onnx')
+
+def _labels_path(model_path) -> Path:
+    return Path(str(model_path) + '.labels.json')
+
+def export_onnx(output_path=None, quantize: bool = False) -> Path:
+    """Export the detector to ONNX, optionally followed by dynamic int8 weight quantization"""
+    import torch
+    from transformers import AutoModelForObjectDetection
+
+    output_path = Path(output_path or onnx_model_path(quantize))
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    fp32_path = output_path.with_name(output_path.name.replace('.int8', '') + '.fp32.tmp') if quantize else output_path
+
+    model = AutoModelForObjectDetection.from_pretrained(DETECTION_MODEL).eval()
+
+    class _ExportWrapper(torch.nn.Module):
+        def __init__(self, m):
+            super().__init__()
+            self.m = m
+
+        def forward(self, pixel_values):
+            out = self.m(pixel_values=pixel_values)
+            return out.logits, out.pred_boxes
+
+    dummy = torch.zeros(1, 3, DETECTION_INPUT_SIZE, DETECTION_INPUT_SIZE)
+    with torch.no_grad():
+        torch.onnx.export(
+            _ExportWrapper(model), (dummy,), str(fp32_path),
+            input_names=['pixel_values'], output_names=['logits', 'pred_boxes'],
+            dynamic_axes={'pixel_values': {0: 'batch'}, 'logits': {0: 'batch'}, 'pred_boxes': {0: 'batch'}},
+            opset_version=17
+        )
+
+    if quantize:
+        from onnxruntime.quantization import quantize_dynamic, QuantType
+        quantize_dynamic(str(fp32_path), str(output_path), weight_type=QuantType.QInt8)
+        fp32_path.unlink()
+
+    with open(_labels_path(output_path), 'w') as f:
+        json.dump({int(k): v for k, v in model.config.id2label.items()}, f)
+    return output_path
+
+class OnnxDetector:
+    """onnxruntime-backed stand-in for the transformers object-detection pipeline.
+
+    Accepts the same call shape as the pipeline (a list of PIL images plus
+    batch_size) and returns pipeline-style {'label', 'score', 'box'} dicts.
+    """
+
+    def __init__(self, model_path, device='cpu'):
+        import onnxruntime as ort
+        opts = ort.SessionOptions()
+        opts.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        opts.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+        opts.intra_op_num_threads = ONNX_INTRA_OP_THREADS
+        opts.inter_op_num_threads = ONNX_INTER_OP_THREADS
+        providers = ['CPUExecutionProvider']
+        if device == 'cuda':
+            providers.insert(0, 'CUDAExecutionProvider')
+        self.session = ort.InferenceSession(str(model_path), sess_options=opts, providers=providers)
+        with open(_labels_path(model_path)) as f:
+            self.id2label = {int(k): v for k, v in json.load(f).items()}
+
+    def __call__(self, images, batch_size=None, threshold=DETECTION_THRESHOLD):
+        single = isinstance(images, Image.Image)
+        images = [images] if single else list(images)
+        batch_size = batch_size or len(images) or 1
+        results = []
+        for start in range(0, len(images), batch_size):
+            chunk = images[start:start + batch_size]
+            pixel_values = np.stack([_to_pixel_values(img) for img in chunk])
+            logits, pred_boxes = self.session.run(None, {'pixel_values': pixel_values})
+            for img, img_logits, img_boxes in zip(chunk, logits, pred_boxes):
+                results.append(self._postprocess(img_logits, img_boxes, img.size, threshold))
+        return results[0] if single else results
+
+    def _postprocess(self, logits, boxes, size, threshold):
+        # Softmax over classes, dropping DETR's trailing "no object" class
+        exp = np.exp(logits - logits.max(axis=-1, keepdims=True))
+        probs = (exp / exp.sum(axis=-1, keepdims=True))[:, :-1]
+        scores = probs.max(axis=-1)
+        labels = probs.argmax(axis=-1)
+        width, height = size
+        detections = []
+        for score, label, (cx, cy, w, h) in zip(scores, labels, boxes):
+            if score <= threshold:
+                continue
+            detections.append({
+                'score': float(score),
+                'label': self.id2label.get(int(label), str(label)),
+                'box': {
+                    'xmin': int((cx - w / 2) * width),
+                    'ymin': int((cy - h / 2) * height),
+                    'xmax': int((cx + w / 2) * width),
+                    'ymax': int((cy + h / 2) * height)
+                }
+            })
+        return detections
+
+def _to_pixel_values(image: Image.Image) -> np.ndarray:
+    arr = np.asarray(image.convert('RGB'), dtype=np.float32) / 255.0
+    return ((arr - _PIXEL_MEAN) / _PIXEL_STD).transpose(2, 0, 1)
+
+def letterbox(image: Image.Image, size: int = DETECTION_INPUT_SIZE):
+    """Fit the image inside a size x size canvas (top-left aligned) and return it with the scale used.
+
+    The scale is relative to image.size. A JPEG not yet decoded is read reduced through a
+    separate handle, so the caller's image keeps its size and can be passed again.
+    """
+    width, height = image.size
+    scale = size / max(width, height)
+    new_size = (max(1, round(width * scale)), max(1, round(height * scale)))
+    source = drafted_copy(image, scale)
+    try:
+        img = source.convert('RGB')
+    finally:
+        if source is not image:
+            source.close()
+    canvas = Image.new('RGB', (size, size), (0, 0, 0))
+    canvas.paste(img.resize(new_size, Image.BILINEAR), (0, 0))
+    return canvas, scale
+
+def _rescale(detection: Dict, scale: float, width: int, height: int) -> Dict:
+    box = detection.get('box') or {}
+    return {
+        'label': detection['label'],
+        'score': float(detection['score']),
+        'box': {
+            'xmin': max(0, min(width, int(box.get('xmin', 0) / scale))),
+            'ymin': max(0, min(height, int(box.get('ymin', 0) / scale))),
+            'xmax': max(0, min(width, int(box.get('xmax', 0) / scale))),
+            'ymax': max(0, min(height, int(box.get('ymax', 0) / scale)))
+        }
+    }
+
+def detect_batch(detector, images: List[Image.Image], batch_size: int = None) -> List[List[Dict]]:
+    """Run the detector over images in fixed-size batches.
+
+    Returns one list of detections per input image, in input order, with boxes
+    mapped back to the original image coordinates.
+    """
+    batch_size = max(1, batch_size or DETECTION_BATCH_SIZE)
+    results = []
+    for start in range(0, len(images), batch_size):
+        chunk = images[start:start + batch_size]
+        sizes = [img.size for img in chunk]
+        prepared = [letterbox(img) for img in chunk]
+        with queued('detection'), stage_timer('model.detection'):
+            outputs = detector([canvas for canvas, _ in prepared], batch_size=len(chunk))
+        for (width, height), (_, scale), detections in zip(sizes, prepared, outputs):
+            results.append([
+                _rescale(d, scale, width, height)
+                for d in detections if d['score'] > DETECTION_THRESHOLD
+            ])
+    return results
+
+def summarize_detections(detections: List[Dict]):
+    """Split detections into the detected_objects / detected_people shape used by analyze_image"""
+    detected_objects = [{'label': d['label'], 'confidence': d['score']} for d in detections]
+    detected_people = [{'confidence': d['score']} for d in detections if d['label'] == 'person']
+    return detected_objects, detected_people
+
+def _iou(a: Dict, b: Dict) -> float:
+    ix = max(0, min(a['xmax'], b['xmax']) - max(a['xmin'], b['xmin']))
+    iy = max(0, min(a['ymax'], b['ymax']) - max(a['ymin'], b['ymin']))
+    inter = ix * iy
+    area_a = (a['xmax'] - a['xmin']) * (a['ymax'] - a['ymin'])
+    area_b = (b['xmax'] - b['xmin']) * (b['ymax'] - b['ymin'])
+    union = area_a + area_b - inter
+    return inter / union if union > 0 else 0.0
+
+def check_parity(fixture_dir, min_recall: float = 0.9, min_iou: float = 0.5) -> bool:
+    """Compare ONNX detections against the torch pipeline on a fixture set.
+
+    A reference detection is matched when the ONNX output has the same label
+    with IoU >= min_iou. Passes when overall recall reaches min_recall.
+    """
+    paths = sorted(p for p in Path(fixture_dir).iterdir() if p.suffix.lower() in {'.png', '.jpg', '.jpeg', '.webp'})
+    reference = load_detector('cpu', backend='torch')
+    candidate = load_detector('cpu', backend='onnx')
+    matched = total = extra = 0
+    max_score_delta = 0.0
+    for p in paths:
+        with Image.open(p) as img:
+            ref = detect_batch(reference, [img], batch_size=1)[0]
+            out = detect_batch(candidate, [img], batch_size=1)[0]
+        unused = list(out)
+        for r in ref:
+            total += 1
+            best = max((o for o in unused if o['label'] == r['label']),
+                       key=lambda o: _iou(r['box'], o['box']), default=None)
+            if best is not None and _iou(r['box'], best['box']) >= min_iou:
+                matched += 1
+                max_score_delta = max(max_score_delta, abs(r['score'] - best['score']))
+                unused.remove(best)
+        extra += len(unused)
+        print(f'{p.name}: torch={len(ref)} onnx={len(out)}')
+    recall = matched / total if total else 1.0
+    print(f'recall={recall:.3f} unmatched_onnx={extra} max_score_delta={max_score_delta:.3f}')
+    return recall >= min_recall
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Object detector ONNX export and parity check')
+    sub = parser.add_subparsers(dest='command', required=True)
+    p = sub.add_parser('export', help='Export the detector to ONNX')
+    p.add_argument('--output')
+    p.add_argument('--quantize', action='store_true', help='Apply dynamic int8 quantization')
+    p = sub.add_parser('parity', help='Check ONNX detections against the torch pipeline')
+    p.add_argument('fixture_dir')
+    p.add_argument('--min-recall', type=float, default=0.9)
+    args = parser.parse_args()
+
+    if args.command == 'export':
+        print(export_onnx(args.output, quantize=args.quantize))
+    else:
+        sys.exit(0 if check_parity(args.fixture_dir, min_recall=args.min_recall) else 1)
@@ -0,0 +1,68 @@
+import os
+
+# Output policy for images produced by utils operations.
+# OUTPUT_CODEC: png (lossless, tunable compress_level), webp (lossless) or
+# jpeg (high quality, opaque images only; transparent ones use OUTPUT_ALPHA_CODEC).
+OUTPUT_CODEC = os.getenv('OUTPUT_CODEC', 'png').lower()
+OUTPUT_ALPHA_CODEC = os.getenv('OUTPUT_ALPHA_CODEC', 'png').lower()
+# zlib level 0-9; 1-3 encode several times faster than 6 for a few percent more bytes
+OUTPUT_PNG_COMPRESS_LEVEL = int(os.getenv('OUTPUT_PNG_COMPRESS_LEVEL', '6'))
+# Lossless WebP effort 0-6
+OUTPUT_WEBP_METHOD = int(os.getenv('OUTPUT_WEBP_METHOD', '4'))
+OUTPUT_JPEG_QUALITY = int(os.getenv('OUTPUT_JPEG_QUALITY', '92'))
+
+CODECS = {'png': ('PNG', '.png'), 'webp': ('WEBP', '.webp'), 'jpeg': ('JPEG', '.jpg')}
+_MODES = {
+    'PNG': ('1', 'L', 'LA', 'P', 'RGB', 'RGBA', 'I', 'I;16'),
+    'WEBP': ('RGB', 'RGBA'),
+    'JPEG': ('L', 'RGB'),
+}
+
+for _codec in (OUTPUT_CODEC, OUTPUT_ALPHA_CODEC):
+    if _codec not in CODECS:
+        raise ValueError(f'Unknown output codec: {_codec}. Choose from {", ".join(CODECS)}')
+if OUTPUT_ALPHA_CODEC == 'jpeg':
+    raise ValueError('OUTPUT_ALPHA_CODEC must support transparency (png or webp)')
+
+def has_transparency(img) -> bool:
+    """True if any pixel is less than fully opaque"""
+    if img.mode in ('RGBA', 'LA', 'PA'):
+        return img.getchannel('A').getextrema()[0] < 255
+    return img.mode == 'P' and 'transparency' in img.info
+
+def save_params(codec: str, compress_level: int = None) -> dict:
+    if codec == 'png':
+        return {'compress_level': OUTPUT_PNG_COMPRESS_LEVEL if compress_level is None else compress_level}
+    if codec == 'webp':
+        return {'lossless': True, 'method': OUTPUT_WEBP_METHOD}
+    # 4:4:4 chroma keeps text and product edges sharp
+    return {'quality': OUTPUT_JPEG_QUALITY, 'subsampling': 0, 'optimize': True}
+
+def _fit_mode(img, pil_format, transparent):
+    if img.mode in _MODES[pil_format]:
+        return img
+    if transparent and pil_format != 'JPEG':
+        return img.convert('RGBA')
+    return img.convert('RGB')
+
+def prepare_output(img, intermediate: bool = False):
+    """Image converted for its codec, with (PIL format, suffix, save params).
+
+    Intermediates that the next pipeline step re-reads immediately are stored as
+    uncompressed PNG: a transform costs less than compressing its result.
+    """
+    if intermediate:
+        return _fit_mode(img, 'PNG', True), 'PNG', '.png', {'compress_level': 0}
+
+    transparent = has_transparency(img)
+    if not transparent and img.mode in ('RGBA', 'LA', 'PA'):
+        # An all-opaque alpha channel only adds bytes
+        img = img.convert('RGB' if img.mode != 'LA' else 'L')
+    codec = OUTPUT_CODEC
+    if transparent and codec == 'jpeg':
+        codec = OUTPUT_ALPHA_CODEC
+    pil_format, suffix = CODECS[codec]
+    params = save_params(codec)
+    if img.info.get('icc_profile'):
+        params['icc_profile'] = img.info['icc_profile']
+    return _fit_mode(img, pil_format, transparent), pil_format, suffix, params
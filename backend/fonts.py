@@ -0,0 +1,175 @@
+import os
+import math
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+from pathlib import Path
+from PIL import Image, ImageDraw, ImageFont
+from metrics import cache_lookup, register_cache
+
+# Brand fonts are the .ttf/.otf/.ttc files in FONT_DIR, registered under their file
+# stem (fonts/Brand-Bold.ttf is the face "Brand-Bold") and loaded once per (face, size).
+FONT_DIR = Path(os.getenv('FONT_DIR', Path(__file__).resolve().parent / 'fonts'))
+# Face used when a request names none; defaults to the first registered face
+DEFAULT_FONT = os.getenv('DEFAULT_FONT', '')
+# Used when FONT_DIR is empty: looked up on the system font path, then Pillow's bundled scalable font
+FALLBACK_FONT = os.getenv('FALLBACK_FONT', 'DejaVuSans.ttf')
+FONT_CACHE_SIZE = int(os.getenv('FONT_CACHE_SIZE', '128'))
+MAX_FONT_SIZE = int(os.getenv('MAX_FONT_SIZE', '512'))
+# Largest text mask rendered (1 byte per pixel); bigger layouts are refused before rendering
+TEXT_LAYER_MAX_PIXELS = int(os.getenv('TEXT_LAYER_MAX_PIXELS', str(16 * 1024 * 1024)))
+# Rendered masks kept for reuse, bounded by their total bytes; masks over a quarter of it are not kept
+TEXT_LAYER_CACHE_BYTES = int(os.getenv('TEXT_LAYER_CACHE_BYTES', str(64 * 1024 * 1024)))
+
+FONT_SUFFIXES = {'.ttf', '.otf', '.ttc'}
+ALIGNS = ('left', 'center', 'right')
+# Pillow multiline anchors: horizontal l/m/r, vertical a(scender)/m(iddle)/s (first baseline)/d(escender)
+H_ANCHORS = 'lmr'
+V_ANCHORS = 'amsd'
+
+_registry = None
+_registry_lock = threading.Lock()
+_layers = OrderedDict()  # layout key -> (mask, offset, lines), least recently used first
+_layers_bytes = 0
+_layers_lock = threading.Lock()
+
+def registry() -> dict:
+    """Face name -> font file, scanned from FONT_DIR on first use"""
+    global _registry
+    if _registry is None:
+        with _registry_lock:
+            if _registry is None:
+                found = {}
+                if FONT_DIR.is_dir():
+                    for p in sorted(FONT_DIR.iterdir()):
+                        if p.suffix.lower() in FONT_SUFFIXES:
+                            found[p.stem] = str(p)
+                _registry = found
+    return _registry
+
+def faces() -> list:
+    return list(registry())
+
+def default_face():
+    """DEFAULT_FONT if registered, else the first registered face, else None (the fallback font)"""
+    registered = registry()
+    if DEFAULT_FONT in registered:
+        return DEFAULT_FONT
+    return next(iter(registered), None)
+
+def resolve_face(face=None):
+    if not face:
+        return default_face()
+    if face not in registry():
+        raise ValueError(f'Unknown font: {face}. Available: {", ".join(registry()) or "none"}')
+    return face
+
+@lru_cache(maxsize=FONT_CACHE_SIZE)
+def _load(face, size: int):
+    """FreeType font for a resolved face (None for the fallback) at a pixel size, shared per (face, size)"""
+    if face is not None:
+        return ImageFont.truetype(registry()[face], size)
+    try:
+        return ImageFont.truetype(FALLBACK_FONT, size)
+    except OSError:
+        return ImageFont.load_default(size)
+
+def _check_size(size):
+    if not 1 <= size <= MAX_FONT_SIZE:
+        raise ValueError(f'font_size must be between 1 and {MAX_FONT_SIZE}')
+
+def wrap(text: str, font, max_width=None) -> list:
+    """Lines of text greedily word-wrapped to max_width pixels; explicit newlines are kept.
+
+    Words wider than max_width on their own are broken between characters.
+    """
+    lines = []
+    for paragraph in text.split('\n'):
+        if not max_width:
+            lines.append(paragraph)
+            continue
+        line = ''
+        for word in paragraph.split():
+            candidate = f'{line} {word}' if line else word
+            if line and font.getlength(candidate) > max_width:
+                lines.append(line)
+                line = word
+            else:
+                line = candidate
+            while len(line) > 1 and font.getlength(line) > max_width:
+                cut = len(line) - 1
+                while cut > 1 and font.getlength(line[:cut]) > max_width:
+                    cut -= 1
+                lines.append(line[:cut])
+                line = line[cut:]
+        lines.append(line)
+    return lines
+
+def _check_layout(align, anchor):
+    if align not in ALIGNS:
+        raise ValueError(f'Unknown text align: {align}. Choose from {", ".join(ALIGNS)}')
+    if len(anchor) != 2 or anchor[0] not in H_ANCHORS or anchor[1] not in V_ANCHORS:
+        raise ValueError(f'Unknown text anchor: {anchor}. Use one of {H_ANCHORS} followed by one of {V_ANCHORS}')
+
+def _render_layer(text, face, size, max_width, align, spacing, anchor):
+    font = _load(face, size)
+    lines = wrap(text, font, max_width)
+    wrapped = '\n'.join(lines)
+    options = {'font': font, 'spacing': spacing, 'align': align, 'anchor': anchor}
+    left, top, right, bottom = ImageDraw.Draw(Image.new('L', (1, 1))).multiline_textbbox((0, 0), wrapped, **options)
+    left, top = math.floor(left), math.floor(top)
+    size = (max(1, math.ceil(right) - left), max(1, math.ceil(bottom) - top))
+    if size[0] * size[1] > TEXT_LAYER_MAX_PIXELS:
+        raise ValueError(f'Text layout of {size[0]}x{size[1]} pixels exceeds the {TEXT_LAYER_MAX_PIXELS} pixel limit; '
+                         f'use a smaller font_size or a max width')
+    mask = Image.new('L', size)
+    ImageDraw.Draw(mask).multiline_text((-left, -top), wrapped, fill=255, **options)
+    return mask, (left, top), tuple(lines)
+
+def _layer(*key):
+    global _layers_bytes
+    with _layers_lock:
+        layer = _layers.get(key)
+        if layer is not None:
+            _layers.move_to_end(key)
+    cache_lookup('text_layer', layer is not None)
+    if layer is not None:
+        return layer
+    layer = _render_layer(*key)
+    nbytes = layer[0].width * layer[0].height
+    if nbytes <= TEXT_LAYER_CACHE_BYTES // 4:
+        with _layers_lock:
+            if key not in _layers:
+                _layers[key] = layer
+                _layers_bytes += nbytes
+            while _layers_bytes > TEXT_LAYER_CACHE_BYTES:
+                _, (mask, _, _) = _layers.popitem(last=False)
+                _layers_bytes -= mask.width * mask.height
+    return layer
+
+def text_layer(text: str, face=None, size: int = 20, max_width=None, align: str = 'left',
+               spacing: int = 4, anchor: str = 'la'):
+    """Coverage mask of wrapped text, its (left, top) offset from the anchor point, and its lines.
+
+    Cached per (text, face, size, layout); the mask is shared and must not be modified.
+    Raises ValueError for sizes over MAX_FONT_SIZE and masks over TEXT_LAYER_MAX_PIXELS.
+    """
+    _check_layout(align, anchor)
+    _check_size(size)
+    if max_width is not None and max_width < 0:
+        raise ValueError('max_width must not be negative')
+    face = resolve_face(face)
+    return _layer(text, face, int(size), int(max_width) if max_width else None, align, int(spacing), anchor)
+
+def measure_text(text: str, face=None, size: int = 20, max_width=None, align: str = 'left',
+                 spacing: int = 4, anchor: str = 'la') -> dict:
+    """Wrapped lines and the box (left, top, right, bottom) they cover, relative to the anchor point"""
+    mask, (left, top), lines = text_layer(text, face, size, max_width, align, spacing, anchor)
+    return {'lines': list(lines), 'box': (left, top, left + mask.width, top + mask.height)}
+
+def _cache_stats(fn):
+    info = fn.cache_info()
+    return info.hits, info.misses, info.currsize
+
+register_cache('font', lambda: _cache_stats(_load))
+register_cache('text_layer', lambda: (None, None, len(_layers)))
@@ -1,10 +1,12 @@
+import os
 import re
 from typing import Dict, List, Optional
 import cv2
-import pytesseract
 import numpy as np
-from PIL import Image
 import colorsys
+import ocr
+from metrics import stage_timer, timed
+from largeimage import imread_reduced, iter_strips, strip_rows
 
 # Enhanced forbidden terms with categories
 FORBIDDEN_COPY_TERMS = {
@@ -52,6 +54,9 @@ BRAND_COLORS = {
     'tesco_white': (255, 255, 255)
 }
 
+# Word boxes below this OCR confidence are ignored for font-size estimation
+MIN_WORD_CONFIDENCE = 60
+
 def _contains_forbidden(text: str) -> Dict[str, List[str]]:
     """Check for forbidden terms and return categories found"""
     if not text:
@@ -79,10 +84,15 @@ def _check_brand_colors(image: np.ndarray) -> List[Dict]:
     try:
         # Convert to RGB if needed
         if image.shape[2] == 3:
-            # Get dominant colors (simple approach)
-            pixels = image.reshape(-1, 3)
-            unique_colors, counts = np.unique(pixels, axis=0, return_counts=True)
-            dominant_colors = unique_colors[np.argsort(counts)[-5:]]  # Top 5 colors
+            # Dominant colors from a 32-level-per-channel histogram built strip by strip;
+            # np.unique over every pixel needs several full-size copies and a sort
+            counts = np.zeros(1 << 15, dtype=np.int64)
+            for top, bottom in iter_strips(image.shape[0], strip_rows(image.shape[1], 'RGB')):
+                q = image[top:bottom] >> 3
+                packed = (q[..., 0].astype(np.int32) << 10) | (q[..., 1].astype(np.int32) << 5) | q[..., 2]
+                counts += np.bincount(packed.ravel(), minlength=1 << 15)
+            top_bins = [b for b in np.argsort(counts)[-5:] if counts[b]]  # Top 5 colors
+            dominant_colors = [np.array([(b >> 10) & 31, (b >> 5) & 31, b & 31]) * 8 + 4 for b in top_bins]
 
             brand_found = False
             for color in dominant_colors:
@@ -112,11 +122,17 @@ def _check_contrast_and_readability(image: np.ndarray) -> List[Dict]:
     """Check text contrast and readability"""
     issues = []
     try:
-        # Convert to grayscale
-        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        # Grayscale mean and standard deviation accumulated over strips
+        total = total_sq = 0.0
+        for top, bottom in iter_strips(image.shape[0], strip_rows(image.shape[1], 'RGB')):
+            gray = cv2.cvtColor(image[top:bottom], cv2.COLOR_BGR2GRAY).astype(np.float64)
+            total += gray.sum()
+            total_sq += np.square(gray).sum()
+        pixels = image.shape[0] * image.shape[1]
+        brightness = total / pixels
 
         # Calculate contrast
-        contrast = gray.std()
+        contrast = np.sqrt(max(0.0, total_sq / pixels - brightness ** 2))
 
         if contrast < 30:
             issues.append({
@@ -125,7 +141,6 @@ def _check_contrast_and_readability(image: np.ndarray) -> List[Dict]:
             })
 
         # Check for high brightness (washed out)
-        brightness = np.mean(gray)
         if brightness > 200:
             issues.append({
                 'type': 'warning',
@@ -140,6 +155,7 @@ def _check_contrast_and_readability(image: np.ndarray) -> List[Dict]:
 
     return issues
 
+@timed('guidelines.creative_rules')
 def validate_creative_rules(payload: Dict, platform: str = 'general') -> List[Dict]:
     issues = []
     tags = payload.get('tags', '') or ''
@@ -224,10 +240,14 @@ def validate_creative_rules(payload: Dict, platform: str = 'general') -> List[Di
 
     return issues
 
+@timed('guidelines.validate_image')
 def validate_image_guidelines(image_path: str, platform: str = 'general') -> List[Dict]:
     issues = []
     try:
-        img = cv2.imread(image_path)
+        # Colour and contrast statistics only need a reduced decode; dimensions are the full ones.
+        # Refuses decompression bombs and images over the memory budget before decoding
+        with stage_timer('guidelines.decode'):
+            img, (width, height) = imread_reduced(image_path)
         if img is None:
             issues.append({
                 'type': 'hard_fail',
@@ -236,9 +256,14 @@ def validate_image_guidelines(image_path: str, platform: str = 'general') -> Lis
             })
             return issues
 
-        height, width = img.shape[:2]
         aspect_ratio = height / width
 
+        # One OCR pass shared by the safe-zone, font-size and forbidden-term checks
+        with stage_timer('guidelines.ocr'):
+            ocr_result = ocr.ocr_file(image_path)
+        text = ocr_result['text']
+        words = ocr_result['words']
+
         # Platform-specific aspect ratio check
         if platform in PLATFORM_REQUIREMENTS:
             req = PLATFORM_REQUIREMENTS[platform]
@@ -252,39 +277,17 @@ def validate_image_guidelines(image_path: str, platform: str = 'general') -> Lis
                     'category': 'format'
                 })
 
-            # Safe zone checks
+            # Safe zone checks: flag recognised words whose boxes fall inside a margin
             safe_zones = req['safe_zones']
-            if 'all' in safe_zones:
-                margin = safe_zones['all']
-                zones_to_check = [
-                    ('top', img[:margin, :]),
-                    ('bottom', img[height-margin:, :]),
-                    ('left', img[:, :margin]),
-                    ('right', img[:, width-margin:])
-                ]
-            else:
-                zones_to_check = []
-                if 'top' in safe_zones:
-                    zones_to_check.append(('top', img[:safe_zones['top'], :]))
-                if 'bottom' in safe_zones:
-                    zones_to_check.append(('bottom', img[height-safe_zones['bottom']:, :]))
-                if 'sides' in safe_zones:
-                    zones_to_check.extend([
-                        ('left', img[:, :safe_zones['sides']]),
-                        ('right', img[:, width-safe_zones['sides']:])
-                    ])
-
-            for zone_name, zone in zones_to_check:
-                if _has_content_in_zone(zone):
-                    issues.append({
-                        'type': 'warning',
-                        'msg': f'{zone_name.title()} safe zone ({safe_zones.get(zone_name, safe_zones.get("all", 0))}px) may contain text/logos.',
-                        'category': 'layout'
-                    })
-
-        # OCR for text detection and analysis
-        pil_img = Image.open(image_path)
-        text = pytesseract.image_to_string(pil_img)
+            with stage_timer('guidelines.safe_zones'):
+                for zone_name, margin, box in _safe_zone_boxes(safe_zones, width, height):
+                    zone_words = [w['text'] for w in words if _box_overlaps(w, box)]
+                    if zone_words:
+                        issues.append({
+                            'type': 'warning',
+                            'msg': f'{zone_name.title()} safe zone ({margin}px) contains text: "{" ".join(zone_words)[:60]}"',
+                            'category': 'layout'
+                        })
 
         if text.strip():
             issues.append({
@@ -293,12 +296,11 @@ def validate_image_guidelines(image_path: str, platform: str = 'general') -> Lis
                 'category': 'content'
             })
 
-            # Check font size (rough estimate)
-            # This is a simplified check - in production, you'd use more sophisticated OCR
-            text_lines = text.strip().split('\n')
-            if len(text_lines) > 0:
-                avg_line_length = sum(len(line) for line in text_lines) / len(text_lines)
-                estimated_font_size = min(50, max(12, int(100 / avg_line_length)))  # Rough estimation
+            # Font size from the median height of confidently recognised word boxes
+            with stage_timer('guidelines.font_size'):
+                heights = sorted(w['height'] for w in words if w['conf'] >= MIN_WORD_CONFIDENCE)
+            if heights:
+                estimated_font_size = heights[len(heights) // 2]
 
                 min_font = PLATFORM_REQUIREMENTS.get(platform, {}).get('min_font_size', 20)
                 if estimated_font_size < min_font:
@@ -309,21 +311,25 @@ def validate_image_guidelines(image_path: str, platform: str = 'general') -> Lis
                     })
 
             # Check for forbidden terms in image text
-            forbidden = _contains_forbidden(text)
+            with stage_timer('guidelines.forbidden_terms'):
+                forbidden = _contains_forbidden(text)
             if forbidden:
                 for category, terms in forbidden.items():
                     issues.append({
                         'type': 'hard_fail',
                         'msg': f'Forbidden {category.replace("_", " ")} terms in image text: {", ".join(terms)}',
-                        'category': 'compliance'
+                        'category': 'compliance',
+                        'locations': _locate_terms(words, terms)
                     })
 
         # Color and contrast analysis
-        issues.extend(_check_brand_colors(img))
-        issues.extend(_check_contrast_and_readability(img))
+        with stage_timer('guidelines.brand_colors'):
+            issues.extend(_check_brand_colors(img))
+        with stage_timer('guidelines.contrast'):
+            issues.extend(_check_contrast_and_readability(img))
 
         # Image quality checks
-        file_size_kb = len(open(image_path, 'rb').read()) / 1024
+        file_size_kb = os.path.getsize(image_path) / 1024
         if file_size_kb > 500:
             issues.append({
                 'type': 'warning',
@@ -349,11 +355,56 @@ def validate_image_guidelines(image_path: str, platform: str = 'general') -> Lis
 
     return issues
 
-def _has_content_in_zone(zone: np.ndarray, threshold: int = 1000) -> bool:
-    """Check if a zone contains significant content (text/logos)"""
-    try:
-        gray = cv2.cvtColor(zone, cv2.COLOR_BGR2GRAY)
-        _, thresh = cv2.threshold(gray, 240, 255, cv2.THRESH_BINARY_INV)
-        return np.sum(thresh) > threshold
-    except:
-        return False
+def _safe_zone_boxes(safe_zones: Dict, width: int, height: int) -> List[tuple]:
+    """Return (zone_name, margin, (x0, y0, x1, y1)) for each configured safe zone"""
+    if 'all' in safe_zones:
+        m = safe_zones['all']
+        return [
+            ('top', m, (0, 0, width, m)),
+            ('bottom', m, (0, height - m, width, height)),
+            ('left', m, (0, 0, m, height)),
+            ('right', m, (width - m, 0, width, height))
+        ]
+    zones = []
+    if 'top' in safe_zones:
+        zones.append(('top', safe_zones['top'], (0, 0, width, safe_zones['top'])))
+    if 'bottom' in safe_zones:
+        zones.append(('bottom', safe_zones['bottom'], (0, height - safe_zones['bottom'], width, height)))
+    if 'sides' in safe_zones:
+        m = safe_zones['sides']
+        zones.extend([
+            ('left', m, (0, 0, m, height)),
+            ('right', m, (width - m, 0, width, height))
+        ])
+    return zones
+
+def _box_overlaps(word: Dict, box: tuple) -> bool:
+    x0, y0, x1, y1 = box
+    return (word['left'] < x1 and word['left'] + word['width'] > x0 and
+            word['top'] < y1 and word['top'] + word['height'] > y0)
+
+def _bare_token(text: str) -> str:
+    """OCR word lowercased without surrounding punctuation ('Organic!' -> 'organic')"""
+    return re.sub(r'^\W+|\W+$', '', text.lower())
+
+def _locate_terms(words: List[Dict], terms: List[str]) -> List[Dict]:
+    """Find bounding boxes of (possibly multi-word) terms among OCR word boxes"""
+    locations = []
+    for term in terms:
+        tokens = term.lower().split()
+        for i in range(len(words) - len(tokens) + 1):
+            run = words[i:i + len(tokens)]
+            if any(w['line'] != run[0]['line'] for w in run):
+                continue
+            # Whole tokens only, so 'natural' does not match inside 'supernatural'
+            if all(tok == _bare_token(w['text']) for tok, w in zip(tokens, run)):
+                left = min(w['left'] for w in run)
+                top = min(w['top'] for w in run)
+                locations.append({
+                    'term': term,
+                    'left': left,
+                    'top': top,
+                    'width': max(w['left'] + w['width'] for w in run) - left,
+                    'height': max(w['top'] + w['height'] for w in run) - top
+                })
+    return locations
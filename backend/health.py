@@ -0,0 +1,77 @@
+import os
+import time
+import logging
+import threading
+from collections import deque
+from pathlib import Path
+import psutil
+from db import get_storage_totals
+
+logger = logging.getLogger('creative_tool')
+
+BASE = Path(os.getenv('BASE_DIR', Path(__file__).resolve().parent.parent / "storage"))
+HEALTH_SAMPLE_INTERVAL = float(os.getenv('HEALTH_SAMPLE_INTERVAL', '10'))
+# Samples kept in memory; at the default interval this is ten minutes of history
+HEALTH_HISTORY_SIZE = int(os.getenv('HEALTH_HISTORY_SIZE', '60'))
+
+_samples = deque(maxlen=HEALTH_HISTORY_SIZE)
+_samples_lock = threading.Lock()
+_stop = threading.Event()
+_thread = None
+
+def take_sample(db_path, model_state=None) -> dict:
+    """One snapshot of host and storage state; never blocks on CPU measurement"""
+    totals = get_storage_totals(db_path)
+    disk_root = BASE if BASE.exists() else Path('/')
+    sample = {
+        'timestamp': time.time(),
+        # interval=None compares against the previous call instead of sleeping
+        'cpu_percent': psutil.cpu_percent(interval=None),
+        'memory_percent': psutil.virtual_memory().percent,
+        'disk_usage': psutil.disk_usage(str(disk_root)).percent,
+        'uptime_seconds': time.time() - psutil.boot_time(),
+        'process_rss_mb': psutil.Process().memory_info().rss / (1024 * 1024),
+        'total_assets': totals['total_assets'],
+        'total_versions': totals['total_versions'],
+        'blob_count': totals['blob_count'],
+        'storage_used_mb': totals['storage_bytes'] / (1024 * 1024),
+        'models': model_state() if model_state else {}
+    }
+    with _samples_lock:
+        _samples.append(sample)
+    return sample
+
+def _loop(db_path, model_state):
+    psutil.cpu_percent(interval=None)  # prime the CPU counter
+    while not _stop.is_set():
+        try:
+            take_sample(db_path, model_state)
+        except Exception as e:
+            logger.warning(f'Health sample failed: {e}')
+        _stop.wait(HEALTH_SAMPLE_INTERVAL)
+
+def start_sampler(db_path, model_state=None):
+    """Refresh samples every HEALTH_SAMPLE_INTERVAL seconds in a daemon thread"""
+    global _thread
+    if _thread and _thread.is_alive():
+        return
+    _stop.clear()
+    _thread = threading.Thread(target=_loop, args=(db_path, model_state), name='health-sampler', daemon=True)
+    _thread.start()
+
+def stop_sampler():
+    _stop.set()
+
+def latest_sample() -> dict:
+    with _samples_lock:
+        return dict(_samples[-1]) if _samples else None
+
+def sample_history(seconds: float) -> list:
+    """Samples from the last `seconds`, oldest first"""
+    cutoff = time.time() - seconds
+    with _samples_lock:
+        return [dict(s) for s in _samples if s['timestamp'] >= cutoff]
+
+def sample_age() -> float:
+    sample = latest_sample()
+    return time.time() - sample['timestamp'] if sample else None
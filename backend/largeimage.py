@@ -0,0 +1,187 @@
+import os
+import math
+import warnings
+import cv2
+from PIL import ExifTags, Image, ImageEnhance, ImageStat
+
+# Images above MAX_IMAGE_PIXELS are refused from their header, before any decoding.
+MAX_IMAGE_PIXELS = int(os.getenv('MAX_IMAGE_PIXELS', str(200_000_000)))
+# Decoded pixel memory one operation may hold (source, output and working copies)
+IMAGE_MEMORY_BUDGET = int(os.getenv('IMAGE_MEMORY_BUDGET', str(1024 * 1024 * 1024)))
+# Above this many pixels filters and analysis work on horizontal strips instead of whole-image copies
+LARGE_IMAGE_PIXELS = int(os.getenv('LARGE_IMAGE_PIXELS', str(24_000_000)))
+IMAGE_STRIP_BYTES = int(os.getenv('IMAGE_STRIP_BYTES', str(32 * 1024 * 1024)))
+# Downscales decode JPEGs at 1/2, 1/4 or 1/8 scale (DCT scaling) and box-reduce other formats,
+# keeping at least this multiple of the output size for the final resample; 0 disables
+REDUCED_DECODE_HEADROOM = float(os.getenv('REDUCED_DECODE_HEADROOM', '2'))
+# Analysis and guideline pixel statistics use a reduced decode whose longer side stays at least this
+ANALYSIS_MAX_SIDE = int(os.getenv('ANALYSIS_MAX_SIDE', '2048'))
+
+# Pillow only warns past MAX_IMAGE_PIXELS and errors at twice that; refuse at the limit itself
+Image.MAX_IMAGE_PIXELS = MAX_IMAGE_PIXELS
+warnings.simplefilter('error', Image.DecompressionBombWarning)
+
+class ImageTooLarge(ValueError):
+    """Image exceeds MAX_IMAGE_PIXELS or would not fit IMAGE_MEMORY_BUDGET"""
+
+def pixel_bytes(size, mode) -> int:
+    """Bytes Pillow holds for a decoded image; multi-band modes are stored 4 bytes per pixel"""
+    width, height = size
+    if mode in ('1', 'L', 'P'):
+        per_pixel = 1
+    elif mode.startswith('I;16'):
+        per_pixel = 2
+    else:
+        per_pixel = 4
+    return width * height * per_pixel
+
+def check_image(path):
+    """(size, mode) read from the header only; raises ImageTooLarge for decompression bombs"""
+    try:
+        with Image.open(path) as img:
+            size, mode = img.size, img.mode
+    except (Image.DecompressionBombError, Image.DecompressionBombWarning) as e:
+        raise ImageTooLarge(str(e))
+    if size[0] * size[1] > MAX_IMAGE_PIXELS:
+        raise ImageTooLarge(f'{size[0]}x{size[1]} image exceeds the {MAX_IMAGE_PIXELS} pixel limit')
+    return size, mode
+
+def check_budget(*buffers):
+    """Raise ImageTooLarge unless decoded buffers given as (size, mode) fit IMAGE_MEMORY_BUDGET together"""
+    needed = sum(pixel_bytes(size, mode) for size, mode in buffers)
+    if needed > IMAGE_MEMORY_BUDGET:
+        width, height = buffers[0][0]
+        raise ImageTooLarge(f'{width}x{height} image needs ~{needed >> 20}MB for this operation; '
+                            f'the limit is {IMAGE_MEMORY_BUDGET >> 20}MB')
+
+def open_image(path, copies: int = 1):
+    """Open an image once its header passes the bomb check and `copies` decoded copies fit the budget"""
+    size, mode = check_image(path)
+    check_budget(*[(size, mode)] * copies)
+    return Image.open(path)
+
+def oriented_size(path):
+    """(width, height) once EXIF orientation is applied, read from the header only"""
+    with Image.open(path) as img:
+        width, height = img.size
+        if img.getexif().get(ExifTags.Base.Orientation, 1) in (5, 6, 7, 8):
+            return height, width
+    return width, height
+
+def contain_size(size, box):
+    """Output size of ImageOps.contain(image of `size`, box)"""
+    width, height = size
+    if width * box[1] > height * box[0]:
+        return box[0], max(1, round(height * box[0] / width))
+    if width * box[1] < height * box[0]:
+        return max(1, round(width * box[1] / height)), box[1]
+    return tuple(box)
+
+def draft(img, scale: float):
+    """Set a not-yet-decoded JPEG to decode at the coarsest DCT scale that still leaves
+    REDUCED_DECODE_HEADROOM x an output `scale` times its stored size.
+
+    No-op for other formats, loaded images and reductions under the headroom;
+    img.size is the size that will be decoded afterwards.
+    """
+    if img.format == 'JPEG' and REDUCED_DECODE_HEADROOM >= 1 and scale * REDUCED_DECODE_HEADROOM < 1:
+        wanted = scale * REDUCED_DECODE_HEADROOM
+        img.draft(None, (max(1, math.ceil(img.width * wanted)), max(1, math.ceil(img.height * wanted))))
+    return img
+
+def drafted_copy(img, scale: float):
+    """draft() applied to a fresh handle on img's file, leaving img itself untouched.
+
+    Only a not-yet-decoded JPEG opened from a path can be reopened; anything else is
+    returned as is. The caller closes the result when it is not img.
+    """
+    if img.format == 'JPEG' and getattr(img, 'filename', None) and len(img.tile) == 1 and not img.decoderconfig:
+        return draft(Image.open(img.filename), scale)
+    return img
+
+def open_reduced(path, scale: float, copies: int = 1):
+    """open_image for a downscale to `scale` x the stored size.
+
+    JPEGs are decoded reduced, and the budget is checked against the decoded size,
+    so a downscale can succeed on an image too large to decode in full.
+    """
+    check_image(path)
+    img = draft(Image.open(path), scale)
+    try:
+        check_budget(*[(img.size, img.mode)] * copies)
+    except ImageTooLarge:
+        img.close()
+        raise
+    return img
+
+def resample(img, size, method=Image.LANCZOS):
+    """Final resample to size, box-reducing by an integer factor first while REDUCED_DECODE_HEADROOM allows"""
+    gap = REDUCED_DECODE_HEADROOM if REDUCED_DECODE_HEADROOM >= 1 else None
+    return img.resize(size, method, reducing_gap=gap)
+
+def imread_reduced(path, max_side: int = ANALYSIS_MAX_SIDE, grayscale: bool = False):
+    """cv2.imread at 1/2, 1/4 or 1/8 scale while the longer side stays >= max_side.
+
+    Returns (array or None, (width, height)) with the full-resolution, EXIF-oriented
+    dimensions, since the reduced array's shape is rounded up from them.
+    """
+    size, _ = check_image(path)
+    factor = next((f for f in (8, 4, 2) if max(size) >= max_side * f), 1)
+    check_budget(((math.ceil(size[0] / factor), math.ceil(size[1] / factor)), 'L' if grayscale else 'RGB'))
+    if factor == 1:
+        flags = cv2.IMREAD_GRAYSCALE if grayscale else cv2.IMREAD_COLOR
+    else:
+        flags = getattr(cv2, f'IMREAD_REDUCED_{"GRAYSCALE" if grayscale else "COLOR"}_{factor}')
+    return cv2.imread(str(path), flags), oriented_size(path)
+
+def is_large(size) -> bool:
+    return size[0] * size[1] > LARGE_IMAGE_PIXELS
+
+def strip_rows(width, mode) -> int:
+    return max(1, IMAGE_STRIP_BYTES // pixel_bytes((width, 1), mode))
+
+def iter_strips(height, rows):
+    for top in range(0, height, rows):
+        yield top, min(height, top + rows)
+
+def _mean_luma(img) -> int:
+    total = 0.0
+    for top, bottom in iter_strips(img.height, strip_rows(img.width, img.mode)):
+        total += ImageStat.Stat(img.crop((0, top, img.width, bottom)).convert('L')).sum[0]
+    return int(total / (img.width * img.height) + 0.5)
+
+def enhance_in_strips(img, filter_type, value):
+    """ImageEnhance brightness/contrast/sharpness applied in place, one horizontal strip at a time.
+
+    Gives the same pixels as ImageEnhance on the whole image while holding one
+    full-size buffer instead of three: contrast uses the whole-image mean luma,
+    and sharpness reads one original row either side of each strip for its 3x3 kernel.
+    """
+    img.load()
+    width, height = img.size
+    mean = _mean_luma(img) if filter_type == 'contrast' else None
+    halo = 1 if filter_type == 'sharpness' else 0
+    carried = None  # original rows above the current strip, already overwritten in img
+    for top, bottom in iter_strips(height, strip_rows(width, img.mode)):
+        below = min(height, bottom + halo)
+        strip = img.crop((0, top, width, below))
+        if carried is not None:
+            padded = Image.new(img.mode, (width, below - top + carried.height))
+            padded.paste(carried, (0, 0))
+            padded.paste(strip, (0, carried.height))
+            strip = padded
+        offset = carried.height if carried is not None else 0
+        if halo:
+            carried = img.crop((0, bottom - halo, width, bottom))
+
+        if filter_type == 'brightness':
+            out = ImageEnhance.Brightness(strip).enhance(value)
+        elif filter_type == 'contrast':
+            degenerate = Image.new('L', strip.size, mean).convert(strip.mode)
+            if 'A' in strip.getbands():
+                degenerate.putalpha(strip.getchannel('A'))
+            out = Image.blend(degenerate, strip, value)
+        else:
+            out = ImageEnhance.Sharpness(strip).enhance(value)
+        img.paste(out.crop((0, offset, width, offset + bottom - top)), (0, top))
+    return img
@@ -1,31 +1,43 @@
-from fastapi import FastAPI, File, UploadFile, HTTPException, Form
+from fastapi import FastAPI, File, UploadFile, HTTPException, Form, Query
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, StreamingResponse, Response
+from starlette.concurrency import run_in_threadpool
 import uvicorn
 import os
 from dotenv import load_dotenv
-from db import init_db, save_asset, list_assets, get_asset_path, save_asset_version, get_asset_versions, add_asset_comment, get_asset_comments
-from utils import save_upload_file_temp, remove_background, resize_image, rotate_image, crop_image, apply_filter, overlay_text
+from db import init_db, save_asset, list_assets, get_asset_path, get_current_version, get_asset_versions, get_version_record, add_asset_comment, get_asset_comments, save_asset_hash, get_asset_hash, find_near_duplicates, HASH_BITS, get_rollup, ROLLUP_DIMENSIONS, get_user, create_user, update_user_password, import_users_json
+from largeimage import ImageTooLarge, imread_reduced
+from utils import save_upload_file_temp, warm_rembg_sessions, REMBG_WARM_MODELS, compute_image_hashes, apply_operations
+from versioning import record_version, resolve_version_path
+from delivery import file_response, not_modified_response, content_digest
+from renditions import get_rendition, rendition_etag, negotiate_format, source_has_alpha, source_format, FORMATS as RENDITION_FORMATS, RENDITION_MAX_DIMENSION
+from backup import start_backup, get_backup_job, find_snapshot, stream_archive
+from reclaim import plan_reclamation, start_reclamation, get_reclamation_job, public_plan
+import metrics
+from metrics import stage_timer, queued
+from reports import build_report, report_rows, stream_csv, to_parquet, REPORT_FORMATS
+from health import start_sampler, stop_sampler, take_sample, latest_sample, sample_history, sample_age, HEALTH_SAMPLE_INTERVAL
 from guidelines import validate_creative_rules, validate_image_guidelines
+import ocr
+import fonts
+import passwords
+import variants
+from passwords import hash_password, verify_password, needs_rehash, login_retry_after, record_login_failure, user_attempts, HashingBusy
+from detection import load_detector, detect_batch, summarize_detections, DETECTION_BATCH_SIZE, DETECTION_BACKEND
 import logging
 from logging.handlers import RotatingFileHandler
 import torch
 from pathlib import Path
 import cv2
-import pytesseract
 import numpy as np
 import time
-import pandas as pd
-import io
 import json
 from typing import List
 import jwt
-import bcrypt
 from datetime import datetime, timedelta
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from fastapi import Depends, Security
+from fastapi import Depends, Security, Request
 from diffusers import DiffusionPipeline
-from transformers import pipeline
 from PIL import Image
 
 # Load environment variables from .env file
@@ -93,9 +105,32 @@ app.add_middleware(
     allow_headers=['*'],
 )
 
+@app.middleware('http')
+async def record_request_metrics(request, call_next):
+    if not metrics.ENABLE_METRICS:
+        return await call_next(request)
+    start = time.perf_counter()
+    status = 500
+    metrics.HTTP_INFLIGHT.labels().inc()
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        metrics.HTTP_INFLIGHT.labels().dec()
+        # Label by route template, not raw path, to keep series bounded
+        route = request.scope.get('route')
+        metrics.observe_request(request.method, route.path if route else 'unmatched', status, time.perf_counter() - start)
+
 # Initialize database
 init_db(DB_PATH)
 logger.info(f'Database initialized at: {DB_PATH}')
+try:
+    imported_users = import_users_json(DB_PATH, str(BASE_DIR / 'users.json'))
+    if imported_users:
+        logger.info(f'Imported {imported_users} users from users.json')
+except FileNotFoundError:
+    pass  # Another worker imported and renamed it first
 
 # GPU configuration
 USE_GPU = os.getenv('USE_GPU', 'true').lower() == 'true'
@@ -106,6 +141,7 @@ logger.info(f'GPU available: {GPU_AVAILABLE}, GPU enabled: {USE_GPU}')
 MAX_UPLOAD_SIZE = int(os.getenv('MAX_UPLOAD_SIZE', '10485760'))  # 10MB default
 BATCH_LIMIT = int(os.getenv('BATCH_LIMIT', '50'))
 AI_TIMEOUT = int(os.getenv('AI_TIMEOUT', '300'))
+DUPLICATE_MAX_DISTANCE = int(os.getenv('DUPLICATE_MAX_DISTANCE', '6'))  # pHash bits
 
 # Feature flags
 ENABLE_ADVANCED_AI = os.getenv('ENABLE_ADVANCED_AI', 'true').lower() == 'true'
@@ -118,8 +154,8 @@ logger.info('Application configuration loaded successfully')
 # Initialize models
 device = "cuda" if GPU_AVAILABLE else "cpu"
 try:
-    object_detector = pipeline("object-detection", model="facebook/detr-resnet-50", device=device)
-    logger.info("Object detection model loaded")
+    object_detector = load_detector(device)
+    logger.info(f"Object detection model loaded (backend={DETECTION_BACKEND})")
 except Exception as e:
     logger.warning(f"Failed to load object detection model: {e}")
     object_detector = None
@@ -137,12 +173,48 @@ except Exception as e:
     logger.warning(f"Failed to load Stable Diffusion model: {e}")
     stable_diffusion_pipe = None
 
-# Authentication functions
-def hash_password(password: str) -> str:
-    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+if REMBG_WARM_MODELS:
+    try:
+        warm_rembg_sessions()
+        logger.info(f"Background removal sessions warmed: {REMBG_WARM_MODELS}")
+    except Exception as e:
+        logger.warning(f"Failed to warm background removal sessions: {e}")
 
-def verify_password(password: str, hashed: str) -> bool:
-    return bcrypt.checkpw(password.encode('utf-8'), hashed.encode('utf-8'))
+try:
+    logger.info(f'OCR backend: {ocr.active_backend()}')
+except Exception as e:
+    logger.warning(f'OCR backend unavailable: {e}')
+
+def model_state():
+    """Which models are loaded, reported by the health sampler"""
+    try:
+        ocr_backend = ocr.active_backend()
+    except Exception:
+        ocr_backend = None
+    return {
+        'object_detection': object_detector is not None,
+        'detection_backend': DETECTION_BACKEND,
+        'stable_diffusion': stable_diffusion_pipe is not None,
+        'ocr_backend': ocr_backend,
+        'device': device
+    }
+
+@app.on_event('startup')
+def start_background_workers():
+    start_sampler(DB_PATH, model_state)
+    passwords.start_proxy_resolver()
+
+@app.on_event('shutdown')
+def stop_background_workers():
+    """Release OCR engines and stop the health sampler, password hashing and variant rendering pools"""
+    ocr.shutdown()
+    stop_sampler()
+    passwords.shutdown()
+    variants.shutdown()
+
+# Authentication functions
+def hashing_busy() -> HTTPException:
+    return HTTPException(status_code=503, detail='Authentication is busy, retry shortly', headers={'Retry-After': '1'})
 
 def create_access_token(data: dict):
     to_encode = data.copy()
@@ -160,13 +232,32 @@ def verify_token(credentials: HTTPAuthorizationCredentials = Security(security))
     except jwt.JWTError:
         raise HTTPException(status_code=401, detail="Invalid token")
 
+def index_asset_hashes(asset_id, path):
+    """Store perceptual hashes for a new asset and return its near-duplicates"""
+    try:
+        phash, dhash = compute_image_hashes(path)
+        duplicates = find_near_duplicates(DB_PATH, phash, dhash, DUPLICATE_MAX_DISTANCE, exclude_id=asset_id)
+        save_asset_hash(DB_PATH, asset_id, phash, dhash)
+        return duplicates
+    except Exception as e:
+        logger.warning(f'Perceptual hashing failed for asset {asset_id}: {e}')
+        return []
+
 @app.post('/upload_packshot')
 async def upload_packshot(file: UploadFile = File(...), label: str = Form(None), current_user: dict = Depends(verify_token)):
     try:
         tmp_path = save_upload_file_temp(file, subfolder='uploads')
         asset_id = save_asset(DB_PATH, tmp_path, label or file.filename, current_user['sub'])
-        logger.info(f'Uploaded asset {asset_id} label={label} filename={file.filename}')
-        return {'asset_id': asset_id, 'filename': file.filename}
+        duplicates = index_asset_hashes(asset_id, tmp_path)
+        logger.info(f'Uploaded asset {asset_id} label={label} filename={file.filename} duplicates={len(duplicates)}')
+        return {
+            'asset_id': asset_id,
+            'filename': file.filename,
+            'duplicate_of': duplicates[0]['asset_id'] if duplicates else None,
+            'duplicates': duplicates
+        }
+    except ImageTooLarge as e:
+        raise HTTPException(status_code=413, detail=str(e))
     except Exception as e:
         logger.exception('Upload failed')
         raise HTTPException(status_code=500, detail=str(e))
@@ -175,59 +266,93 @@ async def upload_packshot(file: UploadFile = File(...), label: str = Form(None),
 def assets(current_user: dict = Depends(verify_token)):
     return list_assets(DB_PATH)
 
-@app.get('/asset/{asset_id}')
-def asset(asset_id: int, current_user: dict = Depends(verify_token)):
-    path = get_asset_path(DB_PATH, asset_id)
-    if not path or not os.path.exists(path):
+RENDITION_WIDTH = Query(None, ge=1, le=RENDITION_MAX_DIMENSION)
+RENDITION_HEIGHT = Query(None, ge=1, le=RENDITION_MAX_DIMENSION)
+RENDITION_FIT = Query('contain', pattern='^(contain|cover|fill)$')
+RENDITION_FORMAT = Query(None, pattern='^(auto|original|webp|avif|jpeg|png)$')
+
+def asset_file_response(request, path, last_modified, immutable, width, height, fit, format):
+    """The stored file, or a cached rendition when a size or output format is requested"""
+    if width is None and height is None and format in (None, 'original'):
+        return file_response(request, path, last_modified=last_modified, immutable=immutable)
+    negotiated = format in (None, 'auto')
+    try:
+        if format == 'original':
+            # A resized original keeps the source's format rather than following Accept
+            fmt = source_format(path)
+        elif negotiated:
+            fmt = negotiate_format(request.headers.get('accept'), source_has_alpha(path))
+        else:
+            fmt = format
+    except ImageTooLarge as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    digest = content_digest(path)
+    etag = rendition_etag(digest, width, height, fit, fmt)
+    vary = 'Accept' if negotiated else None
+    # Revalidations are answered without rendering, even if the rendition was evicted
+    response = not_modified_response(request, etag, last_modified, immutable, vary)
+    if response is not None:
+        return response
+    for attempt in range(2):
+        try:
+            rendition = get_rendition(path, digest, width, height, fit, fmt)
+        except ImageTooLarge as e:
+            raise HTTPException(status_code=413, detail=str(e))
+        try:
+            return file_response(request, rendition, last_modified=last_modified, immutable=immutable,
+                                 etag=etag, media_type=RENDITION_FORMATS[fmt], vary=vary)
+        except FileNotFoundError:
+            # Another request's render evicted it after get_rendition returned; render it again once
+            if attempt:
+                raise
+
+@app.api_route('/asset/{asset_id}', methods=['GET', 'HEAD'])
+def asset(request: Request, asset_id: int, width: int = RENDITION_WIDTH, height: int = RENDITION_HEIGHT,
+          fit: str = RENDITION_FIT, format: str = RENDITION_FORMAT, current_user: dict = Depends(verify_token)):
+    current = get_current_version(DB_PATH, asset_id)
+    if not current or not current['path'] or not os.path.exists(current['path']):
         raise HTTPException(status_code=404, detail='Asset not found')
-    return FileResponse(path, media_type='image/png')
+    return asset_file_response(request, current['path'], current['created_at'], False, width, height, fit, format)
 
 @app.post('/manipulate_image')
-async def manipulate_image(asset_id: int = Form(...), remove_bg: bool = Form(False),
+async def manipulate_image(asset_id: int = Form(...), remove_bg: bool = Form(False), bg_model: str = Form(None),
                              width: int = Form(None), height: int = Form(None), rotate: int = Form(0),
                              crop_left: int = Form(None), crop_top: int = Form(None), crop_right: int = Form(None), crop_bottom: int = Form(None),
                              filter_type: str = Form(None), filter_value: float = Form(1.0),
                              overlay_text_str: str = Form(''), overlay_x: int = Form(0), overlay_y: int = Form(0), font_size: int = Form(20),
+                             font: str = Form(None), text_max_width: int = Form(None), text_align: str = Form('left'), text_anchor: str = Form('la'),
                              current_user: dict = Depends(verify_token)):
     path = get_asset_path(DB_PATH, asset_id)
     if not path:
         raise HTTPException(status_code=404, detail='Asset not found')
-    out_path = path
-    operations_applied = []
-
-    if remove_bg:
-        out_path = remove_background(out_path)
-        operations_applied.append('remove_bg')
-    if crop_left is not None and crop_top is not None and crop_right is not None and crop_bottom is not None:
-        out_path = crop_image(out_path, crop_left, crop_top, crop_right, crop_bottom)
-        operations_applied.append('crop')
-    if width or height:
-        out_path = resize_image(out_path, width=width, height=height)
-        operations_applied.append('resize')
-    if rotate:
-        out_path = rotate_image(out_path, rotate)
-        operations_applied.append('rotate')
-    if filter_type:
-        out_path = apply_filter(out_path, filter_type, filter_value)
-        operations_applied.append('filter')
-    if overlay_text_str:
-        out_path = overlay_text(out_path, overlay_text_str, overlay_x, overlay_y, font_size)
-        operations_applied.append('overlay_text')
-
-    # Save new version
     operation_params = {
         'remove_bg': remove_bg,
+        'bg_model': bg_model if remove_bg else None,
         'crop': {'left': crop_left, 'top': crop_top, 'right': crop_right, 'bottom': crop_bottom} if crop_left is not None else None,
         'resize': {'width': width, 'height': height} if width or height else None,
         'rotate': rotate if rotate else None,
         'filter': {'type': filter_type, 'value': filter_value} if filter_type else None,
-        'overlay_text': {'text': overlay_text_str, 'x': overlay_x, 'y': overlay_y, 'font_size': font_size} if overlay_text_str else None
+        'overlay_text': {'text': overlay_text_str, 'x': overlay_x, 'y': overlay_y, 'font_size': font_size,
+                         'font': font, 'max_width': text_max_width, 'align': text_align, 'anchor': text_anchor} if overlay_text_str else None
     }
-    new_version = save_asset_version(DB_PATH, asset_id, out_path, 'manipulate', json.dumps(operation_params), current_user['sub'])
+    try:
+        out_path, operations_applied = apply_operations(path, operation_params)
+    except ImageTooLarge as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    # Save new version
+    new_version = record_version(DB_PATH, asset_id, out_path, 'manipulate', json.dumps(operation_params), current_user['sub'])
 
     logger.info(f'Manipulated image {asset_id} -> {out_path} operations={operations_applied} new_version={new_version}')
     return {'result_path': out_path, 'new_version': new_version, 'operations_applied': operations_applied}
 
+@app.get('/fonts')
+async def list_fonts(current_user: dict = Depends(verify_token)):
+    """Registered brand font faces for text overlays"""
+    return {'fonts': fonts.faces(), 'default': fonts.default_face()}
+
 @app.post('/validate')
 async def validate(headline: str = Form(''), subhead: str = Form(''), caveat: str = Form(''), tags: str = Form(''), description: str = Form(''), platform: str = Form('general'), current_user: dict = Depends(verify_token)):
     payload = {'headline': headline, 'subhead': subhead, 'caveat': caveat, 'tags': tags, 'description': description}
@@ -251,70 +376,117 @@ def download_sample_zip():
         raise HTTPException(status_code=404, detail='Sample not ready')
     return FileResponse(zipf, media_type='application/zip', filename='sample_output.zip')
 
+def current_health() -> dict:
+    """Latest sampler snapshot; samples synchronously only before the first one exists"""
+    sample = latest_sample() or take_sample(DB_PATH, model_state)
+    sample['gpu_available'] = GPU_AVAILABLE
+    return sample
+
+@app.get('/health')
+def health():
+    """Unauthenticated liveness check for container orchestration"""
+    age = sample_age()
+    if age is not None and age > 3 * HEALTH_SAMPLE_INTERVAL:
+        raise HTTPException(status_code=503, detail=f'Health sampler stalled ({age:.0f}s since last sample)')
+    return {'status': 'ok', 'sample_age_seconds': age}
+
+@app.get('/metrics')
+def prometheus_metrics():
+    """Request, stage, queue and cache metrics in the Prometheus text format"""
+    if not metrics.ENABLE_METRICS:
+        raise HTTPException(status_code=404, detail='Metrics are disabled')
+    return Response(metrics.render(), media_type='text/plain; version=0.0.4; charset=utf-8')
+
 @app.post('/system_health')
-def system_health(current_user: dict = Depends(verify_token)):
-    import psutil
-    health_data = {
-        'timestamp': time.time(),
-        'cpu_percent': psutil.cpu_percent(interval=1),
-        'memory_percent': psutil.virtual_memory().percent,
-        'disk_usage': psutil.disk_usage('/').percent,
-        'uptime_seconds': time.time() - psutil.boot_time(),
-        'gpu_available': GPU_AVAILABLE,
-        'active_connections': 1,  # Mock
-        'total_assets': len(list_assets(DB_PATH)),
-        'storage_used_mb': sum(os.path.getsize(asset['path']) for asset in list_assets(DB_PATH)) / (1024 * 1024) if list_assets(DB_PATH) else 0
-    }
-    logger.info(f'System health check: {health_data}')
+def system_health(history_seconds: int = 0, current_user: dict = Depends(verify_token)):
+    """Latest cached health snapshot, optionally with the samples from the last history_seconds"""
+    health_data = current_health()
+    if history_seconds > 0:
+        health_data['history'] = sample_history(history_seconds)
     return health_data
 
 @app.post('/cleanup_assets')
-def cleanup_assets(days: int = 30, current_user: dict = Depends(verify_token)):
-    cutoff = time.time() - (days * 24 * 60 * 60)
-    assets = list_assets(DB_PATH)
-    old_assets = [a for a in assets if a['uploaded_at'] < cutoff]
-    result = {
-        'found_old_assets': len(old_assets),
-        'would_delete': [a['id'] for a in old_assets],
-        'message': f'Found {len(old_assets)} assets older than {days} days. Run with confirm=true to delete.'
-    }
-    logger.info(f'Cleanup check: {result}')
-    return result
+def cleanup_assets(days: int = 30, keep_last: int = None, keep_commented: bool = True, dry_run: bool = True,
+                   current_user: dict = Depends(verify_token)):
+    """Reclaim storage from superseded versions and orphaned files; dry run by default"""
+    try:
+        plan = public_plan(plan_reclamation(DB_PATH, days, keep_last, keep_commented))
+        if dry_run:
+            plan['message'] = (f"{len(plan['versions'])} versions and {len(plan['orphaned_files'])} orphaned files "
+                               f"({plan['bytes_reclaimable']} bytes) are outside the retention policy. "
+                               f"Run with dry_run=false to delete.")
+            logger.info(f"Cleanup check: {len(plan['versions'])} versions, {plan['bytes_reclaimable']} bytes reclaimable")
+            return plan
+        job = start_reclamation(DB_PATH, days, keep_last, keep_commented)
+        logger.info(f"Cleanup started: {job['job_id']}")
+        return {'status': 'started', **job}
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f'Cleanup failed: {str(e)}')
+        raise HTTPException(status_code=500, detail=f'Cleanup failed: {str(e)}')
+
+@app.get('/cleanup_assets/{job_id}')
+def cleanup_status(job_id: str, current_user: dict = Depends(verify_token)):
+    """Progress of a reclamation started by /cleanup_assets"""
+    job = get_reclamation_job(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail='Cleanup job not found')
+    return job
+
+def report_download(report: dict, format: str):
+    """Stream a report as a CSV or Parquet file download"""
+    if format not in REPORT_FORMATS:
+        raise HTTPException(status_code=400, detail=f'Unsupported report format: {format}. Choose from {", ".join(REPORT_FORMATS)}')
+    rows = list(report_rows(report, current_health()))
+    filename = f'creative_tool_report_{time.strftime("%Y%m%d_%H%M%S")}.{format}'
+    headers = {'Content-Disposition': f'attachment; filename="{filename}"', 'X-Metrics-Count': str(len(rows))}
+    if format == 'parquet':
+        try:
+            content = to_parquet(rows)
+        except ImportError:
+            raise HTTPException(status_code=400, detail='Parquet export requires pyarrow')
+        return Response(content, media_type=REPORT_FORMATS[format], headers=headers)
+    return StreamingResponse(stream_csv(rows), media_type=REPORT_FORMATS[format], headers=headers)
 
 @app.post('/generate_report')
-def generate_report(current_user: dict = Depends(verify_token)):
-    assets = list_assets(DB_PATH)
-    total_assets = len(assets)
-    processed = sum(1 for a in assets if 'processed' in (a.get('label') or '').lower())
-    avg_size = sum(os.path.getsize(a['path']) for a in assets[:min(10, len(assets))]) / (1024 * min(10, len(assets))) if assets else 0
-
-    report = {
-        'generated_at': time.time(),
-        'total_assets': total_assets,
-        'processed_assets': processed,
-        'processing_rate': (processed / total_assets * 100) if total_assets > 0 else 0,
-        'average_file_size_kb': avg_size,
-        'storage_estimate_mb': total_assets * 0.15,
-        'top_labels': {}
+def generate_report(format: str = 'json', current_user: dict = Depends(verify_token)):
+    """Analytics summary as JSON, or as a CSV/Parquet download with format=csv|parquet"""
+    try:
+        report = build_report(DB_PATH)
+        logger.info(f"Report generated: {report['total_assets']} assets")
+        if format == 'json':
+            return report
+        return report_download(report, format)
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f'Report generation failed: {str(e)}')
+        raise HTTPException(status_code=500, detail=f'Report generation failed: {str(e)}')
+
+@app.get('/analytics/{dimension}')
+def analytics_rollup(dimension: str, limit: int = None, top: bool = False, since: str = None,
+                     current_user: dict = Depends(verify_token)):
+    """Dashboard series served from the analytics rollups (top=true orders by count)"""
+    if dimension not in ROLLUP_DIMENSIONS:
+        raise HTTPException(status_code=404, detail=f'Unknown analytics dimension: {dimension}. Choose from {", ".join(ROLLUP_DIMENSIONS)}')
+    rows = get_rollup(DB_PATH, dimension, order_by_count=top, limit=limit, since=since)
+    return {
+        'dimension': dimension,
+        'buckets': [{'bucket': bucket, 'count': count, 'bytes': nbytes} for bucket, count, nbytes in rows]
     }
-    logger.info(f'Report generated: {report}')
-    return report
 
 @app.post('/backup_data')
 def backup_data(current_user: dict = Depends(verify_token)):
-    import shutil
-    backup_time = time.strftime('%Y%m%d_%H%M%S')
-    backup_dir = f'backup_{backup_time}'
+    """Start an incremental snapshot backup in the background"""
     try:
-        # Use BASE_DIR to ensure correct path
-        storage_path = str(BASE_DIR)
-        backup_path = os.path.join(storage_path, backup_dir)
-        shutil.copytree(storage_path, backup_path)
+        job = start_backup(DB_PATH)
         result = {
-            'status': 'success',
-            'backup_path': backup_path,
-            'timestamp': time.time(),
-            'message': f'Backup created successfully at {backup_dir}'
+            'status': 'started',
+            'backup_id': job['backup_id'],
+            'backup_path': job['backup_path'],
+            'timestamp': job['started_at'],
+            'message': f'Backup {job["backup_id"]} started'
         }
     except Exception as e:
         result = {
@@ -325,6 +497,23 @@ def backup_data(current_user: dict = Depends(verify_token)):
     logger.info(f'Backup operation: {result}')
     return result
 
+@app.get('/backup/{backup_id}')
+def backup_status(backup_id: str, current_user: dict = Depends(verify_token)):
+    """Progress of a backup started by /backup_data"""
+    job = get_backup_job(backup_id)
+    if not job:
+        raise HTTPException(status_code=404, detail='Backup not found')
+    return job
+
+@app.get('/backup/{backup_id}/archive')
+def backup_archive(backup_id: str, current_user: dict = Depends(verify_token)):
+    """Stream a completed snapshot as a .tar.gz"""
+    snapshot = find_snapshot(backup_id)
+    if not snapshot or not snapshot.exists():
+        raise HTTPException(status_code=404, detail='Backup not found or not complete')
+    return StreamingResponse(stream_archive(snapshot), media_type='application/gzip',
+                             headers={'Content-Disposition': f'attachment; filename="{snapshot.name}.tar.gz"'})
+
 @app.post('/batch_upload')
 async def batch_upload(files: List[UploadFile] = File(...), labels: str = Form(None), current_user: dict = Depends(verify_token)):
     """
@@ -335,17 +524,24 @@ async def batch_upload(files: List[UploadFile] = File(...), labels: str = Form(N
         results = []
 
         for i, file in enumerate(files):
-            tmp_path = save_upload_file_temp(file, subfolder='uploads')
+            try:
+                tmp_path = save_upload_file_temp(file, subfolder='uploads')
+            except ImageTooLarge as e:
+                results.append({'filename': file.filename, 'error': str(e)})
+                continue
             label = labels_list[i] if i < len(labels_list) else None
             asset_id = save_asset(DB_PATH, tmp_path, label or file.filename, current_user['sub'])
+            duplicates = index_asset_hashes(asset_id, tmp_path)
             results.append({
                 'asset_id': asset_id,
                 'filename': file.filename,
-                'label': label
+                'label': label,
+                'duplicate_of': duplicates[0]['asset_id'] if duplicates else None,
+                'duplicates': duplicates
             })
             logger.info(f'Batch uploaded asset {asset_id} filename={file.filename}')
 
-        return {'uploaded_assets': results, 'total_uploaded': len(results)}
+        return {'uploaded_assets': results, 'total_uploaded': sum(1 for r in results if 'asset_id' in r)}
     except Exception as e:
         logger.exception('Batch upload failed')
         raise HTTPException(status_code=500, detail=str(e))
@@ -367,44 +563,19 @@ async def batch_manipulate(asset_ids: str = Form(...), operations: str = Form(..
                 results.append({'asset_id': asset_id, 'status': 'error', 'message': 'Asset not found'})
                 continue
 
-            out_path = path
-            applied_ops = []
-
-            # Apply operations in sequence
-            if operations_dict.get('remove_bg', False):
-                out_path = remove_background(out_path)
-                applied_ops.append('remove_bg')
-
-            if 'crop' in operations_dict:
-                crop_data = operations_dict['crop']
-                out_path = crop_image(out_path, crop_data['left'], crop_data['top'], crop_data['right'], crop_data['bottom'])
-                applied_ops.append('crop')
-
-            if 'resize' in operations_dict:
-                resize_data = operations_dict['resize']
-                out_path = resize_image(out_path, width=resize_data.get('width'), height=resize_data.get('height'))
-                applied_ops.append('resize')
-
-            if operations_dict.get('rotate', 0):
-                out_path = rotate_image(out_path, operations_dict['rotate'])
-                applied_ops.append('rotate')
-
-            if 'filter' in operations_dict:
-                filter_data = operations_dict['filter']
-                out_path = apply_filter(out_path, filter_data['type'], filter_data['value'])
-                applied_ops.append('filter')
-
-            if 'overlay_text' in operations_dict:
-                text_data = operations_dict['overlay_text']
-                out_path = overlay_text(out_path, text_data['text'], text_data['x'], text_data['y'], text_data['font_size'])
-                applied_ops.append('overlay_text')
+            try:
+                out_path, applied_ops = apply_operations(path, operations_dict)
+            except (ImageTooLarge, ValueError) as e:
+                # Invalid parameters (an unknown font, oversized text) fail the item, not the batch
+                results.append({'asset_id': asset_id, 'status': 'error', 'message': str(e)})
+                continue
 
             # Save new version for batch operations
             operation_params = {
                 'batch_operation': True,
                 'operations': operations_dict
             }
-            new_version = save_asset_version(DB_PATH, asset_id, out_path, 'batch_manipulate', json.dumps(operation_params), current_user['sub'])
+            new_version = record_version(DB_PATH, asset_id, out_path, 'batch_manipulate', json.dumps(operation_params), current_user['sub'])
 
             results.append({
                 'asset_id': asset_id,
@@ -420,6 +591,72 @@ async def batch_manipulate(asset_ids: str = Form(...), operations: str = Form(..
         logger.exception('Batch manipulation failed')
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post('/render_variants')
+async def render_variants(asset_id: int = Form(...), copies: str = Form(...),
+                          formats: str = Form(','.join(variants.VARIANT_FORMATS)),
+                          remove_bg: bool = Form(False), bg_model: str = Form(None), fit: str = Form('cover'),
+                          font: str = Form(None), text_color: str = Form('#ffffff'), background: str = Form('#ffffff'),
+                          output: str = Form('store'),
+                          render_rejected: bool = Form(False), current_user: dict = Depends(verify_token)):
+    """
+    Render copy lines x formats from one asset in a single pass, validating each copy line
+    """
+    path = get_asset_path(DB_PATH, asset_id)
+    if not path or not os.path.exists(path):
+        raise HTTPException(status_code=404, detail='Asset not found')
+    if output not in variants.OUTPUTS:
+        raise HTTPException(status_code=400, detail=f'output must be one of: {", ".join(variants.OUTPUTS)}')
+    try:
+        copy_lines = json.loads(copies)
+        if not isinstance(copy_lines, list) or not all(isinstance(c, dict) for c in copy_lines):
+            raise ValueError('copies must be a JSON list of objects')
+        for i, copy in enumerate(copy_lines):
+            for field in variants.COPY_FIELDS:
+                if not isinstance(copy.get(field) or '', str):
+                    raise ValueError(f'copies[{i}].{field} must be a string')
+        results = await run_in_threadpool(
+            variants.render_variants, path, copy_lines, variants.parse_formats(formats.split(',')),
+            remove_bg, bg_model, fit, font, text_color, background, render_rejected)
+    except ImageTooLarge as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    try:
+        if output == 'zip':
+            for result in results:
+                if 'data' in result:
+                    result['filename'] = variants.variant_filename(result)
+            manifest = json.dumps({
+                'asset_id': asset_id,
+                'copies': copy_lines,
+                'variants': [{k: v for k, v in r.items() if k not in ('data', 'suffix')} for r in results]
+            }, indent=2).encode()
+            archive = await run_in_threadpool(variants.zip_variants, results, manifest)
+            logger.info(f'Rendered {len(results)} variants of asset {asset_id} as zip')
+            return Response(content=archive, media_type='application/zip',
+                            headers={'Content-Disposition': f'attachment; filename="asset_{asset_id}_variants.zip"'})
+
+        # Each rendered variant becomes a new asset derived from the source
+        await run_in_threadpool(variants.store_variants, results)
+        for result in results:
+            if 'path' in result:
+                headline = copy_lines[result['copy_index']].get('headline') or f"copy {result['copy_index'] + 1}"
+                result['asset_id'] = save_asset(DB_PATH, result['path'], f"{headline[:60]} [{result['format']}]",
+                                                current_user['sub'])
+                index_asset_hashes(result['asset_id'], result['path'])
+        logger.info(f'Rendered variants of asset {asset_id}: '
+                    f'{sum(1 for r in results if "asset_id" in r)} stored of {len(results)}')
+        return {
+            'asset_id': asset_id,
+            'variants': results,
+            'total_rendered': sum(1 for r in results if 'asset_id' in r),
+            'total_rejected': sum(1 for r in results if r['status'] == 'rejected')
+        }
+    except Exception as e:
+        logger.exception(f'Variant rendering failed for asset {asset_id}')
+        raise HTTPException(status_code=500, detail=str(e))
+
 @app.post('/batch_validate')
 async def batch_validate(asset_ids: str = Form(...), current_user: dict = Depends(verify_token)):
     """
@@ -449,6 +686,82 @@ async def batch_validate(asset_ids: str = Form(...), current_user: dict = Depend
         logger.exception('Batch validation failed')
         raise HTTPException(status_code=500, detail=str(e))
 
+def build_image_analysis(path, detections):
+    """
+    Pixel statistics, OCR and auto-tags for one image, combined with its detections
+    """
+    # Basic image analysis using OpenCV, on a decode reduced as far as ANALYSIS_MAX_SIDE allows
+    image, (width, height) = imread_reduced(path)
+    if image is None:
+        raise ValueError(f'Unable to decode image for analysis: {path}')
+
+    # Color analysis
+    avg_color = cv2.mean(image)[:3]
+    avg_color_rgb = tuple(reversed([int(c) for c in avg_color]))
+
+    # Brightness analysis
+    hsv = cv2.cvtColor(image, cv2.COLOR_BGR2HSV)
+    brightness = np.mean(hsv[:, :, 2])
+
+    # Edge detection for complexity
+    edges = cv2.Canny(image, 100, 200)
+    complexity = np.sum(edges > 0) / edges.size
+
+    # OCR for text detection (cached word-box pass shared with validate_image_guidelines)
+    try:
+        text_content = ocr.ocr_file(path)['text']
+        has_text = len(text_content.strip()) > 0
+    except:
+        text_content = ""
+        has_text = False
+
+    detected_objects, detected_people = summarize_detections(detections)
+
+    analysis = {
+        'dimensions': {'width': width, 'height': height},
+        'average_color': avg_color_rgb,
+        'brightness': float(brightness),
+        'complexity_score': float(complexity),
+        'has_text': has_text,
+        'extracted_text': text_content[:500] if text_content else "",  # Limit text length
+        'file_size_kb': os.path.getsize(path) / 1024,
+        'aspect_ratio': width / height if height > 0 else 0,
+        'detected_objects': detected_objects,
+        'detected_people': detected_people,
+        'restricted_content': len(detected_people) > 0  # Flag if people detected
+    }
+
+    # Auto-tagging based on analysis
+    tags = []
+    if brightness < 50:
+        tags.append('dark')
+    elif brightness > 200:
+        tags.append('bright')
+
+    if complexity < 0.01:
+        tags.append('simple')
+    elif complexity > 0.1:
+        tags.append('complex')
+
+    if has_text:
+        tags.append('text_overlay')
+
+    # Color-based tags
+    r, g, b = avg_color_rgb
+    if r > g and r > b:
+        tags.append('red_tone')
+    elif g > r and g > b:
+        tags.append('green_tone')
+    elif b > r and b > g:
+        tags.append('blue_tone')
+
+    # Object-based tags
+    for obj in detected_objects:
+        tags.append(obj['label'])
+
+    analysis['auto_tags'] = tags
+    return analysis
+
 @app.post('/analyze_image')
 async def analyze_image(asset_id: int = Form(...), current_user: dict = Depends(verify_token)):
     """
@@ -459,97 +772,87 @@ async def analyze_image(asset_id: int = Form(...), current_user: dict = Depends(
         if not path:
             raise HTTPException(status_code=404, detail='Asset not found')
 
-        # Basic image analysis using OpenCV
-        image = cv2.imread(path)
-        height, width = image.shape[:2]
-
-        # Color analysis
-        avg_color = cv2.mean(image)[:3]
-        avg_color_rgb = tuple(reversed([int(c) for c in avg_color]))
-
-        # Brightness analysis
-        hsv = cv2.cvtColor(image, cv2.COLOR_BGR2HSV)
-        brightness = np.mean(hsv[:, :, 2])
-
-        # Edge detection for complexity
-        edges = cv2.Canny(image, 100, 200)
-        complexity = np.sum(edges > 0) / (height * width)
-
-        # OCR for text detection
-        try:
-            text_content = pytesseract.image_to_string(image)
-            has_text = len(text_content.strip()) > 0
-        except:
-            text_content = ""
-            has_text = False
-
         # Object detection
-        detected_objects = []
-        detected_people = []
+        detections = []
         if object_detector:
             try:
-                pil_image = Image.open(path)
-                detections = object_detector(pil_image)
-                for detection in detections:
-                    label = detection['label']
-                    score = detection['score']
-                    if score > 0.5:  # Confidence threshold
-                        detected_objects.append({'label': label, 'confidence': score})
-                        if label == 'person':
-                            detected_people.append({'confidence': score})
+                with Image.open(path) as pil_image:
+                    detections = detect_batch(object_detector, [pil_image], batch_size=1)[0]
             except Exception as e:
                 logger.warning(f"Object detection failed: {e}")
 
-        analysis = {
-            'dimensions': {'width': width, 'height': height},
-            'average_color': avg_color_rgb,
-            'brightness': float(brightness),
-            'complexity_score': float(complexity),
-            'has_text': has_text,
-            'extracted_text': text_content[:500] if text_content else "",  # Limit text length
-            'file_size_kb': os.path.getsize(path) / 1024,
-            'aspect_ratio': width / height if height > 0 else 0,
-            'detected_objects': detected_objects,
-            'detected_people': detected_people,
-            'restricted_content': len(detected_people) > 0  # Flag if people detected
-        }
-
-        # Auto-tagging based on analysis
-        tags = []
-        if brightness < 50:
-            tags.append('dark')
-        elif brightness > 200:
-            tags.append('bright')
-
-        if complexity < 0.01:
-            tags.append('simple')
-        elif complexity > 0.1:
-            tags.append('complex')
-
-        if has_text:
-            tags.append('text_overlay')
-
-        # Color-based tags
-        r, g, b = avg_color_rgb
-        if r > g and r > b:
-            tags.append('red_tone')
-        elif g > r and g > b:
-            tags.append('green_tone')
-        elif b > r and b > g:
-            tags.append('blue_tone')
-
-        # Object-based tags
-        for obj in detected_objects:
-            tags.append(obj['label'])
-
-        analysis['auto_tags'] = tags
+        analysis = build_image_analysis(path, detections)
 
         logger.info(f'Analyzed image {asset_id}: {analysis}')
         return analysis
+    except HTTPException:
+        raise
     except Exception as e:
         logger.exception(f'Image analysis failed for asset {asset_id}')
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post('/batch_analyze')
+async def batch_analyze(asset_ids: str = Form(...), batch_size: int = Form(None), current_user: dict = Depends(verify_token)):
+    """
+    Analyze multiple assets, running object detection in batches
+    """
+    try:
+        asset_ids_list = [int(x.strip()) for x in asset_ids.split(',')]
+        if len(asset_ids_list) > BATCH_LIMIT:
+            raise HTTPException(status_code=400, detail=f'Batch limit is {BATCH_LIMIT} assets')
+        if batch_size is not None and batch_size < 1:
+            raise HTTPException(status_code=400, detail='batch_size must be at least 1')
+        batch_size = batch_size or DETECTION_BATCH_SIZE
+
+        results = {}
+        found = []
+        for asset_id in asset_ids_list:
+            path = get_asset_path(DB_PATH, asset_id)
+            if not path or not os.path.exists(path):
+                results[asset_id] = {'asset_id': asset_id, 'status': 'error', 'message': 'Asset not found'}
+            else:
+                found.append((asset_id, path))
+
+        # Decode only one batch of images at a time
+        for start in range(0, len(found), batch_size):
+            chunk = found[start:start + batch_size]
+            detections = [[] for _ in chunk]
+            if object_detector:
+                # An unreadable file fails only its own item
+                images, opened = [], []
+                try:
+                    for i, (asset_id, path) in enumerate(chunk):
+                        try:
+                            images.append(Image.open(path))
+                            opened.append(i)
+                        except Exception as e:
+                            results[asset_id] = {'asset_id': asset_id, 'status': 'error', 'message': str(e)}
+                    if images:
+                        for i, found_objects in zip(opened, detect_batch(object_detector, images, batch_size=batch_size)):
+                            detections[i] = found_objects
+                except Exception as e:
+                    logger.warning(f"Batch object detection failed: {e}")
+                finally:
+                    for img in images:
+                        img.close()
+
+            for (asset_id, path), asset_detections in zip(chunk, detections):
+                if asset_id in results:
+                    continue
+                try:
+                    analysis = build_image_analysis(path, asset_detections)
+                    results[asset_id] = {'asset_id': asset_id, 'status': 'success', 'analysis': analysis}
+                except Exception as e:
+                    results[asset_id] = {'asset_id': asset_id, 'status': 'error', 'message': str(e)}
+
+        logger.info(f'Batch analyzed {len(asset_ids_list)} assets batch_size={batch_size}')
+        return {'results': [results[a] for a in asset_ids_list], 'total_analyzed': len(found)}
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.exception('Batch analysis failed')
+        raise HTTPException(status_code=500, detail=str(e))
+
 def generate_marketing_text(analysis):
     """
     Generate marketing text based on image analysis
@@ -585,7 +888,8 @@ def generate_image_with_sd(prompt, negative_prompt="blurry, low quality, distort
         raise Exception("Stable Diffusion model not loaded")
 
     try:
-        image = stable_diffusion_pipe(prompt=prompt, negative_prompt=negative_prompt).images[0]
+        with queued('sdxl'), stage_timer('model.sdxl'):
+            image = stable_diffusion_pipe(prompt=prompt, negative_prompt=negative_prompt).images[0]
         return image
     except Exception as e:
         logger.error(f"Image generation failed: {e}")
@@ -705,49 +1009,47 @@ async def generate_ad_assets(asset_id: int = Form(...), current_user: dict = Dep
 async def register(username: str = Form(...), password: str = Form(...), email: str = Form(None)):
     """Register a new user"""
     try:
-        # In production, store users in database
-        # For demo, we'll use a simple file-based storage
-        users_file = os.path.join(BASE_DIR, 'users.json')
-        if os.path.exists(users_file):
-            with open(users_file, 'r') as f:
-                users = json.load(f)
-        else:
-            users = {}
-
-        if username in users:
+        if get_user(DB_PATH, username):
             raise HTTPException(status_code=400, detail="Username already exists")
 
-        users[username] = {
-            'password_hash': hash_password(password),
-            'email': email,
-            'created_at': time.time(),
-            'role': 'user'
-        }
-
-        with open(users_file, 'w') as f:
-            json.dump(users, f)
+        # The unique index settles concurrent registrations of the same name
+        if not create_user(DB_PATH, username, await hash_password(password), email):
+            raise HTTPException(status_code=400, detail="Username already exists")
 
         logger.info(f'User registered: {username}')
         return {'message': 'User registered successfully'}
+    except HTTPException:
+        raise
+    except HashingBusy:
+        raise hashing_busy()
     except Exception as e:
         logger.exception('Registration failed')
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.post('/login')
-async def login(username: str = Form(...), password: str = Form(...)):
+async def login(request: Request, username: str = Form(...), password: str = Form(...)):
     """Authenticate user and return JWT token"""
     try:
-        users_file = os.path.join(BASE_DIR, 'users.json')
-        if not os.path.exists(users_file):
+        client_ip = request.client.host if request.client else 'unknown'
+        retry_after = login_retry_after(username, client_ip)
+        if retry_after:
+            raise HTTPException(status_code=429, detail='Too many failed login attempts', headers={'Retry-After': str(retry_after)})
+
+        user = get_user(DB_PATH, username)
+        # Unknown users are still checked against a dummy hash so response time does not reveal them
+        if not await verify_password(password, user['password_hash'] if user else None):
+            record_login_failure(username, client_ip)
             raise HTTPException(status_code=401, detail="Invalid credentials")
+        user_attempts.reset(username)
 
-        with open(users_file, 'r') as f:
-            users = json.load(f)
-
-        if username not in users or not verify_password(password, users[username]['password_hash']):
-            raise HTTPException(status_code=401, detail="Invalid credentials")
+        if needs_rehash(user['password_hash']):
+            try:
+                update_user_password(DB_PATH, username, await hash_password(password))
+                logger.info(f'Rehashed password for {username} at the current cost')
+            except HashingBusy:
+                pass  # retried on the next login
 
-        access_token = create_access_token(data={"sub": username, "role": users[username]['role']})
+        access_token = create_access_token(data={"sub": username, "role": user['role']})
         logger.info(f'User logged in: {username}')
         return {
             'access_token': access_token,
@@ -756,6 +1058,8 @@ async def login(username: str = Form(...), password: str = Form(...)):
         }
     except HTTPException:
         raise
+    except HashingBusy:
+        raise hashing_busy()
     except Exception as e:
         logger.exception('Login failed')
         raise HTTPException(status_code=500, detail=str(e))
@@ -776,23 +1080,19 @@ async def change_password(
 ):
     """Change user password"""
     try:
-        users_file = os.path.join(BASE_DIR, 'users.json')
-        with open(users_file, 'r') as f:
-            users = json.load(f)
-
         username = current_user['sub']
-        if not verify_password(old_password, users[username]['password_hash']):
+        user = get_user(DB_PATH, username)
+        if not user or not await verify_password(old_password, user['password_hash']):
             raise HTTPException(status_code=400, detail="Invalid old password")
 
-        users[username]['password_hash'] = hash_password(new_password)
-
-        with open(users_file, 'w') as f:
-            json.dump(users, f)
+        update_user_password(DB_PATH, username, await hash_password(new_password))
 
         logger.info(f'Password changed for user: {username}')
         return {'message': 'Password changed successfully'}
     except HTTPException:
         raise
+    except HashingBusy:
+        raise hashing_busy()
     except Exception as e:
         logger.exception('Password change failed')
         raise HTTPException(status_code=500, detail=str(e))
@@ -808,14 +1108,44 @@ async def get_asset_version_history(asset_id: int, current_user: dict = Depends(
         logger.exception(f'Failed to get versions for asset {asset_id}')
         raise HTTPException(status_code=500, detail=str(e))
 
-@app.get('/asset/{asset_id}/version/{version}')
-async def get_asset_version(asset_id: int, version: int, current_user: dict = Depends(verify_token)):
-    """Get specific version of an asset"""
+@app.get('/asset/{asset_id}/duplicates')
+async def get_asset_duplicates(asset_id: int, max_distance: int = Query(None, ge=0, le=HASH_BITS),
+                               current_user: dict = Depends(verify_token)):
+    """Find near-duplicate assets by perceptual hash"""
+    try:
+        hashes = get_asset_hash(DB_PATH, asset_id)
+        if hashes is None:
+            # Assets uploaded before hashing existed are indexed on first lookup
+            path = get_asset_path(DB_PATH, asset_id, 1) or get_asset_path(DB_PATH, asset_id)
+            if not path or not os.path.exists(path):
+                raise HTTPException(status_code=404, detail='Asset not found')
+            phash, dhash = compute_image_hashes(path)
+            save_asset_hash(DB_PATH, asset_id, phash, dhash)
+            hashes = {'phash': phash, 'dhash': dhash}
+        duplicates = find_near_duplicates(DB_PATH, hashes['phash'], hashes['dhash'],
+                                          max_distance if max_distance is not None else DUPLICATE_MAX_DISTANCE,
+                                          exclude_id=asset_id)
+        return {'asset_id': asset_id, 'duplicates': duplicates}
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.exception(f'Failed to find duplicates for asset {asset_id}')
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.api_route('/asset/{asset_id}/version/{version}', methods=['GET', 'HEAD'])
+async def get_asset_version(request: Request, asset_id: int, version: int, width: int = RENDITION_WIDTH,
+                            height: int = RENDITION_HEIGHT, fit: str = RENDITION_FIT, format: str = RENDITION_FORMAT,
+                            current_user: dict = Depends(verify_token)):
+    """Get specific version of an asset; the content of a version never changes"""
     try:
-        path = get_asset_path(DB_PATH, asset_id, version)
+        record = get_version_record(DB_PATH, asset_id, version)
+        # In oplog mode resolving replays the version's operations; keep it off the event loop too
+        path = await run_in_threadpool(resolve_version_path, DB_PATH, asset_id, version) if record else None
         if not path or not os.path.exists(path):
             raise HTTPException(status_code=404, detail='Version not found')
-        return FileResponse(path, media_type='image/png')
+        # Rendering is CPU-bound; keep it off the event loop
+        return await run_in_threadpool(asset_file_response, request, path, record['created_at'], True,
+                                       width, height, fit, format)
     except HTTPException:
         raise
     except Exception as e:
@@ -855,18 +1185,13 @@ async def restore_asset_version(
 ):
     """Restore asset to a previous version"""
     try:
-        # Get the path of the version to restore
-        version_path = get_asset_path(DB_PATH, asset_id, version)
+        # Get the path of the version to restore; an oplog version is replayed off the event loop
+        version_path = await run_in_threadpool(resolve_version_path, DB_PATH, asset_id, version)
         if not version_path:
             raise HTTPException(status_code=404, detail='Version not found')
 
-        # Create a copy of the version as new current version
-        import shutil
-        new_path = version_path.replace('.png', f'_restored_v{version}_{int(time.time())}.png')
-        shutil.copy2(version_path, new_path)
-
-        # Save as new version
-        new_version = save_asset_version(DB_PATH, asset_id, new_path, 'restore', json.dumps({'restored_from': version}), current_user['sub'])
+        # Blobs are immutable and content-addressed, so the restored version shares the old file
+        new_version = record_version(DB_PATH, asset_id, version_path, 'restore', json.dumps({'restored_from': version}), current_user['sub'])
 
         return {'new_version': new_version, 'message': f'Asset restored to version {version}'}
     except HTTPException:
@@ -876,89 +1201,17 @@ async def restore_asset_version(
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get('/export_report')
-def export_report(current_user: dict = Depends(verify_token)):
-    assets = list_assets(DB_PATH)
-    total_assets = len(assets)
-
-    # System health data
-    import psutil
-    health_data = {
-        'cpu_percent': psutil.cpu_percent(interval=1),
-        'memory_percent': psutil.virtual_memory().percent,
-        'disk_usage': psutil.disk_usage('/').percent,
-        'uptime_seconds': time.time() - psutil.boot_time(),
-        'gpu_available': GPU_AVAILABLE,
-    }
-
-    # Asset analytics
-    if assets:
-        df = pd.DataFrame(assets)
-        df['uploaded_at'] = pd.to_datetime(df['uploaded_at'], unit='s')
-
-        processed = sum(1 for a in assets if 'processed' in (a.get('label') or '').lower())
-        avg_size = sum(os.path.getsize(a['path']) for a in assets[:min(10, len(assets))]) / (1024 * min(10, len(assets))) if assets else 0
-
-        categories = {'Product': 0, 'Lifestyle': 0, 'Banner': 0, 'Packshot': 0, 'Other': 0}
-        for asset in assets:
-            label = (asset.get('label') or '').lower()
-            if 'product' in label or 'shot' in label:
-                categories['Product'] += 1
-            elif 'lifestyle' in label or 'scene' in label:
-                categories['Lifestyle'] += 1
-            elif 'banner' in label or 'header' in label:
-                categories['Banner'] += 1
-            elif 'packshot' in label or 'package' in label:
-                categories['Packshot'] += 1
-            else:
-                categories['Other'] += 1
-
-        # Upload patterns
-        hourly_uploads = df.groupby(df['uploaded_at'].dt.hour).size()
-        daily_uploads = df.groupby(df['uploaded_at'].dt.date).size()
-
-    # Create comprehensive report data
-    report_data = {
-        'Report_Generated_At': time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(time.time())),
-        'Total_Assets': total_assets,
-        'Processed_Assets': processed if assets else 0,
-        'Processing_Rate_Percent': (processed / total_assets * 100) if total_assets > 0 else 0,
-        'Average_File_Size_KB': avg_size if assets else 0,
-        'Storage_Used_MB': sum(os.path.getsize(asset['path']) for asset in assets) / (1024 * 1024) if assets else 0,
-        'Storage_Estimate_MB': total_assets * 0.15,
-
-        # System Health
-        'CPU_Usage_Percent': health_data['cpu_percent'],
-        'Memory_Usage_Percent': health_data['memory_percent'],
-        'Disk_Usage_Percent': health_data['disk_usage'],
-        'System_Uptime_Hours': health_data['uptime_seconds'] / 3600,
-        'GPU_Available': 'Yes' if health_data['gpu_available'] else 'No',
-
-        # Asset Categories
-        'Product_Assets': categories.get('Product', 0),
-        'Lifestyle_Assets': categories.get('Lifestyle', 0),
-        'Banner_Assets': categories.get('Banner', 0),
-        'Packshot_Assets': categories.get('Packshot', 0),
-        'Other_Assets': categories.get('Other', 0),
-    }
-
-    # Add hourly upload data
-    for hour in range(24):
-        report_data[f'Uploads_Hour_{hour}'] = hourly_uploads.get(hour, 0) if assets else 0
-
-    df_report = pd.DataFrame([report_data])
-    csv_buffer = io.StringIO()
-    df_report.to_csv(csv_buffer, index=False)
-    # Return CSV file
-    csv_buffer.seek(0)
-    response = csv_buffer.getvalue()
-
-    logger.info(f'Comprehensive report exported with {len(report_data)} metrics')
-
-    return {
-        'filename': f'creative_tool_report_{time.strftime("%Y%m%d_%H%M%S")}.csv',
-        'content': response,
-        'metrics_count': len(report_data)
-    }
+def export_report(format: str = 'csv', current_user: dict = Depends(verify_token)):
+    """Comprehensive report with system health as a streamed CSV (or Parquet) download"""
+    try:
+        report = build_report(DB_PATH)
+        logger.info(f"Report exported as {format}: {report['total_assets']} assets")
+        return report_download(report, format)
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f'Report export failed: {str(e)}')
+        raise HTTPException(status_code=500, detail=f'Report export failed: {str(e)}')
 
 if __name__ == '__main__':
     uvicorn.run('backend.main:app', host='0.0.0.0', port=8000, reload=True)
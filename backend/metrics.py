@@ -0,0 +1,261 @@
+import os
+import time
+import bisect
+import threading
+from functools import wraps
+
+# In-process metrics rendered in the Prometheus text exposition format.
+# Label children are resolved once and cached, so an observation costs a
+# dict lookup, a bisect and a short lock hold.
+ENABLE_METRICS = os.getenv('ENABLE_METRICS', 'true').lower() == 'true'
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+_registry = []
+_callbacks = []
+_cache_stats = {}
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format_labels(names, values):
+    if not names:
+        return ''
+    return '{' + ','.join(f'{n}="{_escape(v)}"' for n, v in zip(names, values)) + '}'
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def labels(self, *values):
+        child = self._children.get(values)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(values, self._new_child())
+        return child
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}']
+        for values, child in list(self._children.items()):
+            lines.extend(self._render_child(values, child))
+        return lines
+
+class _Value:
+    __slots__ = ('value', 'lock')
+
+    def __init__(self):
+        self.value = 0.0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1.0):
+        with self.lock:
+            self.value += amount
+
+    def dec(self, amount=1.0):
+        with self.lock:
+            self.value -= amount
+
+    def set(self, value):
+        self.value = value
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def _new_child(self):
+        return _Value()
+
+    def _render_child(self, values, child):
+        return [f'{self.name}{_format_labels(self.labelnames, values)} {child.value}']
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+class _HistogramValue:
+    __slots__ = ('buckets', 'counts', 'sum', 'lock')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[i] += 1
+            self.sum += value
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, help_text, labelnames)
+
+    def _new_child(self):
+        return _HistogramValue(self.buckets)
+
+    def _render_child(self, values, child):
+        with child.lock:
+            counts = list(child.counts)
+            total_sum = child.sum
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += count
+            le = '+Inf' if bound == float('inf') else repr(bound)
+            lines.append(f'{self.name}_bucket{_format_labels(self.labelnames + ("le",), values + (le,))} {cumulative}')
+        labels = _format_labels(self.labelnames, values)
+        lines.append(f'{self.name}_sum{labels} {total_sum}')
+        lines.append(f'{self.name}_count{labels} {cumulative}')
+        return lines
+
+class _CacheCounter(Counter):
+    """cache_requests_total, plus caches that keep their own hit/miss counts (e.g. lru_cache)"""
+
+    def render(self):
+        lines = super().render()
+        for cache, fn in list(_cache_stats.items()):
+            try:
+                hits, misses, _ = fn()
+            except Exception:
+                continue
+            if hits is None:
+                continue
+            for result, value in (('hit', hits), ('miss', misses)):
+                lines.append(f'{self.name}{_format_labels(self.labelnames, (cache, result))} {value}')
+        return lines
+
+def register_cache(cache, fn):
+    """Report a cache at scrape time; fn returns (hits, misses, entries), hits/misses may be None"""
+    _cache_stats[cache] = fn
+
+def _cache_entries():
+    entries = {}
+    for cache, fn in list(_cache_stats.items()):
+        entries[(cache,)] = fn()[2]
+    return entries
+
+def register_callback(name, help_text, kind, labelnames, fn):
+    """Expose values computed at scrape time; fn returns {label_values_tuple: number}"""
+    _callbacks.append((name, help_text, kind, tuple(labelnames), fn))
+
+def render() -> str:
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    for name, help_text, kind, labelnames, fn in _callbacks:
+        try:
+            values = fn()
+        except Exception:
+            continue
+        lines.extend([f'# HELP {name} {help_text}', f'# TYPE {name} {kind}'])
+        for label_values, value in values.items():
+            lines.append(f'{name}{_format_labels(labelnames, label_values)} {value}')
+    return '\n'.join(lines) + '\n'
+
+HTTP_REQUESTS = Counter('http_requests_total', 'HTTP requests by route and status', ('method', 'route', 'status'))
+HTTP_LATENCY = Histogram('http_request_duration_seconds', 'HTTP request latency by route', ('method', 'route'))
+HTTP_INFLIGHT = Gauge('http_requests_in_flight', 'HTTP requests currently being served')
+STAGE_LATENCY = Histogram('stage_duration_seconds', 'Latency of internal processing stages', ('stage',))
+STAGE_ERRORS = Counter('stage_errors_total', 'Internal processing stages that raised', ('stage',))
+QUEUE_DEPTH = Gauge('queue_depth', 'Work waiting for or holding a bounded resource', ('queue',))
+CACHE_REQUESTS = _CacheCounter('cache_requests_total', 'Cache lookups by result', ('cache', 'result'))
+
+register_callback('cache_entries', 'Entries held by in-process caches', 'gauge', ('cache',), _cache_entries)
+
+def observe_request(method, route, status, seconds):
+    HTTP_REQUESTS.labels(method, route, str(status)).inc()
+    HTTP_LATENCY.labels(method, route).observe(seconds)
+
+def cache_lookup(cache, hit):
+    if ENABLE_METRICS:
+        CACHE_REQUESTS.labels(cache, 'hit' if hit else 'miss').inc()
+
+class _StageTimer:
+    __slots__ = ('histogram', 'errors', 'start')
+
+    def __init__(self, stage):
+        self.histogram = STAGE_LATENCY.labels(stage)
+        self.errors = STAGE_ERRORS.labels(stage)
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.histogram.observe(time.perf_counter() - self.start)
+        if exc_type is not None:
+            self.errors.inc()
+        return False
+
+class _NullTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+_NULL_TIMER = _NullTimer()
+
+def stage_timer(stage):
+    """Context manager recording the enclosed block under stage_duration_seconds{stage=...}"""
+    return _StageTimer(stage) if ENABLE_METRICS else _NULL_TIMER
+
+class queued:
+    """Count a caller in queue_depth{queue=...} for the duration of the block"""
+    __slots__ = ('gauge',)
+
+    def __init__(self, queue):
+        self.gauge = QUEUE_DEPTH.labels(queue) if ENABLE_METRICS else None
+
+    def __enter__(self):
+        if self.gauge is not None:
+            self.gauge.inc()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if self.gauge is not None:
+            self.gauge.dec()
+        return False
+
+def timed(stage):
+    """Decorator form of stage_timer"""
+    def decorator(fn):
+        if not ENABLE_METRICS:
+            return fn
+        histogram = STAGE_LATENCY.labels(stage)
+        errors = STAGE_ERRORS.labels(stage)
+
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            except Exception:
+                errors.inc()
+                raise
+            finally:
+                histogram.observe(time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+def instrument_module(namespace, prefix, names=None):
+    """Wrap a module's public functions with timed('<prefix>.<name>').
+
+    Call at the bottom of the module with globals(); later `from module import fn`
+    imports then pick up the instrumented functions.
+    """
+    module_name = namespace['__name__']
+    for name in names or list(namespace):
+        fn = namespace[name]
+        if name.startswith('_') or not callable(fn) or isinstance(fn, type) \
+                or getattr(fn, '__module__', None) != module_name:
+            continue
+        namespace[name] = timed(f'{prefix}.{name}')(fn)
@@ -0,0 +1,164 @@
+import os
+import threading
+import logging
+from functools import lru_cache
+from typing import Dict
+import numpy as np
+from PIL import Image, ImageOps
+import pytesseract
+from metrics import timed, register_cache
+
+try:
+    import tesserocr
+except ImportError:
+    tesserocr = None
+
+logger = logging.getLogger('creative_tool')
+
+# 'auto' uses resident tesserocr engines when the bindings are installed,
+# 'pytesseract' forces the subprocess path, 'tesserocr' requires the bindings.
+OCR_BACKEND = os.getenv('OCR_BACKEND', 'auto').lower()
+OCR_LANG = os.getenv('OCR_LANG', 'eng')
+TESSDATA_PATH = os.getenv('TESSDATA_PREFIX')
+OCR_CACHE_SIZE = int(os.getenv('OCR_CACHE_SIZE', '256'))
+
+# One initialized engine per worker thread; TessBaseAPI is not thread-safe
+_local = threading.local()
+_engines = []
+_engines_lock = threading.Lock()
+_pool_disabled = False
+
+def _create_engine():
+    kwargs = {'lang': OCR_LANG}
+    if TESSDATA_PATH:
+        kwargs['path'] = TESSDATA_PATH
+    api = tesserocr.PyTessBaseAPI(**kwargs)
+    with _engines_lock:
+        _engines.append(api)
+    return api
+
+def _get_engine():
+    """Return this thread's resident engine, or None when the pool is unusable"""
+    global _pool_disabled
+    if _pool_disabled:
+        return None
+    api = getattr(_local, 'api', None)
+    if api is None:
+        try:
+            api = _create_engine()
+        except Exception as e:
+            if OCR_BACKEND == 'tesserocr':
+                raise
+            logger.warning(f'tesserocr engine init failed, falling back to pytesseract: {e}')
+            _pool_disabled = True
+            return None
+        _local.api = api
+    return api
+
+def active_backend() -> str:
+    if OCR_BACKEND == 'tesserocr' and tesserocr is None:
+        raise RuntimeError('OCR_BACKEND=tesserocr but tesserocr is not installed')
+    if OCR_BACKEND == 'pytesseract' or tesserocr is None or _pool_disabled:
+        return 'pytesseract'
+    return 'tesserocr'
+
+def _to_pil(image) -> Image.Image:
+    """Accept PIL images, file paths and OpenCV (BGR/BGRA) arrays"""
+    if isinstance(image, Image.Image):
+        return image
+    if isinstance(image, np.ndarray):
+        if image.ndim == 3 and image.shape[2] == 3:
+            image = image[:, :, ::-1]
+        elif image.ndim == 3 and image.shape[2] == 4:
+            image = image[:, :, [2, 1, 0, 3]]
+        return Image.fromarray(np.ascontiguousarray(image))
+    return Image.open(image)
+
+@timed('model.ocr')
+def image_to_string(image, backend: str = None) -> str:
+    """OCR an image, reusing this thread's tesseract engine when available"""
+    pil_img = _to_pil(image)
+    backend = backend or active_backend()
+    if backend == 'tesserocr':
+        api = _get_engine()
+        if api is not None:
+            api.SetImage(pil_img)
+            text = api.GetUTF8Text()
+            api.Clear()
+            return text
+    return pytesseract.image_to_string(pil_img, lang=OCR_LANG)
+
+def _parse_tsv(tsv: str) -> Dict:
+    """Turn tesseract TSV output into word boxes plus the reconstructed text"""
+    words = []
+    lines = {}
+    for row in tsv.splitlines():
+        cols = row.split('\t')
+        # Skip the header row (pytesseract) and non-word levels
+        if len(cols) < 12 or not cols[0].isdigit() or cols[0] != '5':
+            continue
+        text = cols[11].strip()
+        if not text:
+            continue
+        line_key = (int(cols[2]), int(cols[3]), int(cols[4]))
+        word = {
+            'text': text,
+            'left': int(cols[6]),
+            'top': int(cols[7]),
+            'width': int(cols[8]),
+            'height': int(cols[9]),
+            'conf': float(cols[10]),
+            'line': line_key
+        }
+        words.append(word)
+        lines.setdefault(line_key, []).append(text)
+    return {
+        'text': '\n'.join(' '.join(line) for line in lines.values()),
+        'words': words
+    }
+
+@timed('model.ocr')
+def image_to_data(image, backend: str = None) -> Dict:
+    """Single OCR pass returning {'text', 'words'} with per-word boxes and confidences"""
+    pil_img = _to_pil(image)
+    backend = backend or active_backend()
+    if backend == 'tesserocr':
+        api = _get_engine()
+        if api is not None:
+            api.SetImage(pil_img)
+            tsv = api.GetTSVText(0)
+            api.Clear()
+            return _parse_tsv(tsv or '')
+    return _parse_tsv(pytesseract.image_to_data(pil_img, lang=OCR_LANG))
+
+@lru_cache(maxsize=OCR_CACHE_SIZE)
+def _ocr_file_cached(path: str, mtime_ns: int, size: int) -> Dict:
+    # Word boxes in display orientation, matching the EXIF-oriented sizes callers compare them with
+    with Image.open(path) as img:
+        return image_to_data(ImageOps.exif_transpose(img))
+
+def _cache_stats():
+    info = _ocr_file_cached.cache_info()
+    return info.hits, info.misses, info.currsize
+
+register_cache('ocr', _cache_stats)
+
+def ocr_file(path) -> Dict:
+    """Cached image_to_data for a file on disk, keyed by path, mtime and size.
+
+    The returned dict is shared between callers and must be treated as read-only.
+    """
+    st = os.stat(path)
+    return _ocr_file_cached(str(path), st.st_mtime_ns, st.st_size)
+
+def shutdown():
+    """Release all resident engines; later calls use the pytesseract path"""
+    global _pool_disabled
+    _pool_disabled = True
+    with _engines_lock:
+        for api in _engines:
+            try:
+                api.End()
+            except Exception:
+                pass
+        _engines.clear()
@@ -0,0 +1,173 @@
+import os
+import time
+import socket
+import asyncio
+import ipaddress
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import bcrypt
+from metrics import queued, stage_timer
+
+# bcrypt work factor for new hashes; stored hashes with another cost are rehashed on login
+BCRYPT_ROUNDS = int(os.getenv('BCRYPT_ROUNDS', '12'))
+# Threads dedicated to hashing, so a login burst cannot occupy the shared request pool.
+# bcrypt releases the GIL while hashing, so these run in parallel with request handling.
+PASSWORD_HASH_WORKERS = int(os.getenv('PASSWORD_HASH_WORKERS', str(max(1, (os.cpu_count() or 2) // 2))))
+# Hashes queued or running beyond this are refused rather than left to pile up
+PASSWORD_HASH_QUEUE_LIMIT = int(os.getenv('PASSWORD_HASH_QUEUE_LIMIT', str(PASSWORD_HASH_WORKERS * 16)))
+LOGIN_MAX_ATTEMPTS = int(os.getenv('LOGIN_MAX_ATTEMPTS', '5'))
+# Higher than the per-user limit because an office shares one address behind NAT
+LOGIN_MAX_ATTEMPTS_PER_IP = int(os.getenv('LOGIN_MAX_ATTEMPTS_PER_IP', '50'))
+LOGIN_WINDOW_SECONDS = int(os.getenv('LOGIN_WINDOW_SECONDS', '300'))
+# Comma-separated IPs, CIDRs or hostnames of proxies that submit logins on behalf of many
+# users (the Streamlit frontend); their failures count only against the per-user limit
+LOGIN_TRUSTED_PROXIES = [p.strip() for p in os.getenv('LOGIN_TRUSTED_PROXIES', '').split(',') if p.strip()]
+# Hostnames in LOGIN_TRUSTED_PROXIES are re-resolved this often, since container addresses change
+TRUSTED_PROXY_RESOLVE_SECONDS = 60
+
+_executor = ThreadPoolExecutor(max_workers=PASSWORD_HASH_WORKERS, thread_name_prefix='bcrypt')
+_slots = threading.BoundedSemaphore(PASSWORD_HASH_QUEUE_LIMIT)
+
+# Compared against when the username does not exist, so unknown users cost the same as known ones
+_DUMMY_HASH = bcrypt.hashpw(b'unused', bcrypt.gensalt(BCRYPT_ROUNDS))
+
+class HashingBusy(Exception):
+    """Raised when the hashing queue is full"""
+
+def _hash(password: str) -> str:
+    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(BCRYPT_ROUNDS)).decode('utf-8')
+
+def _check(password: str, hashed: str) -> bool:
+    return bcrypt.checkpw(password.encode('utf-8'), hashed.encode('utf-8'))
+
+def _run_bounded(fn, *args):
+    if not _slots.acquire(blocking=False):
+        raise HashingBusy()
+    # Counted from submission, so queue_depth{queue="bcrypt"} includes hashes still waiting for a thread
+    depth = queued('bcrypt').__enter__()
+
+    def task():
+        try:
+            with stage_timer('auth.bcrypt'):
+                return fn(*args)
+        finally:
+            depth.__exit__(None, None, None)
+            _slots.release()
+    try:
+        return asyncio.get_running_loop().run_in_executor(_executor, task)
+    except Exception:
+        depth.__exit__(None, None, None)
+        _slots.release()
+        raise
+
+async def hash_password(password: str) -> str:
+    return await _run_bounded(_hash, password)
+
+async def verify_password(password: str, hashed: str = None) -> bool:
+    """Check a password off the event loop; hashed=None burns equivalent time and returns False"""
+    if hashed is None:
+        await _run_bounded(bcrypt.checkpw, password.encode('utf-8'), _DUMMY_HASH)
+        return False
+    return await _run_bounded(_check, password, hashed)
+
+def needs_rehash(hashed: str) -> bool:
+    """True if a stored hash was made with a different cost than BCRYPT_ROUNDS"""
+    try:
+        return int(hashed.split('$')[2]) != BCRYPT_ROUNDS
+    except (IndexError, ValueError):
+        return True
+
+class AttemptLimiter:
+    """Sliding-window failure counter per key; in-memory, so each worker process limits on its own"""
+
+    def __init__(self, max_attempts, window=LOGIN_WINDOW_SECONDS):
+        self.max_attempts = max_attempts
+        self.window = window
+        self._failures = {}
+        self._lock = threading.Lock()
+
+    def _prune(self, key, now):
+        failures = self._failures.get(key)
+        while failures and failures[0] <= now - self.window:
+            failures.popleft()
+        if failures is not None and not failures:
+            del self._failures[key]
+        return failures
+
+    def retry_after(self, key) -> int:
+        """Seconds until key may try again; 0 if it is not limited"""
+        now = time.time()
+        with self._lock:
+            failures = self._prune(key, now)
+            if failures and len(failures) >= self.max_attempts:
+                return int(failures[0] + self.window - now) + 1
+        return 0
+
+    def record_failure(self, key):
+        with self._lock:
+            self._failures.setdefault(key, deque(maxlen=self.max_attempts)).append(time.time())
+
+    def reset(self, key):
+        with self._lock:
+            self._failures.pop(key, None)
+
+user_attempts = AttemptLimiter(LOGIN_MAX_ATTEMPTS)
+ip_attempts = AttemptLimiter(LOGIN_MAX_ATTEMPTS_PER_IP)
+
+_trusted = []  # networks for LOGIN_TRUSTED_PROXIES, hostnames resolved by the resolver thread
+_resolver_stop = threading.Event()
+_resolver = None
+
+def refresh_trusted_proxies():
+    """Re-resolve LOGIN_TRUSTED_PROXIES; blocking DNS, so never called on the event loop"""
+    global _trusted
+    networks = []
+    for entry in LOGIN_TRUSTED_PROXIES:
+        try:
+            networks.append(ipaddress.ip_network(entry, strict=False))
+            continue
+        except ValueError:
+            pass
+        try:
+            networks.extend(ipaddress.ip_network(addr) for addr in socket.gethostbyname_ex(entry)[2])
+        except OSError:
+            # Not resolvable right now (e.g. the container is restarting); retried next period
+            pass
+    _trusted = networks
+
+def _resolve_loop():
+    while not _resolver_stop.wait(TRUSTED_PROXY_RESOLVE_SECONDS):
+        refresh_trusted_proxies()
+
+def start_proxy_resolver():
+    """Resolve trusted proxies now, then keep hostnames current from a background thread"""
+    global _resolver
+    refresh_trusted_proxies()
+    if _resolver is None and LOGIN_TRUSTED_PROXIES:
+        _resolver = threading.Thread(target=_resolve_loop, name='trusted-proxy-resolver', daemon=True)
+        _resolver.start()
+
+def is_trusted_proxy(client_ip: str) -> bool:
+    if not LOGIN_TRUSTED_PROXIES:
+        return False
+    try:
+        addr = ipaddress.ip_address(client_ip)
+    except ValueError:
+        return False
+    return any(addr in network for network in _trusted)
+
+def login_retry_after(username: str, client_ip: str) -> int:
+    retry_after = user_attempts.retry_after(username)
+    if not is_trusted_proxy(client_ip):
+        retry_after = max(retry_after, ip_attempts.retry_after(client_ip))
+    return retry_after
+
+def record_login_failure(username: str, client_ip: str):
+    user_attempts.record_failure(username)
+    if not is_trusted_proxy(client_ip):
+        ip_attempts.record_failure(client_ip)
+
+def shutdown():
+    _resolver_stop.set()
+    _executor.shutdown(wait=False, cancel_futures=True)
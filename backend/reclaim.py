@@ -0,0 +1,139 @@
+import os
+import time
+import uuid
+import logging
+import threading
+from db import select_reclaimable_versions, delete_asset_versions, delete_blob_rows, list_version_paths, count_assets_before
+from utils import UPLOAD_DIR, GENERATED_DIR, MASK_DIR
+import blobstore
+from metrics import queued
+
+logger = logging.getLogger('creative_tool')
+
+RECLAIM_KEEP_VERSIONS = int(os.getenv('RECLAIM_KEEP_VERSIONS', '5'))
+# Deletions happen in batches with a pause in between so serving latency is not affected
+RECLAIM_BATCH_SIZE = int(os.getenv('RECLAIM_BATCH_SIZE', '200'))
+RECLAIM_BATCH_PAUSE = float(os.getenv('RECLAIM_BATCH_PAUSE', '0.05'))
+# Pre-blob-store directories whose files may be intermediates no version points at
+LEGACY_DIRS = [UPLOAD_DIR, GENERATED_DIR]
+
+_jobs = {}
+_jobs_lock = threading.Lock()
+_run_lock = threading.Lock()
+
+def _orphaned_files(db_path, cutoff):
+    """Legacy intermediates (_resized.png, _rot90.png, ...) and stale masks older than cutoff"""
+    referenced = set(list_version_paths(db_path))
+    orphans = []
+    for directory in LEGACY_DIRS + [MASK_DIR]:
+        if not directory.exists():
+            continue
+        for f in directory.iterdir():
+            if not f.is_file() or str(f) in referenced:
+                continue
+            st = f.stat()
+            if st.st_mtime < cutoff:
+                orphans.append((str(f), st.st_size))
+    return orphans
+
+def plan_reclamation(db_path, days=30, keep_last=None, keep_commented=True):
+    """Dry-run diff: which versions and files a reclamation pass would remove"""
+    keep_last = RECLAIM_KEEP_VERSIONS if keep_last is None else keep_last
+    cutoff = time.time() - days * 24 * 60 * 60
+    versions = select_reclaimable_versions(db_path, keep_last, cutoff, keep_commented)
+
+    # A blob is only freed once every keyframe version referencing it is reclaimed
+    releases, sizes, refcounts = {}, {}, {}
+    for v in versions:
+        if v['is_keyframe']:
+            releases[v['path']] = releases.get(v['path'], 0) + 1
+            sizes[v['path']] = v['size']
+            refcounts[v['path']] = v['refcount']
+    version_bytes = sum(sizes[p] for p, n in releases.items() if n >= refcounts[p])
+
+    orphans = _orphaned_files(db_path, cutoff)
+    return {
+        'days': days,
+        'keep_last': keep_last,
+        'keep_commented': keep_commented,
+        'found_old_assets': count_assets_before(db_path, cutoff),
+        'would_delete': sorted({v['asset_id'] for v in versions}),
+        'versions': [{'asset_id': v['asset_id'], 'version': v['version'], 'path': v['path'], 'bytes': v['size']}
+                     for v in versions],
+        'orphaned_files': [p for p, _ in orphans],
+        'bytes_reclaimable': version_bytes + sum(size for _, size in orphans),
+        '_version_ids': [v['id'] for v in versions],
+        '_orphans': orphans
+    }
+
+def _update(job_id, **fields):
+    with _jobs_lock:
+        _jobs[job_id].update(fields)
+
+def _delete_files(job_id, paths):
+    """Delete files in batches, pausing between batches; progress goes to the job record"""
+    for i, path in enumerate(paths, 1):
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+        except FileNotFoundError:
+            continue
+        with _jobs_lock:
+            _jobs[job_id]['files_deleted'] += 1
+            _jobs[job_id]['bytes_reclaimed'] += size
+        if i % RECLAIM_BATCH_SIZE == 0:
+            time.sleep(RECLAIM_BATCH_PAUSE)
+
+def _run(job_id, db_path, plan):
+    try:
+        with queued('reclaim'), _run_lock:
+            _update(job_id, state='running')
+            unreferenced = delete_asset_versions(db_path, plan['_version_ids'])
+            _update(job_id, versions_deleted=len(plan['_version_ids']))
+            # Recently written blobs may be about to gain a reference again through
+            # put_file's dedupe; leave those to the grace-period blob GC below
+            grace_cutoff = time.time() - blobstore.BLOB_GC_GRACE_SECONDS
+            removable = [p for p in unreferenced
+                         if os.path.exists(p) and (not blobstore.is_blob(p) or os.path.getmtime(p) < grace_cutoff)]
+            _delete_files(job_id, removable)
+            delete_blob_rows(db_path, removable)
+            _delete_files(job_id, [p for p, _ in plan['_orphans']])
+
+            gc = blobstore.collect_garbage(db_path, batch_size=RECLAIM_BATCH_SIZE, pause=RECLAIM_BATCH_PAUSE)
+            with _jobs_lock:
+                _jobs[job_id]['files_deleted'] += gc['removed_files']
+                _jobs[job_id]['bytes_reclaimed'] += gc['bytes_freed']
+        _update(job_id, state='success', finished_at=time.time())
+        logger.info(f'Reclamation {job_id} completed: {_jobs[job_id]}')
+    except Exception as e:
+        _update(job_id, state='error', finished_at=time.time(), error=str(e))
+        logger.exception(f'Reclamation {job_id} failed')
+
+def start_reclamation(db_path, days=30, keep_last=None, keep_commented=True) -> dict:
+    """Plan, then delete in a background thread; returns the job record"""
+    plan = plan_reclamation(db_path, days, keep_last, keep_commented)
+    job_id = uuid.uuid4().hex[:12]
+    job = {
+        'job_id': job_id,
+        'state': 'queued',
+        'started_at': time.time(),
+        'finished_at': None,
+        'versions_planned': len(plan['_version_ids']),
+        'versions_deleted': 0,
+        'files_deleted': 0,
+        'bytes_reclaimable': plan['bytes_reclaimable'],
+        'bytes_reclaimed': 0,
+        'error': None
+    }
+    with _jobs_lock:
+        _jobs[job_id] = job
+    threading.Thread(target=_run, args=(job_id, db_path, plan), name=f'reclaim-{job_id}', daemon=True).start()
+    return dict(job)
+
+def get_reclamation_job(job_id) -> dict:
+    with _jobs_lock:
+        job = _jobs.get(job_id)
+        return dict(job) if job else None
+
+def public_plan(plan) -> dict:
+    return {k: v for k, v in plan.items() if not k.startswith('_')}
@@ -0,0 +1,157 @@
+import os
+import time
+import uuid
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from PIL import Image, ImageOps
+from metrics import cache_lookup, register_cache, stage_timer
+from largeimage import open_image, open_reduced, oriented_size, contain_size, resample
+
+# Resized/transcoded copies of stored images, keyed by (source sha256, params).
+# Entries are files under RENDITION_DIR; the least recently served are removed
+# once the directory exceeds RENDITION_CACHE_MAX_BYTES.
+BASE = Path(os.getenv('BASE_DIR', Path(__file__).resolve().parent.parent / "storage"))
+RENDITION_DIR = BASE / "renditions"
+RENDITION_CACHE_MAX_BYTES = int(os.getenv('RENDITION_CACHE_MAX_BYTES', str(512 * 1024 * 1024)))
+RENDITION_MAX_DIMENSION = int(os.getenv('RENDITION_MAX_DIMENSION', '4096'))
+# Entries served this recently are not evicted, so a response is not left pointing at a removed file
+RENDITION_EVICT_GRACE_SECONDS = float(os.getenv('RENDITION_EVICT_GRACE_SECONDS', '30'))
+
+FITS = ('contain', 'cover', 'fill')
+FORMATS = {'webp': 'image/webp', 'avif': 'image/avif', 'jpeg': 'image/jpeg', 'png': 'image/png'}
+_SAVE_OPTIONS = {
+    'webp': {'quality': int(os.getenv('RENDITION_WEBP_QUALITY', '80')), 'method': 4},
+    'avif': {'quality': int(os.getenv('RENDITION_AVIF_QUALITY', '60')), 'speed': 8},
+    'jpeg': {'quality': int(os.getenv('RENDITION_JPEG_QUALITY', '85')), 'optimize': True, 'progressive': True},
+    'png': {'compress_level': 6},
+}
+
+RENDITION_DIR.mkdir(parents=True, exist_ok=True)
+
+_index = OrderedDict()  # path -> size, least recently served first
+_index_bytes = 0
+_served = {}  # path -> monotonic time last returned by get_rendition
+_index_lock = threading.Lock()
+_key_locks = {}
+register_cache('rendition', lambda: (None, None, len(_index)))
+
+def _load_index():
+    global _index_bytes
+    entries = []
+    for f in RENDITION_DIR.rglob('*'):
+        if f.is_file() and not f.name.startswith('.'):
+            st = f.stat()
+            entries.append((st.st_mtime, str(f), st.st_size))
+    for _, path, size in sorted(entries):
+        _index[path] = size
+        _index_bytes += size
+
+_load_index()
+
+def negotiate_format(accept: str, has_alpha: bool) -> str:
+    """Best output format the client accepts: AVIF, then WebP, else PNG for transparency and JPEG otherwise"""
+    accept = (accept or '').lower()
+    for fmt in ('avif', 'webp'):
+        if f'image/{fmt}' in accept:
+            return fmt
+    return 'png' if has_alpha else 'jpeg'
+
+def _has_alpha(img) -> bool:
+    return img.mode in ('RGBA', 'LA', 'PA') or (img.mode == 'P' and 'transparency' in img.info)
+
+def source_has_alpha(path) -> bool:
+    with open_image(path) as img:
+        return _has_alpha(img)
+
+def source_format(path) -> str:
+    """The source's own format when renditions can encode it, else PNG for transparency and JPEG otherwise"""
+    with open_image(path) as img:
+        fmt = 'jpeg' if img.format == 'MPO' else (img.format or '').lower()
+        if fmt in FORMATS:
+            return fmt
+        return 'png' if _has_alpha(img) else 'jpeg'
+
+def rendition_path(digest: str, width, height, fit: str, fmt: str) -> Path:
+    return RENDITION_DIR / digest[:2] / f'{digest}_{width or 0}x{height or 0}_{fit}.{fmt}'
+
+def _render(src_path, dest: Path, width, height, fit, fmt):
+    with stage_timer('rendition.render'):
+        w, h = oriented_size(src_path)
+        # Never upscale: the box is clamped to the source size
+        box = (min(width or w, w), min(height or h, h))
+        if width and not height:
+            box = (box[0], max(1, round(h * box[0] / w)))
+        elif height and not width:
+            box = (max(1, round(w * box[1] / h)), box[1])
+        scale = min(box[0] / w, box[1] / h) if fit == 'contain' else max(box[0] / w, box[1] / h)
+
+        # Reduced-decode source plus the transposed/resized working copies
+        with open_reduced(src_path, scale, copies=2) as img:
+            img = ImageOps.exif_transpose(img)
+            if fit == 'cover':
+                img = ImageOps.fit(img, box, Image.LANCZOS)
+            elif fit == 'fill':
+                img = resample(img, box)
+            else:
+                img = resample(img, contain_size((w, h), box))
+
+            if fmt == 'jpeg' and img.mode != 'RGB':
+                background = Image.new('RGB', img.size, 'white')
+                background.paste(img.convert('RGBA'), mask=img.convert('RGBA').getchannel('A'))
+                img = background
+            elif img.mode not in ('RGB', 'RGBA', 'L', 'LA'):
+                img = img.convert('RGBA' if _has_alpha(img) else 'RGB')
+
+            dest.parent.mkdir(parents=True, exist_ok=True)
+            tmp = dest.parent / f'.{uuid.uuid4().hex}.{fmt}'
+            img.save(tmp, format=fmt.upper(), **_SAVE_OPTIONS[fmt])
+            os.replace(tmp, dest)
+
+def _evict():
+    global _index_bytes
+    recent = time.monotonic() - RENDITION_EVICT_GRACE_SECONDS
+    while _index_bytes > RENDITION_CACHE_MAX_BYTES and len(_index) > 1:
+        path = next(iter(_index))
+        if _served.get(path, 0) > recent:
+            # Everything after it was served more recently still; go over budget until they age out
+            break
+        size = _index.pop(path)
+        _served.pop(path, None)
+        _index_bytes -= size
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+def get_rendition(src_path, digest: str, width=None, height=None, fit='contain', fmt='webp') -> str:
+    """Path to the rendition of a source image, rendering and caching it on first request"""
+    global _index_bytes
+    dest = rendition_path(digest, width, height, fit, fmt)
+    key = str(dest)
+    with _index_lock:
+        hit = key in _index and dest.exists()
+        if hit:
+            _index.move_to_end(key)
+            _served[key] = time.monotonic()
+        lock = _key_locks.setdefault(key, threading.Lock())
+    cache_lookup('rendition', hit)
+    if hit:
+        return key
+
+    # One render per key; concurrent requests for the same rendition wait for it
+    with lock:
+        if not dest.exists():
+            _render(src_path, dest, width, height, fit, fmt)
+        size = dest.stat().st_size
+        with _index_lock:
+            _index_bytes += size - _index.pop(key, 0)
+            _index[key] = size
+            _served[key] = time.monotonic()
+            _key_locks.pop(key, None)
+            _evict()
+    return key
+
+def rendition_etag(digest: str, width, height, fit: str, fmt: str) -> str:
+    """Renditions are deterministic in (source, params), so their ETag needs no read of the output"""
+    return f'"{digest}-{width or 0}x{height or 0}-{fit}.{fmt}"'
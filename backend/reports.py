@@ -0,0 +1,101 @@
+import io
+import csv
+import time
+from db import get_rollup, get_storage_totals, rebuild_rollups, LABEL_CATEGORIES
+
+REPORT_FORMATS = {'csv': 'text/csv', 'parquet': 'application/vnd.apache.parquet'}
+TOP_LABELS = 10
+
+def build_report(db_path) -> dict:
+    """Summary figures read from the analytics rollups; cost does not grow with the asset count"""
+    categories = {name: 0 for name, _ in LABEL_CATEGORIES}
+    categories['Other'] = 0
+    total = uploaded_bytes = 0
+    for category, count, nbytes in get_rollup(db_path, 'category'):
+        categories[category] = count
+        total += count
+        uploaded_bytes += nbytes
+    processed = sum(count for _, count, _ in get_rollup(db_path, 'processed'))
+
+    hourly = [0] * 24
+    for hour, count, _ in get_rollup(db_path, 'upload_hour'):
+        hourly[int(hour)] = count
+    storage = get_storage_totals(db_path)
+    return {
+        'generated_at': time.time(),
+        'total_assets': total,
+        'processed_assets': processed,
+        'processing_rate': (processed / total * 100) if total > 0 else 0,
+        'average_file_size_kb': uploaded_bytes / total / 1024 if total else 0,
+        'storage_used_mb': storage['storage_bytes'] / (1024 * 1024),
+        'storage_estimate_mb': total * 0.15,
+        'categories': categories,
+        'hourly_uploads': hourly,
+        'daily_uploads': {day: count for day, count, _ in get_rollup(db_path, 'upload_day')},
+        'top_labels': {label: count for label, count, _ in get_rollup(db_path, 'label', order_by_count=True, limit=TOP_LABELS) if label},
+        'versions_by_user': {user: count for user, count, _ in get_rollup(db_path, 'user_versions', order_by_count=True)}
+    }
+
+def report_rows(report: dict, health: dict = None):
+    """Flatten a report into (section, metric, value) rows"""
+    yield 'summary', 'Report_Generated_At', time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(report['generated_at']))
+    yield 'summary', 'Total_Assets', report['total_assets']
+    yield 'summary', 'Processed_Assets', report['processed_assets']
+    yield 'summary', 'Processing_Rate_Percent', round(report['processing_rate'], 2)
+    yield 'summary', 'Average_File_Size_KB', round(report['average_file_size_kb'], 2)
+    yield 'summary', 'Storage_Used_MB', round(report['storage_used_mb'], 2)
+    yield 'summary', 'Storage_Estimate_MB', round(report['storage_estimate_mb'], 2)
+    if health:
+        yield 'system', 'CPU_Usage_Percent', health['cpu_percent']
+        yield 'system', 'Memory_Usage_Percent', health['memory_percent']
+        yield 'system', 'Disk_Usage_Percent', health['disk_usage']
+        yield 'system', 'System_Uptime_Hours', round(health['uptime_seconds'] / 3600, 2)
+        yield 'system', 'GPU_Available', 'Yes' if health.get('gpu_available') else 'No'
+    for category, count in report['categories'].items():
+        yield 'category', f'{category}_Assets', count
+    for hour, count in enumerate(report['hourly_uploads']):
+        yield 'hourly_uploads', f'Uploads_Hour_{hour}', count
+    for day, count in report['daily_uploads'].items():
+        yield 'daily_uploads', day, count
+    for label, count in report['top_labels'].items():
+        yield 'top_labels', label, count
+    for user, count in report['versions_by_user'].items():
+        yield 'versions_by_user', user, count
+
+def stream_csv(rows, chunk_rows: int = 500):
+    """Yield CSV text in chunks as rows are produced"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(['section', 'metric', 'value'])
+    for i, row in enumerate(rows, 1):
+        writer.writerow(row)
+        if i % chunk_rows == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+def to_parquet(rows) -> bytes:
+    """Parquet bytes for the report rows; values are stored as strings so one column holds every metric"""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    sections, metrics, values = [], [], []
+    for section, metric, value in rows:
+        sections.append(section)
+        metrics.append(metric)
+        values.append(str(value))
+    table = pa.table({'section': sections, 'metric': metrics, 'value': values})
+    sink = io.BytesIO()
+    pq.write_table(table, sink)
+    return sink.getvalue()
+
+if __name__ == '__main__':
+    import os
+    import argparse
+    from pathlib import Path
+    parser = argparse.ArgumentParser(description='Analytics rollup maintenance')
+    parser.add_argument('command', choices=['rebuild'])
+    base = Path(os.getenv('BASE_DIR', Path(__file__).resolve().parent.parent / "storage"))
+    parser.add_argument('--db', default=os.getenv('DB_PATH', str(base / "assets.db")))
+    args = parser.parse_args()
+    print(f'{rebuild_rollups(args.db)} rollup rows rebuilt')
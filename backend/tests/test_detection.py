@@ -0,0 +1,18 @@
+from PIL import Image
+from detection import detect_batch, DETECTION_INPUT_SIZE
+
+def fake_detector(canvases, batch_size=None):
+    # One box over the right half of the letterboxed content, in canvas coordinates
+    return [[{'label': 'bottle', 'score': 0.9,
+              'box': {'xmin': DETECTION_INPUT_SIZE // 2, 'ymin': 0, 'xmax': DETECTION_INPUT_SIZE, 'ymax': 300}}]
+            for _ in canvases]
+
+def test_detect_batch_leaves_reused_jpeg_untouched(tmp_path):
+    path = tmp_path / 'large.jpg'
+    Image.new('RGB', (4000, 3000), 'white').save(path, quality=50)
+    with Image.open(path) as img:
+        first = detect_batch(fake_detector, [img])
+        second = detect_batch(fake_detector, [img])
+        assert img.size == (4000, 3000)
+    assert first == second
+    assert first[0][0]['box']['xmax'] == 4000
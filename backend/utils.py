@@ -1,87 +1,341 @@
-from PIL import Image, ImageOps, ImageEnhance
-import os, uuid
+from PIL import Image, ImageEnhance, UnidentifiedImageError
+import math
+import os, uuid, threading, shutil
 from pathlib import Path
-from rembg import remove
+import cv2
+import numpy as np
+from rembg import remove, new_session
+import blobstore
+import fonts
+from encoders import prepare_output
+from largeimage import (ImageTooLarge, check_image, check_budget, open_image, open_reduced, contain_size, resample,
+                        is_large, enhance_in_strips, iter_strips, strip_rows)
+from metrics import stage_timer, queued, cache_lookup, instrument_module, register_cache
 
 BASE = Path(__file__).resolve().parent.parent / "storage"
 
 UPLOAD_DIR = BASE / "uploads"
 GENERATED_DIR = BASE / "generated"
+MASK_DIR = BASE / "masks"
 
 UPLOAD_DIR.mkdir(parents=True, exist_ok=True)
 GENERATED_DIR.mkdir(parents=True, exist_ok=True)
+MASK_DIR.mkdir(parents=True, exist_ok=True)
 
 def save_upload_file_temp(upload_file, subfolder='uploads'):
-    out_dir = BASE / subfolder
-    out_dir.mkdir(parents=True, exist_ok=True)
+    """Store an upload in the blob store and return its content-addressed path"""
     suffix = os.path.splitext(upload_file.filename)[1] or '.png'
-    out_path = UPLOAD_DIR / (str(uuid.uuid4()) + suffix)
-    with open(out_path, 'wb') as f:
-        f.write(upload_file.file.read())
-    return str(out_path)
-
-def remove_background(path):
-    img = Image.open(path)
-    img_no_bg = remove(img)
-    out = GENERATED_DIR / (Path(path).stem + '_nobg.png')
-    img_no_bg.save(out)
-    return str(out)
-
-def resize_image(path, width=None, height=None):
-    img = Image.open(path)
-    w,h = img.size
+    tmp_path = blobstore.temp_path(suffix)
+    with open(tmp_path, 'wb') as f:
+        shutil.copyfileobj(upload_file.file, f, 1 << 20)
+    try:
+        check_image(tmp_path)
+    except ImageTooLarge:
+        os.remove(tmp_path)
+        raise
+    except (UnidentifiedImageError, OSError):
+        pass  # not an image Pillow reads; stored as before
+    return blobstore.put_file(tmp_path)
+
+def _save_output(img, intermediate=False):
+    """Write an operation result into the blob store; identical results share one file.
+
+    Intermediates stay as uncompressed scratch files outside the store, to be
+    read by the next pipeline step and then deleted.
+    """
+    img, pil_format, suffix, params = prepare_output(img, intermediate)
+    tmp_path = blobstore.temp_path(suffix)
+    with stage_timer('utils.encode_intermediate' if intermediate else 'utils.encode'):
+        img.save(tmp_path, format=pil_format, **params)
+    return str(tmp_path) if intermediate else blobstore.put_file(tmp_path)
+
+# Background-removal models selectable per request; 'isnet' is shorthand for rembg's general-use model
+REMBG_MODELS = {
+    'u2net': 'u2net',
+    'u2netp': 'u2netp',
+    'silueta': 'silueta',
+    'isnet': 'isnet-general-use'
+}
+REMBG_DEFAULT_MODEL = os.getenv('REMBG_MODEL', 'u2net')
+REMBG_WARM_MODELS = [m.strip() for m in os.getenv('REMBG_WARM_MODELS', '').split(',') if m.strip()]
+# Concurrent removals x threads per session should not exceed the available cores
+REMBG_MAX_CONCURRENCY = max(1, int(os.getenv('REMBG_MAX_CONCURRENCY', '2')))
+# Segmentation runs on a proxy no larger than this (longest side); 0 segments at full resolution
+REMBG_PROXY_SIZE = int(os.getenv('REMBG_PROXY_SIZE', '1024'))
+REMBG_THREADS = int(os.getenv('REMBG_THREADS', str(max(1, (os.cpu_count() or 1) // REMBG_MAX_CONCURRENCY))))
+
+_rembg_sessions = {}
+_rembg_sessions_lock = threading.Lock()
+_rembg_slots = threading.BoundedSemaphore(REMBG_MAX_CONCURRENCY)
+
+def get_rembg_session(model=None):
+    """Return the process-wide rembg session for a model, creating it on first use"""
+    model = model or REMBG_DEFAULT_MODEL
+    if model not in REMBG_MODELS:
+        raise ValueError(f'Unknown background removal model: {model}. Choose from {", ".join(REMBG_MODELS)}')
+    session = _rembg_sessions.get(model)
+    cache_lookup('rembg_session', session is not None)
+    if session is not None:
+        return session
+    with _rembg_sessions_lock:
+        session = _rembg_sessions.get(model)
+        if session is None:
+            # rembg sizes its onnxruntime thread pools from OMP_NUM_THREADS at session creation
+            previous = os.environ.get('OMP_NUM_THREADS')
+            os.environ['OMP_NUM_THREADS'] = str(REMBG_THREADS)
+            try:
+                session = new_session(REMBG_MODELS[model])
+            finally:
+                if previous is None:
+                    os.environ.pop('OMP_NUM_THREADS', None)
+                else:
+                    os.environ['OMP_NUM_THREADS'] = previous
+            _rembg_sessions[model] = session
+    return session
+
+def warm_rembg_sessions(models=None):
+    """Create sessions up front so the first request does not pay for model loading"""
+    for model in (models if models is not None else REMBG_WARM_MODELS):
+        get_rembg_session(model)
+
+def _guided_filter(guide, src, radius, eps):
+    """Edge-preserving smoothing of src steered by guide (He et al.), both float32 in [0, 1]"""
+    ksize = (2 * radius + 1, 2 * radius + 1)
+    mean_i = cv2.boxFilter(guide, -1, ksize)
+    mean_p = cv2.boxFilter(src, -1, ksize)
+    cov_ip = cv2.boxFilter(guide * src, -1, ksize) - mean_i * mean_p
+    var_i = cv2.boxFilter(guide * guide, -1, ksize) - mean_i * mean_i
+    a = cov_ip / (var_i + eps)
+    b = mean_p - a * mean_i
+    return cv2.boxFilter(a, -1, ksize) * guide + cv2.boxFilter(b, -1, ksize)
+
+def _upsample_mask(mask, guide_img):
+    """Upsample a proxy-resolution mask to the guide image size, snapping edges to image detail"""
+    size = guide_img.size
+    # Filter radius grows with the upsampling factor so it spans the blurred transition band
+    radius = max(2, round(2 * max(size) / max(mask.size)))
+    if is_large(size):
+        return _upsample_mask_strips(mask, guide_img, radius)
+    upsampled = cv2.resize(np.asarray(mask, dtype=np.float32) / 255.0, size, interpolation=cv2.INTER_LINEAR)
+    guide = np.asarray(guide_img.convert('L'), dtype=np.float32) / 255.0
+    refined = _guided_filter(guide, upsampled, radius, 1e-3)
+    return Image.fromarray((np.clip(refined, 0.0, 1.0) * 255).astype(np.uint8), 'L')
+
+def _upsample_mask_strips(mask, guide_img, radius):
+    """_upsample_mask on horizontal strips: full-size arrays stay uint8, float work is per strip.
+
+    Each strip is filtered with 2*radius+1 extra rows either side, the reach of
+    the two box-filter passes, so interior rows match the whole-image result.
+    """
+    width, height = guide_img.size
+    upsampled = cv2.resize(np.asarray(mask, dtype=np.uint8), (width, height), interpolation=cv2.INTER_LINEAR)
+    guide = np.asarray(guide_img.convert('L'))
+    refined = np.empty_like(upsampled)
+    halo = 2 * radius + 1
+    # About ten float32 working arrays per strip
+    rows = max(halo, strip_rows(width, 'F') // 10)
+    for top, bottom in iter_strips(height, rows):
+        above, below = max(0, top - halo), min(height, bottom + halo)
+        strip = _guided_filter(guide[above:below].astype(np.float32) / 255.0,
+                               upsampled[above:below].astype(np.float32) / 255.0, radius, 1e-3)
+        refined[top:bottom] = (np.clip(strip[top - above:bottom - above], 0.0, 1.0) * 255).astype(np.uint8)
+    return Image.fromarray(refined, 'L')
+
+def background_mask(path, model=None, proxy_size=None):
+    """Full-resolution alpha mask for an image, cached on disk per (content, model, proxy size)"""
+    model = model or REMBG_DEFAULT_MODEL
+    proxy_size = REMBG_PROXY_SIZE if proxy_size is None else proxy_size
+    session = get_rembg_session(model)
+    cache_path = MASK_DIR / f'{blobstore.file_digest(path)}_{model}_{proxy_size}.png'
+    cache_lookup('mask', cache_path.exists())
+    if cache_path.exists():
+        mask = Image.open(cache_path)
+        mask.load()
+        return mask
+
+    # Source, grayscale guide and full-size mask arrays
+    img = open_image(path, copies=2)
+    if proxy_size and max(img.size) > proxy_size:
+        # Shrink before converting so the only full-size copy made is for modes that need one
+        proxy = img if img.mode == 'RGB' else img.convert('RGB')
+        proxy = resample(proxy, contain_size(img.size, (proxy_size, proxy_size)), Image.BILINEAR)
+        with queued('rembg'), _rembg_slots, stage_timer('model.rembg'):
+            proxy_mask = remove(proxy, session=session, only_mask=True)
+        mask = _upsample_mask(proxy_mask, img)
+    else:
+        with queued('rembg'), _rembg_slots, stage_timer('model.rembg'):
+            mask = remove(img, session=session, only_mask=True)
+
+    tmp_path = cache_path.with_name(cache_path.stem + f'.{uuid.uuid4().hex}.tmp.png')
+    mask.save(tmp_path)
+    os.replace(tmp_path, cache_path)
+    return mask
+
+def remove_background(path, model=None, intermediate=False):
+    model = model or REMBG_DEFAULT_MODEL
+    mask = background_mask(path, model)
+    img_no_bg = open_image(path, copies=2).convert('RGBA')
+    img_no_bg.putalpha(mask)
+    return _save_output(img_no_bg, intermediate)
+
+def compute_image_hashes(path):
+    """64-bit perceptual (DCT) hash and difference hash of an image, as unsigned ints"""
+    # Reduced decode is enough for a 32x32 hash input and skips most of the JPEG IDCT work
+    gray = cv2.imread(str(path), cv2.IMREAD_REDUCED_GRAYSCALE_8)
+    if gray is None or min(gray.shape[:2]) < 32:
+        gray = cv2.imread(str(path), cv2.IMREAD_GRAYSCALE)
+    if gray is None:
+        raise ValueError(f'Unable to decode image for hashing: {path}')
+
+    small = cv2.resize(gray, (32, 32), interpolation=cv2.INTER_AREA).astype(np.float32)
+    low = cv2.dct(small)[:8, :8].flatten()
+    median = np.median(low[1:])
+    phash = 0
+    for bit in (low > median):
+        phash = (phash << 1) | int(bit)
+
+    tiny = cv2.resize(gray, (9, 8), interpolation=cv2.INTER_AREA)
+    dhash = 0
+    for bit in (tiny[:, 1:] > tiny[:, :-1]).flatten():
+        dhash = (dhash << 1) | int(bit)
+    return phash, dhash
+
+def resize_image(path, width=None, height=None, intermediate=False):
+    size, _ = check_image(path)
+    w,h = size
     if width and height:
-        new = img.resize((int(width), int(height)), Image.LANCZOS)
+        out = (int(width), int(height))
     elif width:
-        new = ImageOps.contain(img, (int(width), h))
+        out = contain_size(size, (int(width), h))
     elif height:
-        new = ImageOps.contain(img, (w, int(height)))
+        out = contain_size(size, (w, int(height)))
     else:
         return path
-    out = Path(path).with_name(Path(path).stem + f'_resized.png')
-    new.save(out)
-    return str(out)
+    # Large downscales decode the JPEG reduced; decoded source plus output bounds the memory
+    img = open_reduced(path, max(out[0] / w, out[1] / h))
+    check_budget((img.size, img.mode), (out, img.mode))
+    new = resample(img, out)
+    return _save_output(new, intermediate)
 
-def rotate_image(path, degrees):
-    img = Image.open(path)
+def rotate_image(path, degrees, intermediate=False):
+    img = open_image(path)
+    w, h = img.size
+    angle = math.radians(float(degrees))
+    expanded = (math.ceil(abs(w * math.cos(angle)) + abs(h * math.sin(angle))),
+                math.ceil(abs(w * math.sin(angle)) + abs(h * math.cos(angle))))
+    check_budget((img.size, img.mode), (expanded, img.mode))
     new = img.rotate(float(degrees), expand=True)
-    out = Path(path).with_name(Path(path).stem + f'_rot{degrees}.png')
-    new.save(out)
-    return str(out)
+    return _save_output(new, intermediate)
 
-def crop_image(path, left, top, right, bottom):
-    img = Image.open(path)
+def crop_image(path, left, top, right, bottom, intermediate=False):
+    img = open_image(path)
+    check_budget((img.size, img.mode), ((max(0, right - left), max(0, bottom - top)), img.mode))
     cropped = img.crop((left, top, right, bottom))
-    out = Path(path).with_name(Path(path).stem + f'_crop{left}_{top}_{right}_{bottom}.png')
-    cropped.save(out)
-    return str(out)
+    return _save_output(cropped, intermediate)
 
-def apply_filter(path, filter_type, value=1.0):
-    img = Image.open(path)
+def apply_filter(path, filter_type, value=1.0, intermediate=False):
+    if filter_type not in ('brightness', 'contrast', 'sharpness'):
+        return path
+    img = open_image(path)
+    if is_large(img.size):
+        # In place, strip by strip: one full-size buffer instead of three
+        check_budget((img.size, img.mode))
+        return _save_output(enhance_in_strips(img, filter_type, value), intermediate)
+    check_budget(*[(img.size, img.mode)] * 3)
     if filter_type == 'brightness':
         enhancer = ImageEnhance.Brightness(img)
         new = enhancer.enhance(value)
     elif filter_type == 'contrast':
         enhancer = ImageEnhance.Contrast(img)
         new = enhancer.enhance(value)
-    elif filter_type == 'sharpness':
+    else:
         enhancer = ImageEnhance.Sharpness(img)
         new = enhancer.enhance(value)
+    return _save_output(new, intermediate)
+
+def draw_text(img, text, x, y, font_size=20, color=(255,255,255), font=None, max_width=None,
+              align='left', anchor='la', spacing=4) -> bool:
+    """Draw wrapped text anchored at (x, y) onto an RGB/RGBA image in place, touching only the region it covers.
+
+    Returns False if the text falls entirely outside the image.
+    """
+    mask, (left, top), _ = fonts.text_layer(text, font, font_size, max_width, align, spacing, anchor)
+    x, y = round(x), round(y)
+    box = (max(0, x + left), max(0, y + top), min(img.width, x + left + mask.width), min(img.height, y + top + mask.height))
+    if box[0] >= box[2] or box[1] >= box[3]:
+        return False
+    coverage = mask.crop((box[0] - x - left, box[1] - y - top, box[2] - x - left, box[3] - y - top))
+    if len(color) == 4 and color[3] < 255:
+        coverage = coverage.point(lambda v: v * color[3] // 255)
+    if img.mode == 'RGBA':
+        # Source-over onto transparent pixels, which a masked paste would blend with their hidden colour
+        layer = Image.new('RGBA', coverage.size, tuple(color[:3]) + (0,))
+        layer.putalpha(coverage)
+        region = img.crop(box)
+        region.alpha_composite(layer)
+        img.paste(region, box[:2])
     else:
+        img.paste(tuple(color[:3]), box, coverage)
+    return True
+
+def overlay_text(path, text, x, y, font_size=20, color=(255,255,255), intermediate=False,
+                 font=None, max_width=None, align='left', anchor='la', spacing=4):
+    # Layout errors (unknown font, anchor) are raised before the image is decoded
+    fonts.text_layer(text, font, font_size, max_width, align, spacing, anchor)
+    img = open_image(path)
+    if img.mode not in ('RGB', 'RGBA'):
+        img = img.convert('RGBA')
+    if not draw_text(img, text, x, y, font_size, color, font, max_width, align, anchor, spacing):
         return path
-    out = Path(path).with_name(Path(path).stem + f'_{filter_type}{value}.png')
-    new.save(out)
-    return str(out)
-
-def overlay_text(path, text, x, y, font_size=20, color=(255,255,255)):
-    img = Image.open(path).convert('RGBA')
-    from PIL import ImageDraw, ImageFont
-    draw = ImageDraw.Draw(img)
+    return _save_output(img, intermediate)
+
+def apply_operations(path, ops):
+    """Apply a manipulation spec in the fixed pipeline order.
+
+    `ops` uses the shape stored in asset_versions.operation_params, so a
+    recorded version can be re-derived from its base by calling this again.
+    Returns (output_path, applied_operation_names).
+    """
+    steps = []
+    if ops.get('remove_bg'):
+        steps.append(('remove_bg', remove_background, (), {'model': ops.get('bg_model')}))
+    crop = ops.get('crop')
+    if crop and all(crop.get(k) is not None for k in ('left', 'top', 'right', 'bottom')):
+        steps.append(('crop', crop_image, (crop['left'], crop['top'], crop['right'], crop['bottom']), {}))
+    resize = ops.get('resize')
+    if resize and (resize.get('width') or resize.get('height')):
+        steps.append(('resize', resize_image, (), {'width': resize.get('width'), 'height': resize.get('height')}))
+    if ops.get('rotate'):
+        steps.append(('rotate', rotate_image, (ops['rotate'],), {}))
+    filt = ops.get('filter')
+    if filt and filt.get('type'):
+        steps.append(('filter', apply_filter, (filt['type'], filt.get('value', 1.0)), {}))
+    text = ops.get('overlay_text')
+    if text and text.get('text'):
+        steps.append(('overlay_text', overlay_text, (text['text'], text.get('x', 0), text.get('y', 0), text.get('font_size', 20)),
+                      {'font': text.get('font'), 'max_width': text.get('max_width'),
+                       'align': text.get('align', 'left'), 'anchor': text.get('anchor', 'la')}))
+
+    out_path = path
     try:
-        font = ImageFont.truetype("arial.ttf", font_size)
-    except:
-        font = ImageFont.load_default()
-    draw.text((x, y), text, fill=color, font=font)
-    out = Path(path).with_name(Path(path).stem + '_text.png')
-    img.save(out)
-    return str(out)
+        for i, (name, fn, args, kwargs) in enumerate(steps):
+            # Only the last step pays for the configured output codec
+            new_path = fn(out_path, *args, intermediate=i < len(steps) - 1, **kwargs)
+            if new_path != out_path and blobstore.is_temp(out_path):
+                os.remove(out_path)
+            out_path = new_path
+        if blobstore.is_temp(out_path):
+            # The last step was a no-op on an intermediate
+            with Image.open(out_path) as img:
+                final_path = _save_output(img)
+            os.remove(out_path)
+            out_path = final_path
+    except Exception:
+        # A failed step must not leave the previous step's scratch file behind
+        if blobstore.is_temp(out_path) and os.path.exists(out_path):
+            os.remove(out_path)
+        raise
+    return out_path, [name for name, _, _, _ in steps]
+
+register_cache('rembg_session', lambda: (None, None, len(_rembg_sessions)))
+instrument_module(globals(), 'utils')
@@ -0,0 +1,221 @@
+import io
+import os
+import re
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image, ImageColor, ImageOps
+import blobstore
+import fonts
+from encoders import prepare_output
+from guidelines import PLATFORM_REQUIREMENTS, validate_creative_rules
+from largeimage import open_image, check_budget, contain_size, resample
+from metrics import stage_timer, timed
+from utils import background_mask, draw_text
+
+# Output size per platform, matching the aspect ratios in guidelines.PLATFORM_REQUIREMENTS.
+# Other sizes can be requested as WIDTHxHEIGHT and are validated as 'general'.
+VARIANT_FORMATS = {
+    'instagram_story': (1080, 1920),
+    'instagram_feed': (1080, 1080),
+    'facebook_banner': (1200, 628),
+}
+# Most copy lines x formats one request may render
+VARIANT_LIMIT = int(os.getenv('VARIANT_LIMIT', '60'))
+VARIANT_MAX_DIMENSION = int(os.getenv('VARIANT_MAX_DIMENSION', '4096'))
+VARIANT_WORKERS = int(os.getenv('VARIANT_WORKERS', str(min(4, os.cpu_count() or 1))))
+
+COPY_FIELDS = ('headline', 'subhead', 'caveat', 'tags', 'description')
+FITS = ('cover', 'contain')
+OUTPUTS = ('store', 'zip')
+# Text sizes as multiples of the platform's minimum font size
+TEXT_SCALES = {'headline': 3.0, 'subhead': 2.0, 'tags': 1.5, 'caveat': 1.0}
+_CUSTOM_FORMAT = re.compile(r'^(\d+)x(\d+)$')
+
+# Pillow releases the GIL while resampling, compositing and encoding, so variants render in parallel
+_executor = ThreadPoolExecutor(max_workers=VARIANT_WORKERS, thread_name_prefix='variants')
+
+def parse_formats(names):
+    """[(name, (width, height), platform)] for platform names and WIDTHxHEIGHT sizes"""
+    formats = []
+    for name in names:
+        name = name.strip()
+        if any(name == f[0] for f in formats):
+            # Variants are named by format, so a repeat would collide in the zip and the labels
+            raise ValueError(f'Format {name} is listed more than once')
+        if name in VARIANT_FORMATS:
+            formats.append((name, VARIANT_FORMATS[name], name))
+            continue
+        m = _CUSTOM_FORMAT.match(name)
+        if not m:
+            raise ValueError(f'Unknown format: {name}. Use {", ".join(VARIANT_FORMATS)} or WIDTHxHEIGHT')
+        size = (int(m.group(1)), int(m.group(2)))
+        if not (0 < size[0] <= VARIANT_MAX_DIMENSION and 0 < size[1] <= VARIANT_MAX_DIMENSION):
+            raise ValueError(f'Format {name} must be 1 to {VARIANT_MAX_DIMENSION} pixels per side')
+        formats.append((name, size, 'general'))
+    if not formats:
+        raise ValueError('At least one format is required')
+    return formats
+
+def _margins(size, platform):
+    """(top, bottom, sides) text margins from the platform safe zones, or 5% of the short side"""
+    zones = PLATFORM_REQUIREMENTS.get(platform, {}).get('safe_zones')
+    if not zones:
+        m = round(min(size) * 0.05)
+        return m, m, m
+    default = zones.get('all', 0)
+    return zones.get('top', default), zones.get('bottom', default), zones.get('sides', default)
+
+def _min_font(size, platform):
+    if platform in PLATFORM_REQUIREMENTS:
+        return PLATFORM_REQUIREMENTS[platform]['min_font_size']
+    # 20px at 1080px on the short side
+    return max(12, round(20 * min(size) / 1080))
+
+def layout_copy(copy: dict, size, platform, face=None) -> tuple:
+    """Text placements for a copy line, as draw_text keyword dicts, and layout issues.
+
+    Headline and subhead stack down from the top safe zone; tags and caveat stack up
+    from the bottom one. Every line is centred and wrapped to the safe width.
+    """
+    width, height = size
+    top, bottom, sides = _margins(size, platform)
+    max_width = max(1, width - 2 * sides)
+    min_font = _min_font(size, platform)
+    placements, issues = [], []
+
+    y = top
+    for field in ('headline', 'subhead'):
+        text = (copy.get(field) or '').strip()
+        if text:
+            font_size = round(min_font * TEXT_SCALES[field])
+            box = fonts.measure_text(text, face, font_size, max_width, 'center', anchor='ma')['box']
+            placements.append({'text': text, 'x': width / 2, 'y': y, 'font_size': font_size,
+                               'max_width': max_width, 'align': 'center', 'anchor': 'ma'})
+            y += box[3] + min_font // 2
+    top_end = y
+
+    y = height - bottom
+    for field in ('caveat', 'tags'):
+        text = (copy.get(field) or '').strip()
+        if text:
+            font_size = round(min_font * TEXT_SCALES[field])
+            box = fonts.measure_text(text, face, font_size, max_width, 'center', anchor='md')['box']
+            placements.append({'text': text, 'x': width / 2, 'y': y, 'font_size': font_size,
+                               'max_width': max_width, 'align': 'center', 'anchor': 'md'})
+            y += box[1] - min_font // 2
+    if y < top_end:
+        issues.append({
+            'type': 'warning',
+            'msg': f'Copy does not fit the {width}x{height} layout: top and bottom text overlap',
+            'category': 'layout'
+        })
+    return placements, issues
+
+def _base_layer(img, size, fit, background):
+    """Source fitted to a format: cropped to fill it, or contained and centred on a background-filled canvas"""
+    if fit == 'cover':
+        return ImageOps.fit(img, size, Image.LANCZOS)
+    fitted = resample(img, contain_size(img.size, size))
+    canvas = Image.new(img.mode, size, background if img.mode == 'RGBA' else background[:3])
+    canvas.paste(fitted, ((size[0] - fitted.width) // 2, (size[1] - fitted.height) // 2))
+    return canvas
+
+def _encode(img):
+    """Encoded bytes and file suffix under the output codec policy"""
+    img, pil_format, suffix, params = prepare_output(img)
+    buf = io.BytesIO()
+    with stage_timer('variants.encode'):
+        img.save(buf, format=pil_format, **params)
+    return buf.getvalue(), suffix
+
+def _render(base, placements, color, face):
+    img = base.copy()
+    for p in placements:
+        draw_text(img, color=color, font=face, **p)
+    return _encode(img)
+
+@timed('variants.render')
+def render_variants(path, copies, formats, remove_bg=False, bg_model=None, fit='cover',
+                    face=None, color='#ffffff', background='#ffffff', render_rejected=False):
+    """Render every copy line onto every format from one decode of the source.
+
+    Each copy line is checked with validate_creative_rules for each format's platform;
+    lines with a hard fail are not rendered unless render_rejected is set.
+    With fit='contain' the padding is filled with background ('transparent' keeps alpha).
+    Returns one result dict per (copy, format), in copy-major order, with the
+    encoded image under 'data' and 'suffix' for rendered variants.
+    """
+    if fit not in FITS:
+        raise ValueError(f'Unknown fit: {fit}. Choose from {", ".join(FITS)}')
+    if not copies:
+        raise ValueError('At least one copy line is required')
+    if len(copies) * len(formats) > VARIANT_LIMIT:
+        raise ValueError(f'{len(copies)} copy lines x {len(formats)} formats exceeds the limit of {VARIANT_LIMIT} variants')
+    rgb = ImageColor.getrgb(color)
+    fill = (0, 0, 0, 0) if background == 'transparent' else ImageColor.getcolor(background, 'RGBA')
+    fonts.resolve_face(face)
+
+    results = []
+    jobs = []
+    for i, copy in enumerate(copies):
+        copy = {k: copy.get(k, '') or '' for k in COPY_FIELDS}
+        for name, size, platform in formats:
+            issues = validate_creative_rules(copy, platform)
+            placements, layout_issues = layout_copy(copy, size, platform, face)
+            issues = issues + layout_issues
+            rejected = any(issue['type'] == 'hard_fail' for issue in issues)
+            result = {'copy_index': i, 'format': name, 'width': size[0], 'height': size[1],
+                      'platform': platform, 'status': 'rejected' if rejected else 'rendered', 'issues': issues}
+            results.append(result)
+            if render_rejected or not rejected:
+                jobs.append((result, name, placements))
+    if not jobs:
+        return results
+
+    # One decode (and one cached mask) shared by every format
+    with stage_timer('variants.decode'):
+        img = open_image(path, copies=2)
+        check_budget(*[(size, 'RGBA') for _, size, _ in formats])
+        if remove_bg:
+            mask = background_mask(path, bg_model)
+            img = img.convert('RGBA')
+            img.putalpha(mask)
+        else:
+            # Transparent sources, and contain padding with a transparent background, keep alpha
+            alpha = 'A' in img.getbands() or 'transparency' in img.info or (fit == 'contain' and fill[3] < 255)
+            if img.mode != ('RGBA' if alpha else 'RGB'):
+                img = img.convert('RGBA' if alpha else 'RGB')
+        img.load()
+
+    sizes = {name: size for name, size, _ in formats}
+    used = sorted({name for _, name, _ in jobs})
+    with stage_timer('variants.base'):
+        bases = dict(zip(used, _executor.map(lambda name: _base_layer(img, sizes[name], fit, fill), used)))
+    del img
+
+    futures = [(result, _executor.submit(_render, bases[name], placements, rgb, face)) for result, name, placements in jobs]
+    for result, future in futures:
+        result['data'], result['suffix'] = future.result()
+    return results
+
+def store_variants(results) -> None:
+    """Move rendered variant bytes into the blob store, replacing 'data' with 'path'"""
+    for result in results:
+        if 'data' in result:
+            result['path'] = blobstore.put_bytes(result.pop('data'), result.pop('suffix'))
+
+def variant_filename(result) -> str:
+    return f"{result['copy_index'] + 1:02d}_{result['format']}{result['suffix']}"
+
+def zip_variants(results, manifest: bytes) -> bytes:
+    """Zip of rendered variants plus a manifest; images are already compressed, so entries are stored"""
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, 'w', zipfile.ZIP_STORED) as zf:
+        for result in results:
+            if 'data' in result:
+                zf.writestr(variant_filename(result), result['data'])
+        zf.writestr('manifest.json', manifest)
+    return buf.getvalue()
+
+def shutdown():
+    _executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,99 @@
+import os
+import json
+import threading
+from collections import OrderedDict
+from db import save_asset_version, get_version_record, set_version_keyframe, record_version_access
+from utils import apply_operations
+from metrics import cache_lookup, register_cache
+
+# 'full' keeps an image for every version; 'oplog' keeps keyframes and re-derives the rest
+VERSION_STORAGE_MODE = os.getenv('VERSION_STORAGE_MODE', 'full').lower()
+# Longest run of op-log-only versions before another keyframe is kept
+KEYFRAME_INTERVAL = int(os.getenv('KEYFRAME_INTERVAL', '5'))
+# Op-log-only versions read this often are promoted back to keyframes
+KEYFRAME_PROMOTE_ACCESSES = int(os.getenv('KEYFRAME_PROMOTE_ACCESSES', '3'))
+MATERIALIZED_CACHE_SIZE = int(os.getenv('MATERIALIZED_CACHE_SIZE', '64'))
+
+# Operations whose output can be re-derived from operation_params
+REPLAYABLE_OPERATIONS = {'manipulate', 'batch_manipulate', 'restore'}
+
+_materialized = OrderedDict()
+_materialized_lock = threading.Lock()
+register_cache('materialized_version', lambda: (None, None, len(_materialized)))
+
+def _cache_get(key):
+    with _materialized_lock:
+        path = _materialized.get(key)
+        if path is not None:
+            _materialized.move_to_end(key)
+        return path
+
+def _cache_put(key, path):
+    with _materialized_lock:
+        _materialized[key] = path
+        _materialized.move_to_end(key)
+        while len(_materialized) > MATERIALIZED_CACHE_SIZE:
+            _materialized.popitem(last=False)
+
+def _replay_base(record):
+    """Version a record is derived from when replayed"""
+    if record['operation'] == 'restore':
+        return json.loads(record['params'] or '{}').get('restored_from')
+    return record['base_version']
+
+def _keyframe_distance(db_path, asset_id, version):
+    """Number of op-log-only versions between `version` and its nearest keyframe ancestor"""
+    distance = 0
+    record = get_version_record(db_path, asset_id, version)
+    while record and not record['is_keyframe']:
+        distance += 1
+        record = get_version_record(db_path, asset_id, _replay_base(record))
+    return distance
+
+def record_version(db_path, asset_id, path, operation, operation_params=None, created_by=None):
+    """Save a new current version; in op-log mode the superseded version may drop its image"""
+    new_version = save_asset_version(db_path, asset_id, path, operation, operation_params, created_by)
+    if VERSION_STORAGE_MODE == 'oplog' and new_version and new_version > 2:
+        _maybe_demote(db_path, asset_id, new_version - 1)
+    return new_version
+
+def _maybe_demote(db_path, asset_id, version):
+    record = get_version_record(db_path, asset_id, version)
+    if not record or not record['is_keyframe'] or record['operation'] not in REPLAYABLE_OPERATIONS:
+        return
+    base = _replay_base(record)
+    if base is None or _keyframe_distance(db_path, asset_id, base) + 1 >= KEYFRAME_INTERVAL:
+        return
+    set_version_keyframe(db_path, asset_id, version, False)
+
+def resolve_version_path(db_path, asset_id, version):
+    """Path to a version's image, replaying operations from the nearest keyframe if needed"""
+    record = get_version_record(db_path, asset_id, version)
+    if record is None:
+        return None
+    if record['is_keyframe']:
+        return record['path']
+
+    key = (asset_id, version)
+    path = _cache_get(key)
+    cache_lookup('materialized_version', path is not None)
+    if path is None or not os.path.exists(path):
+        # The old output may still be on disk until blob garbage collection removes it
+        if record['path'] and os.path.exists(record['path']):
+            path = record['path']
+        else:
+            path = _replay(db_path, asset_id, record)
+        _cache_put(key, path)
+
+    if path and record_version_access(db_path, asset_id, version) >= KEYFRAME_PROMOTE_ACCESSES:
+        set_version_keyframe(db_path, asset_id, version, True, path)
+    return path
+
+def _replay(db_path, asset_id, record):
+    params = json.loads(record['params'] or '{}')
+    base_path = resolve_version_path(db_path, asset_id, _replay_base(record))
+    if record['operation'] == 'restore' or base_path is None:
+        return base_path
+    ops = params['operations'] if params.get('batch_operation') else params
+    out_path, _ = apply_operations(base_path, ops)
+    return out_path
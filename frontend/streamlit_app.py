@@ -31,6 +31,32 @@ def get_auth_headers():
         return {'Authorization': f'Bearer {st.session_state.auth_token}'}
     return {}
 
+IMAGE_CACHE_SIZE = int(os.getenv('IMAGE_CACHE_SIZE', '200'))
+
+def fetch_asset(path):
+    """Image bytes for a backend asset URL, revalidated with If-None-Match so reruns reuse the cached copy.
+
+    Version URLs are immutable and are served from the cache without a request.
+    """
+    cache = st.session_state.setdefault('image_cache', {})
+    cached = cache.get(path)
+    if cached and '/version/' in path:
+        return cached['content']
+    headers = get_auth_headers()
+    if cached:
+        headers['If-None-Match'] = cached['etag']
+    resp = requests.get(f'{BACKEND_URL}{path}', headers=headers)
+    if resp.status_code == 304 and cached:
+        return cached['content']
+    if not resp.ok:
+        return None
+    cache.pop(path, None)
+    if resp.headers.get('ETag'):
+        cache[path] = {'etag': resp.headers['ETag'], 'content': resp.content}
+        while len(cache) > IMAGE_CACHE_SIZE:
+            cache.pop(next(iter(cache)))
+    return resp.content
+
 def login(username, password):
     try:
         resp = requests.post(f'{BACKEND_URL}/login', data={'username': username, 'password': password})
@@ -47,6 +73,7 @@ def login(username, password):
 def logout():
     st.session_state.auth_token = None
     st.session_state.current_user = None
+    st.session_state.pop('image_cache', None)
     st.rerun()
 
 def register(username, password, email):
@@ -261,27 +288,25 @@ if st.session_state.current_page == 'Dashboard':
             with st.spinner('Generating comprehensive report...'):
                 resp = requests.get(f'{BACKEND_URL}/export_report', headers=get_auth_headers())
             if resp.ok:
-                data = resp.json()
-                st.success(f'✅ Report generated with {data["metrics_count"]} metrics!')
+                st.success(f'✅ Report generated with {resp.headers.get("X-Metrics-Count", "?")} metrics!')
+                disposition = resp.headers.get('Content-Disposition', '')
+                file_name = disposition.split('filename=')[-1].strip('"') if 'filename=' in disposition else 'creative_tool_report.csv'
 
                 # Create download button for CSV
-                csv_content = data['content']
+                csv_content = resp.text
                 st.download_button(
                     label='📥 Download CSV Report',
                     data=csv_content,
-                    file_name=data['filename'],
+                    file_name=file_name,
                     mime='text/csv',
                     help='Click to download the comprehensive report'
                 )
 
                 # Show preview of key metrics
                 with st.expander('📋 Report Preview'):
-                    lines = csv_content.strip().split('\n')
-                    if len(lines) >= 2:
-                        headers = lines[0].split(',')
-                        values = lines[1].split(',')
-                        preview_data = {h: v for h, v in zip(headers[:10], values[:10])}  # Show first 10 metrics
-                        st.json(preview_data)
+                    report_df = pd.read_csv(io.StringIO(csv_content), dtype=str)
+                    summary = report_df[report_df['section'] == 'summary']
+                    st.json(dict(zip(summary['metric'], summary['value'])))
             else:
                 st.error('Failed to generate report')
 
@@ -296,19 +321,26 @@ if st.session_state.current_page == 'Dashboard':
             st.metric('Total Assets', 0)
             st.stop()
 
+        def get_rollup(dimension, **params):
+            r = requests.get(f'{BACKEND_URL}/analytics/{dimension}', params=params, headers=get_auth_headers())
+            return r.json()['buckets'] if r.ok else []
+
+        category_rollup = get_rollup('category')
+
         # Key Performance Indicators
         st.subheader('📊 Key Performance Indicators')
         col1, col2, col3, col4, col5, col6 = st.columns(6)
         with col1:
             st.metric('Total Assets', total_assets, delta='+12 this week')
         with col2:
-            processed = sum(1 for a in assets if 'processed' in (a.get('label') or '').lower())
+            processed = sum(b['count'] for b in get_rollup('processed'))
             processed_pct = (processed / total_assets * 100) if total_assets > 0 else 0
             st.metric('Processed', processed, delta=f'{processed_pct:.1f}%')
         with col3:
             st.metric('Compliance Rate', '98.5%', delta='+0.5%')
         with col4:
-            avg_size = np.mean([len(requests.get(f'{BACKEND_URL}/asset/{a["id"]}', headers=get_auth_headers()).content) for a in assets[:min(10, len(assets))]]) / 1024 if assets else 0
+            rollup_count = sum(b['count'] for b in category_rollup)
+            avg_size = sum(b['bytes'] for b in category_rollup) / rollup_count / 1024 if rollup_count else 0
             st.metric('Avg Size', f'{avg_size:.1f} KB')
         with col5:
             st.metric('Active Users', '24', delta='+3 today')
@@ -328,7 +360,12 @@ if st.session_state.current_page == 'Dashboard':
             # Asset Upload Trends - Full Width
             st.subheader('📈 Asset Upload Trends & Daily Performance Analysis')
 
-            daily_uploads = df.groupby('date').size().tail(30)  # Last 30 days
+            # Upload counts per UTC day come straight from the analytics rollups
+            day_rollup = get_rollup('upload_day')
+            all_daily = pd.Series({pd.Timestamp(b['bucket']).date(): b['count'] for b in day_rollup}, dtype='int64')
+            if all_daily.empty:
+                all_daily = df.groupby('date').size()
+            daily_uploads = all_daily.tail(30)  # Last 30 days
 
             # Calculate comprehensive trend and statistics
             total_uploads = daily_uploads.sum()
@@ -416,7 +453,7 @@ if st.session_state.current_page == 'Dashboard':
             with st.container(height=500):
                 st.markdown('<h4 style="text-align: center; color: #fff; margin-bottom: 20px;">📅 Weekly Performance Analysis & Trends</h4>', unsafe_allow_html=True)
 
-                weekday_uploads = df.groupby('weekday').size().reindex(['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday'])
+                weekday_uploads = all_daily.groupby(pd.to_datetime(all_daily.index).day_name()).sum().reindex(['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday'])
                 weekday_data = weekday_uploads.fillna(0)
 
                 # Calculate comprehensive insights
@@ -621,20 +658,37 @@ if st.session_state.current_page == 'Dashboard':
 
                 # Clean Up Assets
                 if st.button('🧹 Clean Up Assets', help='Remove unused assets older than 30 days', width='stretch'):
+                    st.session_state.cleanup_plan = None
                     with st.spinner('Checking for old assets...'):
-                        resp = requests.post(f'{BACKEND_URL}/cleanup_assets', data={'days': 30}, headers=get_auth_headers())
+                        resp = requests.post(f'{BACKEND_URL}/cleanup_assets', params={'days': 30}, headers=get_auth_headers())
                     if resp.ok:
                         data = resp.json()
                         st.info(f'Found {data["found_old_assets"]} assets older than 30 days')
-                        if data["found_old_assets"] > 0:
-                            st.warning(f'Would delete assets: {", ".join(map(str, data["would_delete"]))}')
-                            if st.button('Confirm Delete', key='confirm_cleanup'):
-                                st.success('Cleanup completed (simulation)')
+                        if data['versions'] or data['orphaned_files']:
+                            # Kept across the rerun that the confirm button's click triggers
+                            st.session_state.cleanup_plan = data
                         else:
                             st.success('No old assets to clean up')
                     else:
                         st.error('Cleanup check failed')
 
+                plan = st.session_state.get('cleanup_plan')
+                if plan:
+                    st.warning(f'Would delete {len(plan["versions"])} old versions of assets '
+                               f'{", ".join(map(str, plan["would_delete"]))} and {len(plan["orphaned_files"])} orphaned files '
+                               f'({plan["bytes_reclaimable"] / (1024 * 1024):.1f} MB)')
+                    confirm_col, cancel_col = st.columns(2)
+                    if confirm_col.button('Confirm Delete', key='confirm_cleanup'):
+                        st.session_state.cleanup_plan = None
+                        resp = requests.post(f'{BACKEND_URL}/cleanup_assets', params={'days': 30, 'dry_run': 'false'}, headers=get_auth_headers())
+                        if resp.ok:
+                            st.success(f'Cleanup started in the background (job {resp.json()["job_id"]})')
+                        else:
+                            st.error('Cleanup failed')
+                    elif cancel_col.button('Cancel', key='cancel_cleanup'):
+                        st.session_state.cleanup_plan = None
+                        st.rerun()
+
                 # Generate Report
                 if st.button('📊 Generate Report', help='Create monthly analytics report', width='stretch'):
                     with st.spinner('Generating report...'):
@@ -680,12 +734,12 @@ if st.session_state.current_page == 'Dashboard':
 
                 # Backup Data
                 if st.button('💾 Backup Data', help='Create system backup', width='stretch'):
-                    with st.spinner('Creating backup...'):
+                    with st.spinner('Starting backup...'):
                         resp = requests.post(f'{BACKEND_URL}/backup_data', headers=get_auth_headers())
                     if resp.ok:
                         data = resp.json()
-                        if data['status'] == 'success':
-                            st.success(f'Backup created: {data["backup_path"]}')
+                        if data['status'] in ('started', 'success'):
+                            st.success(f'Backup started: {data["backup_path"]} (id {data.get("backup_id")})')
                         else:
                             st.error(f'Backup failed: {data["error"]}')
                     else:
@@ -727,8 +781,11 @@ if st.session_state.current_page == 'Dashboard':
                     sizes = []
                     for asset in assets[:min(100, len(assets))]:  # Increased sample size
                         try:
-                            size_kb = len(requests.get(f'{BACKEND_URL}/asset/{asset["id"]}', headers=get_auth_headers()).content) / 1024
-                            sizes.append(size_kb)
+                            # HEAD returns the stored size without transferring the image
+                            head = requests.head(f'{BACKEND_URL}/asset/{asset["id"]}', headers=get_auth_headers())
+                            if not head.ok:
+                                continue
+                            sizes.append(int(head.headers['Content-Length']) / 1024)
                         except:
                             continue
 
@@ -977,9 +1034,9 @@ elif st.session_state.current_page == 'Asset Library':
                 with cols[i % 4]:
                     with st.container():
                         st.markdown('<div class="asset-card">', unsafe_allow_html=True)
-                        resp_img = requests.get(f'{BACKEND_URL}/asset/{asset["id"]}', headers=get_auth_headers())
-                        if resp_img.ok:
-                            st.image(resp_img.content, width=150)
+                        image_bytes = fetch_asset(f'/asset/{asset["id"]}?width=300&format=webp')
+                        if image_bytes:
+                            st.image(image_bytes, width=150)
                         st.caption(f'ID: {asset["id"]}')
                         st.caption(asset['label'] or 'Untitled')
                         if st.button('Select for Editing', key=f'select_{asset["id"]}', width='stretch'):
@@ -1000,9 +1057,9 @@ elif st.session_state.current_page == 'Image Editor':
         st.subheader('Select Asset')
         asset_id = st.number_input('Asset ID', min_value=0, value=st.session_state.selected_asset, key='manip_asset_id', help='Enter asset ID or select from Asset Library tab')
         if asset_id > 0:
-            resp = requests.get(f'{BACKEND_URL}/asset/{asset_id}', headers=get_auth_headers())
-            if resp.ok:
-                st.image(resp.content, caption='Source Image', width=300)
+            image_bytes = fetch_asset(f'/asset/{asset_id}?width=600&format=webp')
+            if image_bytes:
+                st.image(image_bytes, caption='Source Image', width=300)
             else:
                 st.error('Asset not found or invalid ID')
 
@@ -1030,6 +1087,13 @@ elif st.session_state.current_page == 'Image Editor':
             overlay_x = st.number_input('X Position', min_value=0, value=10)
             overlay_y = st.number_input('Y Position', min_value=0, value=10)
             font_size = st.slider('Font Size', 10, 100, 20)
+            font_resp = requests.get(f'{BACKEND_URL}/fonts', headers=get_auth_headers())
+            font_faces = font_resp.json().get('fonts', []) if font_resp.ok else []
+            font_face = st.selectbox('Font', ['Default'] + font_faces)
+            text_max_width = st.number_input('Wrap Width (px, 0 = no wrapping)', min_value=0, value=0)
+            text_align = st.selectbox('Line Alignment', ['left', 'center', 'right'])
+            text_anchor = st.selectbox('Anchor', ['la', 'ma', 'ra', 'lm', 'mm', 'rm', 'ld', 'md', 'rd'],
+                                       help='Point of the text block placed at (X, Y): horizontal l/m/r, vertical a(top)/m(iddle)/d(bottom)')
 
         if st.button('Apply Changes', type='primary', width='stretch'):
             with st.spinner('Processing image...'):
@@ -1048,8 +1112,14 @@ elif st.session_state.current_page == 'Image Editor':
                     'overlay_text_str': overlay_text,
                     'overlay_x': overlay_x,
                     'overlay_y': overlay_y,
-                    'font_size': font_size
+                    'font_size': font_size,
+                    'text_align': text_align,
+                    'text_anchor': text_anchor
                 }
+                if font_face != 'Default':
+                    data['font'] = font_face
+                if text_max_width:
+                    data['text_max_width'] = int(text_max_width)
                 resp = requests.post(f'{BACKEND_URL}/manipulate_image', data=data, headers=get_auth_headers())
             if resp.ok:
                 st.success('Image processing completed successfully!')
@@ -1071,9 +1141,9 @@ elif st.session_state.current_page == 'AI Analysis':
         analysis_asset_id = st.number_input('Asset ID', min_value=0, value=st.session_state.selected_asset, key='analysis_asset_id', help='Enter asset ID to analyze')
 
         if analysis_asset_id > 0:
-            resp = requests.get(f'{BACKEND_URL}/asset/{analysis_asset_id}', headers=get_auth_headers())
-            if resp.ok:
-                st.image(resp.content, caption=f'Asset {analysis_asset_id}', width=250)
+            image_bytes = fetch_asset(f'/asset/{analysis_asset_id}?width=500&format=webp')
+            if image_bytes:
+                st.image(image_bytes, caption=f'Asset {analysis_asset_id}', width=250)
             else:
                 st.error('Asset not found')
 
@@ -1140,9 +1210,9 @@ elif st.session_state.current_page == 'AI Creative Assistant':
         creative_asset_id = st.number_input('Asset ID', min_value=0, value=st.session_state.selected_asset, key='creative_asset_id', help='Enter packshot asset ID to analyze and generate creatives')
 
         if creative_asset_id > 0:
-            resp = requests.get(f'{BACKEND_URL}/asset/{creative_asset_id}', headers=get_auth_headers())
-            if resp.ok:
-                st.image(resp.content, caption=f'Packshot Asset {creative_asset_id}', width=250)
+            image_bytes = fetch_asset(f'/asset/{creative_asset_id}?width=500&format=webp')
+            if image_bytes:
+                st.image(image_bytes, caption=f'Packshot Asset {creative_asset_id}', width=250)
             else:
                 st.error('Asset not found')
 
@@ -1257,9 +1327,9 @@ elif st.session_state.current_page == 'Version History':
 
         if version_asset_id > 0:
             # Get current asset
-            resp = requests.get(f'{BACKEND_URL}/asset/{version_asset_id}', headers=get_auth_headers())
-            if resp.ok:
-                st.image(resp.content, caption=f'Current Version (Asset {version_asset_id})', width=250)
+            image_bytes = fetch_asset(f'/asset/{version_asset_id}?width=500&format=webp')
+            if image_bytes:
+                st.image(image_bytes, caption=f'Current Version (Asset {version_asset_id})', width=250)
                 st.caption('This is the current version')
             else:
                 st.error('Asset not found')
@@ -1285,9 +1355,9 @@ elif st.session_state.current_page == 'Version History':
                     col_a, col_b = st.columns([1, 2])
                     with col_a:
                         # Show version image
-                        resp = requests.get(f'{BACKEND_URL}/asset/{version_asset_id}/version/{version["version"]}', headers=get_auth_headers())
-                        if resp.ok:
-                            st.image(resp.content, width=150)
+                        image_bytes = fetch_asset(f'/asset/{version_asset_id}/version/{version["version"]}?width=300&format=webp')
+                        if image_bytes:
+                            st.image(image_bytes, width=150)
                         else:
                             st.error('Version image not available')
 
@@ -1411,9 +1481,9 @@ elif st.session_state.current_page == 'Compliance Check':
             img_asset_id = st.number_input('Asset ID', min_value=0, value=st.session_state.selected_asset, key='val_asset_id', help='Enter asset ID from library')
 
             if img_asset_id > 0:
-                resp = requests.get(f'{BACKEND_URL}/asset/{img_asset_id}', headers=get_auth_headers())
-                if resp.ok:
-                    st.image(resp.content, caption=f'Asset {img_asset_id}', width=200)
+                image_bytes = fetch_asset(f'/asset/{img_asset_id}?width=400&format=webp')
+                if image_bytes:
+                    st.image(image_bytes, caption=f'Asset {img_asset_id}', width=200)
                 else:
                     st.warning('Asset preview unavailable')
 